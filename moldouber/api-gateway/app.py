@@ -1,18 +1,59 @@
 # api-gateway/app.py
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
+from flask.json.provider import JSONProvider
+import functools
 import os
 import requests
-import pybreaker
-import threading
-from datetime import datetime, timedelta
+from prometheus_client import CollectorRegistry
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+from upstream import (
+    upstream_pools, hedge_policy, balancer, circuit_breakers, retry_policy,
+    discovery, payment_status_cache, idempotency_store, saga_orchestrator, batch_executor, concurrency_limiter,
+    rate_limiter, call_service_with_retry,
+)
+from concurrency_limit import ConcurrencyLimitExceeded
+from retry_policy import RetriesExhaustedError
+from batch import BatchError
+from routes import ROUTES, RequestInvalid
+from saga import SagaRun, SagaDefinitionError, parse_steps, saga_deadline
+from saga_log import SagaExists
+from idempotency import IdempotencyKeyInvalid, IdempotencyConflict, IdempotencyInProgress
+import fast_json
+from fast_json import UPSTREAM_PASSTHROUGH, relay_headers
+import multiprocess_metrics
+from multiprocess_metrics import MULTIPROCESS
+import structured_log
+from structured_log import configure_logging, new_request_id, REQUEST_ID_HEADER
+import tracing
+from tracing import TRACEPARENT_HEADER
+
+
+class FastJSONProvider(JSONProvider):
+    """jsonify and request.json through fast_json (orjson when installed)."""
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return fast_json.dumps_str(obj)
+
+    def loads(self, s, **kwargs):
+        return fast_json.loads(s)
+
+    def response(self, *args, **kwargs):
+        return self._app.response_class(fast_json.dumps(self._prepare_response_obj(args, kwargs)),
+                                        mimetype=self.mimetype)
 
 
 app = Flask(__name__)
-metrics = PrometheusMetrics(app)
+app.json = FastJSONProvider(app)
+if MULTIPROCESS:
+    # Several gunicorn workers (gunicorn.conf.py): /metrics adds up every worker's samples
+    metrics = GunicornInternalPrometheusMetrics(app)
+else:
+    metrics = PrometheusMetrics(app)
 metrics.info('app_info', 'API Gateway Information', version='1.0.0')
-blacklist_lock = threading.Lock()
 
 # Define metrics
 REQUEST_COUNT = metrics.counter(
@@ -28,297 +69,254 @@ REQUEST_LATENCY = metrics.histogram(
     buckets=(0.1, 0.5, 1, 2, 5)
 )
 
+# Upstream failures a route answers with 503; the deadline or retry budget running out is one
+UPSTREAM_ERRORS = (requests.exceptions.RequestException, RetriesExhaustedError)
+
 # Since Nginx is the gateway to the services, we can simplify service discovery
 NGINX_HOST = 'nginx'
 NGINX_PORT = 80
 
-SERVICE_HOSTS = {
-    'user-location': [
-        'http://user-location-service-1:5001',
-        'http://user-location-service-2:5001'
-    ],
-    'ride-payment': [
-        'http://ride-payment-service-1:5002',
-        'http://ride-payment-service-2:5002'
-    ]
-}
-
-blacklist = {}
-
-def call_service_with_retry(endpoint, payload, service_type):
-    retries_per_instance = 5  
-    timeout = 10  
-    blacklist_duration = timedelta(minutes=1)  
-
-    if service_type not in SERVICE_HOSTS:
-        raise ValueError(f"Unknown service type: {service_type}")
-
-    service_instances = SERVICE_HOSTS[service_type]
-    total_instances = len(service_instances)
-    all_instances_blacklisted = True  # Flag to check if all instances are blacklisted
-
-    for instance_index, host in enumerate(service_instances):
-        instance_key = (service_type, instance_index)
-
-        # Check if the instance is blacklisted
-        with blacklist_lock:
-            if instance_key in blacklist:
-                if datetime.now() >= blacklist[instance_key]:
-                    # Blacklist period has expired; remove from blacklist
-                    del blacklist[instance_key]
-                    print(f"Blacklist expired for instance {instance_index + 1} ({host}).")
-                else:
-                    # Instance is still blacklisted; skip to the next one
-                    print(f"Instance {instance_index + 1} ({host}) is blacklisted until {blacklist[instance_key]}. Skipping...")
-                    continue
-
-        # If we reach here, the instance is not blacklisted
-        all_instances_blacklisted = False  # At least one instance is available
-
-        for retry in range(1, retries_per_instance + 1):
-            try:
-                url = f"{host}/{endpoint}"
-                print(f"Attempt {retry}/{retries_per_instance} on instance {instance_index + 1} ({host})...")
-
-                response = requests.post(url, json=payload, timeout=timeout)
-                response.raise_for_status()  # Raises HTTPError for bad responses (4xx or 5xx)
-
-                print(f"Success: Received response with status code {response.status_code} on instance {instance_index + 1}")
-                return response
-
-            except requests.exceptions.HTTPError as e:
-                print(f"HTTPError on attempt {retry} for instance {instance_index + 1}: {e}")
-            except requests.exceptions.RequestException as e:
-                print(f"RequestException on attempt {retry} for instance {instance_index + 1}: {e}")
-
-        # After all retries for the current instance have failed, add it to the blacklist
-        with blacklist_lock:
-            blacklist_expiry = datetime.now() + blacklist_duration
-            blacklist[instance_key] = blacklist_expiry
-            print(f"All {retries_per_instance} retries failed on instance {instance_index + 1} ({host}).")
-            print(f"Instance {instance_index + 1} ({host}) has been blacklisted until {blacklist_expiry}.\n")
-
-    if all_instances_blacklisted:
-        # If all instances are currently blacklisted
-        print("All instances are currently blacklisted. Circuit breaker is triggered.")
-    else:
-        # If some instances were available but all failed
-        print("All available instances have failed. Circuit breaker is triggered.")
-
-    # If all retries are exhausted on all instances, raise an exception with a custom message
-    raise Exception("Circuit breaker is triggered. All instances are unavailable.")
-
-def call_user_location_service(endpoint, payload):
-    return call_service_with_retry(endpoint, payload, "user-location")
-
-def call_ride_payment_service(endpoint, payload):
-    return call_service_with_retry(endpoint, payload, "ride-payment")
-
-# Endpoint to create an order
-@app.route('/api/user/make_order', methods=['POST'])
-def make_order():
-    data = request.json
-    user_id = data.get('userId')
-    start_long = data.get('startLongitude')
-    start_lat = data.get('startLatitude')
-    end_long = data.get('endLongitude')
-    end_lat = data.get('endLatitude')
-
-    if not all([user_id, start_long, start_lat, end_long, end_lat]):
-        return jsonify({"error": "Missing required fields"}), 400
-
-    payload = {
-        "userId": user_id,
-        "startLongitude": start_long,
-        "startLatitude": start_lat,
-        "endLongitude": end_long,
-        "endLatitude": end_lat
-    }
-
-    try:
-        response = call_user_location_service('make_order', payload)
-        return jsonify(response.json()), response.status_code
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 503
-
-# Endpoint to accept an order
-@app.route('/api/user/accept_order', methods=['POST'])
-def accept_order():
-    data = request.json
-    order_id = data.get('orderId')
-    driver_id = data.get('driverId')
-
-    if not all([order_id, driver_id]):
-        return jsonify({"error": "Missing required fields"}), 400
-
-    payload = {
-        "orderId": order_id,
-        "driverId": driver_id
-    }
-
-    try:
-        response = call_user_location_service('accept_order', payload)
-        return jsonify(response.json()), response.status_code
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 503
-
-# Endpoint to finish an order
-@app.route('/api/user/finish_order', methods=['POST'])
-def finish_order():
-    data = request.json
-    ride_id = data.get('rideId')
-    real_price = data.get('realPrice')
-
-    if not all([ride_id, real_price]):
-        return jsonify({"error": "Missing required fields"}), 400
-
-    payload = {
-        "rideId": ride_id,
-        "realPrice": real_price
-    }
-
-    try:
-        response = call_user_location_service('finish_order', payload)
-        return jsonify(response.json()), response.status_code
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 503
-
-# Endpoint to pay for a ride
-@app.route('/api/ride/pay', methods=['POST'])
-def pay_ride():
-    data = request.json
-    ride_id = data.get('rideId')
-    amount = data.get('amount')
-    user_id = data.get('userId')
-
-    if not all([ride_id, amount, user_id]):
-        return jsonify({"error": "Missing required fields"}), 400
-
-    payload = {
-        "rideId": ride_id,
-        "amount": amount,
-        "userId": user_id
-    }
-
-    try:
-        response = call_ride_payment_service('pay_ride', payload)
-        return jsonify(response.json()), response.status_code
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 503
-
-# Endpoint to process payment
-@app.route('/api/ride/process_payment', methods=['POST'])
-def process_payment():
-    data = request.json
-    ride_id = data.get('rideId')
-
-    if not ride_id:
-        return jsonify({"error": "Missing required fields"}), 400
-
-    payload = {
-        "rideId": ride_id
-    }
-
-    try:
-        response = call_ride_payment_service('process_payment', payload)
-        return jsonify(response.json()), response.status_code
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 503
-    except Exception as e:
-        # Catch all other exceptions
-        return jsonify({"error": str(e)}), 503
+# In multiprocess mode the components' samples already reach /metrics through the shared
+# files; registering the objects with the exported registry as well would list them twice
+component_registry = CollectorRegistry() if MULTIPROCESS else metrics.registry
+
+configure_logging()
+structured_log.register_metrics(component_registry)
+tracing.register_metrics(component_registry)
+upstream_pools.register_metrics(component_registry)
+hedge_policy.register_metrics(component_registry)
+balancer.register_metrics(component_registry)
+circuit_breakers.register_metrics(component_registry)
+retry_policy.register_metrics(component_registry)
+discovery.register_metrics(component_registry)
+payment_status_cache.register_metrics(component_registry)
+idempotency_store.register_metrics(component_registry)
+saga_orchestrator.register_metrics(component_registry)
+batch_executor.register_metrics(component_registry)
+concurrency_limiter.register_metrics(component_registry)
+rate_limiter.register_metrics(component_registry)
+
+
+def start_background_tasks():
+    upstream_pools.start_reaper()
+    discovery.start()
+    saga_orchestrator.start_recovery()
+    rate_limiter.start()
+    multiprocess_metrics.start_refresher()
+
+
+# Under gunicorn the app is preloaded in the master, where threads would not survive the fork
+# into the workers; gunicorn.conf.py starts them in each worker instead
+if os.environ.get('GATEWAY_SERVER') != 'gunicorn':
+    start_background_tasks()
+
+
+
+def idempotent(view):
+    """Run the view at most once per Idempotency-Key and replay its response for repeats."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+
+        def run():
+            response = app.make_response(view(*args, **kwargs))
+            return response.status_code, response.get_data(as_text=True), response.mimetype
+
+        try:
+            (status, body, mimetype), replayed = idempotency_store.execute(request.path, key, request.get_data(), run)
+        except IdempotencyKeyInvalid as e:
+            return jsonify({"error": str(e)}), 400
+        except IdempotencyConflict as e:
+            return jsonify({"error": str(e)}), 422
+        except IdempotencyInProgress as e:
+            return jsonify({"error": str(e)}), 409
+
+        response = app.response_class(body, status=status, mimetype=mimetype)
+        if replayed:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    return wrapper
+
+def relay(response):
+    """The upstream reply as the client's response, without decoding and re-encoding the body."""
+    if not UPSTREAM_PASSTHROUGH:
+        return jsonify(fast_json.parse_response(response)), response.status_code
+    return app.response_class(response.content, status=response.status_code, headers=relay_headers(response))
+
+# Every log line written while handling the request carries its ID, and the caller gets it back
+@app.before_request
+def request_id():
+    g.request_id = new_request_id(request.headers.get(REQUEST_ID_HEADER))
+
+@app.after_request
+def request_id_header(response):
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
+# One server span per request, continuing the caller's trace when it sent a traceparent
+@app.before_request
+def start_trace():
+    g.span = tracing.start_request(request.path, request.headers.get(TRACEPARENT_HEADER), method=request.method)
+
+@app.after_request
+def finish_trace(response):
+    span = g.pop('span', None)
+    if span is not None:
+        tracing.finish_request(span, response.status_code)
+    return response
+
+@app.teardown_request
+def finish_failed_trace(error=None):
+    # after_request is skipped when the view raised
+    span = g.pop('span', None)
+    if span is not None:
+        tracing.finish_request(span, 500, error)
+
+@app.before_request
+def rate_limit():
+    # Buckets are per route template, so every /api/saga/<transaction_id> poll shares one; a path
+    # no route matched gets its 404 or 405 without upstream work and is not limited
+    if request.url_rule is None:
+        return None
+    data = request.get_json(silent=True)
+    user_id = data.get('userId') if isinstance(data, dict) else None
+    client = rate_limiter.client_key(user_id, request.remote_addr, request.headers.get('X-Forwarded-For'))
+    decision = rate_limiter.check(request.url_rule.rule, client)
+    if decision is None:
+        return None
+    g.rate_limit = decision
+    if not decision.allowed:
+        return jsonify({"error": "Rate limit exceeded"}), 429
+
+@app.after_request
+def rate_limit_headers(response):
+    decision = g.get('rate_limit')
+    if decision is not None:
+        response.headers.update(decision.headers())
+    return response
+
+# Shed requests get their status and a Retry-After instead of waiting on a saturated upstream
+@app.errorhandler(ConcurrencyLimitExceeded)
+def concurrency_limit_exceeded(e):
+    return jsonify({"error": str(e)}), e.status_code, {'Retry-After': str(e.retry_after)}
+
+def send(route, payload):
+    """The route's upstream call for a validated payload."""
+    def call():
+        return call_service_with_retry(route.endpoint, payload, route.service_type)
+
+    if route.reads_payment_status:
+        # Concurrent polls for the same ride share one upstream call
+        return payment_status_cache.lookup(payload['rideId'], call)
+    response = call()
+    if route.invalidates_payment_status and response.status_code < 400:
+        payment_status_cache.invalidate(payload['rideId'])
+    return response
+
+def proxy_view(route):
+    """View for a route in ROUTES: validate the body, call the upstream and relay its reply."""
+    errors = Exception if route.any_error_unavailable else UPSTREAM_ERRORS
+
+    def view():
+        try:
+            payload = route.validate(request.json)
+        except RequestInvalid as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            response = send(route, payload)
+        except ConcurrencyLimitExceeded:
+            raise
+        except errors as e:
+            return jsonify({"error": str(e)}), 503
+        if route.reads_payment_status and response.status_code == 404:
+            return jsonify({'rideId': payload['rideId'], 'status': 'orderNotPaid'}), 200
+        return relay(response)
+
+    return view
+
+def batch_view(route):
+    """View for the route's batch form: {batch_key: [body, ...]} -> per-item results."""
+    errors = Exception if route.any_error_unavailable else UPSTREAM_ERRORS
+
+    # One item, same checks as the single route; returns (body, status_code)
+    def handle(data):
+        try:
+            payload = route.validate(data)
+        except RequestInvalid as e:
+            return {"error": str(e)}, 400
+        try:
+            response = send(route, payload)
+        except ConcurrencyLimitExceeded:
+            raise
+        except errors as e:
+            return {"error": str(e)}, 503
+        return fast_json.embed(response), response.status_code
+
+    def view():
+        data = request.json
+        items = data.get(route.batch_key) if isinstance(data, dict) else None
+        try:
+            body, status_code = batch_executor.run(request.path, items, handle)
+        except BatchError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(body), status_code
+
+    return view
+
+# Proxied routes, see routes.py
+for route in ROUTES:
+    view = proxy_view(route)
+    app.add_url_rule(route.path, route.name, idempotent(view) if route.idempotent else view, methods=['POST'])
+    if route.batch_path:
+        view = batch_view(route)
+        app.add_url_rule(route.batch_path, route.batch_name, idempotent(view) if route.idempotent else view,
+                         methods=['POST'])
     
 @app.route('/api/saga', methods=['POST'])
 def execute_saga():
     data = request.json
     transaction_id = data.get('transactionId')
-    steps = data.get('steps')  # Steps define the saga flow
+    steps = data.get('steps')  # Steps define the saga flow, optionally as a DAG via dependsOn
 
     if not transaction_id or not steps:
         return jsonify({"status": "failed", "reason": "Missing required fields"}), 400
 
-    # Results to track success and failures
-    results = {}
-    compensations = []
-
     try:
-        for step in steps:
-            # Forward action
-            service_url = step['forward']['url']
-            payload = step['forward']['payload']
-
-            print(f"Executing forward action for {step['name']} at {service_url}")
-            response = requests.post(service_url, json=payload)
-
-            # Include operation in the response for clarity
-            step_result = response.json()
-            step_result['operation'] = 'forward'
-            results[step['name']] = step_result
-
-            if response.status_code != 200 or step_result.get('status') != 'success':
-                raise Exception(f"Step {step['name']} failed")
-
-            # Add compensating action to the stack
-            compensations.append(step['compensate'])
-
-    except Exception as e:
-        # Track compensations that were executed
-        compensation_results = {}
-
-        # Execute compensating actions on failure
-        for compensation in reversed(compensations):
-            try:
-                print(f"Executing compensate action for {compensation['url']}")
-                comp_response = requests.post(compensation['url'], json=compensation['payload'])
-                compensation_results[compensation['url']] = {
-                    "status": "compensated",
-                    "operation": "compensate",
-                    "message": f"Compensate operation completed for transaction {compensation['payload']['transactionId']}"
-                }
-            except Exception as rollback_error:
-                print(f"Compensation failed: {rollback_error}")
-                compensation_results[compensation['url']] = {
-                    "status": "failed",
-                    "operation": "compensate",
-                    "reason": str(rollback_error)
-                }
-
-        # Return failure status with details of compensations
-        return jsonify({
-            "status": "failed",
-            "reason": str(e),
-            "results": results,
-            "compensations": compensation_results
-        }), 500
-
-    return jsonify({"status": "completed", "results": results}), 200
-
-
-
-# Endpoint to check payment status
-@app.route('/api/user/check_payment_status', methods=['POST'])
-def check_payment_status():
-    data = request.json
-    ride_id = data.get('rideId')
-
-    if not ride_id:
-        return jsonify({"error": "Missing required fields"}), 400
-
-    payload = {
-        "rideId": ride_id
-    }
+        run = SagaRun(transaction_id, parse_steps(steps), saga_deadline(data.get('deadline')))
+    except SagaDefinitionError as e:
+        return jsonify({"status": "failed", "reason": str(e)}), 400
 
     try:
-        response = call_user_location_service('payment_check', payload)
-        if response.status_code == 404:
-            return jsonify({
-                'rideId': ride_id,
-                'status': 'orderNotPaid'
-            }), 200
-        else:
-            return jsonify(response.json()), response.status_code
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 503
+        if 'respond-async' in request.headers.get('Prefer', ''):
+            # Long sagas run in the background; the client polls the Location
+            saga_orchestrator.submit(run)
+            response = jsonify({"status": "running", "transactionId": transaction_id})
+            response.headers['Location'] = f"/api/saga/{transaction_id}"
+            return response, 202
+        body, status_code = saga_orchestrator.run(run)
+    except SagaExists as e:
+        return jsonify({"status": "failed", "reason": str(e)}), 409
+    return jsonify(body), status_code
+
+
+@app.route('/api/saga/<transaction_id>', methods=['GET'])
+def saga_status(transaction_id):
+    body = saga_orchestrator.status(transaction_id)
+    if body is None:
+        return jsonify({"error": "Saga not found"}), 404
+    return jsonify(body), 200
+
+
+# Recent spans of this process with TRACE_EXPORTER=memory, newest first; ?traceId= for one trace
+@app.route('/traces', methods=['GET'])
+def traces():
+    spans = tracing.recent_spans(request.args.get('traceId'), request.args.get('limit', 100, type=int))
+    if spans is None:
+        return jsonify({"error": "Spans are only kept with TRACE_EXPORTER=memory"}), 404
+    return jsonify({"spans": spans}), 200
 
 @app.route('/status', methods=['GET'])
 def status():
@@ -0,0 +1,391 @@
+# api-gateway/async_app.py
+#
+# asyncio serving mode: the same routes as app.py, but every upstream call is awaited
+# so one process can hold thousands of in-flight rides instead of one per thread.
+
+import asyncio
+import functools
+import time
+
+import aiohttp
+from aiohttp import web
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+
+from upstream import (
+    async_upstream_pools, async_grpc_channels, hedge_policy, balancer, circuit_breakers, retry_policy,
+    discovery, payment_status_cache, idempotency_store, saga_orchestrator, batch_executor, concurrency_limiter,
+    rate_limiter, call_service_with_retry_async,
+)
+from concurrency_limit import ConcurrencyLimitExceeded
+from retry_policy import RetriesExhaustedError
+from rate_limit import route_template
+from batch import BatchError
+from routes import ROUTES, RequestInvalid
+from saga import SagaRun, SagaDefinitionError, parse_steps, saga_deadline
+from saga_log import SagaExists
+from idempotency import IdempotencyKeyInvalid, IdempotencyConflict, IdempotencyInProgress
+import fast_json
+from fast_json import UPSTREAM_PASSTHROUGH, relay_headers
+import multiprocess_metrics
+from multiprocess_metrics import MULTIPROCESS
+import structured_log
+from structured_log import configure_logging, fields, get_logger, new_request_id, REQUEST_ID_HEADER
+import tracing
+from tracing import TRACEPARENT_HEADER
+
+# Same series the Flask exporter publishes in sync mode, so dashboards work in either mode
+APP_INFO = Gauge('app_info', 'API Gateway Information', ['version'], multiprocess_mode='livemax')
+APP_INFO.labels(version='1.0.0').set(1)
+
+HTTP_REQUEST_DURATION = Histogram(
+    'flask_http_request_duration_seconds',
+    'Flask HTTP request duration in seconds',
+    ['method', 'path', 'status']
+)
+HTTP_REQUEST_TOTAL = Counter('flask_http_request_total', 'Total number of HTTP requests', ['method', 'status'])
+HTTP_REQUEST_EXCEPTIONS = Counter(
+    'flask_http_request_exceptions_total',
+    'Total number of HTTP requests which resulted in an exception',
+    ['method', 'status']
+)
+
+REQUEST_COUNT = Counter(
+    'api_gateway_request_count_total',
+    'Total Request Count',
+    ['method', 'endpoint', 'http_status']
+)
+
+REQUEST_LATENCY = Histogram(
+    'api_gateway_request_latency_seconds',
+    'Request latency',
+    ['endpoint'],
+    buckets=(0.1, 0.5, 1, 2, 5)
+)
+
+configure_logging()
+structured_log.register_metrics(REGISTRY)
+tracing.register_metrics(REGISTRY)
+async_upstream_pools.register_metrics(REGISTRY)
+hedge_policy.register_metrics(REGISTRY)
+balancer.register_metrics(REGISTRY)
+circuit_breakers.register_metrics(REGISTRY)
+retry_policy.register_metrics(REGISTRY)
+discovery.register_metrics(REGISTRY)
+payment_status_cache.register_metrics(REGISTRY)
+idempotency_store.register_metrics(REGISTRY)
+saga_orchestrator.register_metrics(REGISTRY)
+batch_executor.register_metrics(REGISTRY)
+concurrency_limiter.register_metrics(REGISTRY)
+rate_limiter.register_metrics(REGISTRY)
+
+# Upstream failures a route answers with 503; the deadline or retry budget running out is one
+UPSTREAM_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, RetriesExhaustedError)
+
+log = get_logger('async_app')
+
+
+# Every log line written while handling the request carries its ID, and the caller gets it back.
+# Each request runs in its own task, so the ID set here does not leak between requests.
+@web.middleware
+async def request_id_middleware(request, handler):
+    rid = new_request_id(request.headers.get(REQUEST_ID_HEADER))
+    response = await handler(request)
+    response.headers[REQUEST_ID_HEADER] = rid
+    return response
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    if request.path == '/metrics':
+        return await handler(request)
+
+    start = time.perf_counter()
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        response = e
+    except Exception:
+        log.exception("Unhandled error", extra=fields(path=request.path))
+        HTTP_REQUEST_EXCEPTIONS.labels(method=request.method, status=500).inc()
+        response = web.Response(status=500, text='Internal Server Error')
+
+    elapsed = time.perf_counter() - start
+    HTTP_REQUEST_DURATION.labels(method=request.method, path=request.path, status=response.status).observe(elapsed)
+    HTTP_REQUEST_TOTAL.labels(method=request.method, status=response.status).inc()
+    REQUEST_COUNT.labels(method=request.method, endpoint=request.path, http_status=response.status).inc()
+    REQUEST_LATENCY.labels(endpoint=request.path).observe(elapsed)
+    return response
+
+
+# One server span per request, continuing the caller's trace when it sent a traceparent
+@web.middleware
+async def tracing_middleware(request, handler):
+    span = tracing.start_request(request.path, request.headers.get(TRACEPARENT_HEADER), method=request.method)
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        tracing.finish_request(span, e.status)
+        raise
+    except Exception as e:
+        tracing.finish_request(span, 500, e)
+        raise
+    tracing.finish_request(span, response.status)
+    return response
+
+
+@web.middleware
+async def rate_limit_middleware(request, handler):
+    # Buckets are per route template, so every /api/saga/{transaction_id} poll shares one; a path
+    # no route matched gets its 404 or 405 without upstream work and is not limited
+    resource = request.match_info.route.resource
+    route = route_template(resource.canonical) if resource is not None else None
+    if route is None or rate_limiter.limit_for(route) is None:
+        return await handler(request)
+
+    user_id = None
+    if request.content_type == 'application/json':
+        try:
+            # The body is cached, so the handler's read_json does not read it again
+            data = await request.json(loads=fast_json.loads)
+            user_id = data.get('userId') if isinstance(data, dict) else None
+        except ValueError:
+            pass
+    client = rate_limiter.client_key(user_id, request.remote, request.headers.get('X-Forwarded-For'))
+    decision = rate_limiter.check(route, client)
+    if decision is None:
+        return await handler(request)
+    if not decision.allowed:
+        return web.json_response({"error": "Rate limit exceeded"}, status=429, headers=decision.headers())
+    response = await handler(request)
+    response.headers.update(decision.headers())
+    return response
+
+
+# Shed requests get their status and a Retry-After instead of waiting on a saturated upstream
+@web.middleware
+async def load_shedding_middleware(request, handler):
+    try:
+        return await handler(request)
+    except ConcurrencyLimitExceeded as e:
+        return web.json_response({"error": str(e)}, status=e.status_code,
+                                 headers={'Retry-After': str(e.retry_after)})
+
+
+def jsonify(data, status=200):
+    return web.Response(body=fast_json.dumps(data), status=status, content_type='application/json')
+
+
+def relay(response):
+    """The upstream reply as the client's response, without decoding and re-encoding the body."""
+    if not UPSTREAM_PASSTHROUGH:
+        return jsonify(fast_json.parse_response(response), response.status_code)
+    return web.Response(body=response.content, status=response.status_code, headers=relay_headers(response))
+
+
+async def read_json(request):
+    try:
+        data = await request.json(loads=fast_json.loads)
+    except ValueError:
+        raise web.HTTPBadRequest(text='Failed to decode JSON object')
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest(text='Expected a JSON object')
+    return data
+
+
+def idempotent(handler):
+    """Run the handler at most once per Idempotency-Key and replay its response for repeats."""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return await handler(request)
+
+        async def run():
+            response = await handler(request)
+            return response.status, response.text, response.content_type
+
+        try:
+            (status, body, content_type), replayed = await idempotency_store.execute_async(
+                request.path, key, await request.read(), run)
+        except IdempotencyKeyInvalid as e:
+            return jsonify({"error": str(e)}, 400)
+        except IdempotencyConflict as e:
+            return jsonify({"error": str(e)}, 422)
+        except IdempotencyInProgress as e:
+            return jsonify({"error": str(e)}, 409)
+
+        response = web.Response(text=body, status=status, content_type=content_type)
+        if replayed:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    return wrapper
+
+
+async def send(route, payload):
+    """The route's upstream call for a validated payload."""
+    def call():
+        return call_service_with_retry_async(route.endpoint, payload, route.service_type)
+
+    if route.reads_payment_status:
+        # Concurrent polls for the same ride share one upstream call
+        return await payment_status_cache.lookup_async(payload['rideId'], call)
+    response = await call()
+    if route.invalidates_payment_status and response.status_code < 400:
+        payment_status_cache.invalidate(payload['rideId'])
+    return response
+
+
+def proxy_handler(route):
+    """Handler for a route in ROUTES: validate the body, call the upstream and relay its reply."""
+    errors = Exception if route.any_error_unavailable else UPSTREAM_ERRORS
+
+    async def handler(request):
+        try:
+            payload = route.validate(await read_json(request))
+        except RequestInvalid as e:
+            return jsonify({"error": str(e)}, 400)
+        try:
+            response = await send(route, payload)
+        except ConcurrencyLimitExceeded:
+            raise
+        except errors as e:
+            return jsonify({"error": str(e)}, 503)
+        if route.reads_payment_status and response.status_code == 404:
+            return jsonify({'rideId': payload['rideId'], 'status': 'orderNotPaid'}, 200)
+        return relay(response)
+
+    return idempotent(handler) if route.idempotent else handler
+
+
+def batch_handler(route):
+    """Handler for the route's batch form: {batch_key: [body, ...]} -> per-item results."""
+    errors = Exception if route.any_error_unavailable else UPSTREAM_ERRORS
+
+    # One item, same checks as the single route; returns (body, status_code)
+    async def handle(data):
+        try:
+            payload = route.validate(data)
+        except RequestInvalid as e:
+            return {"error": str(e)}, 400
+        try:
+            response = await send(route, payload)
+        except ConcurrencyLimitExceeded:
+            raise
+        except errors as e:
+            return {"error": str(e)}, 503
+        return fast_json.embed(response), response.status_code
+
+    async def handler(request):
+        data = await read_json(request)
+        try:
+            body, status_code = await batch_executor.run_async(request.path, data.get(route.batch_key), handle)
+        except BatchError as e:
+            return jsonify({"error": str(e)}, 400)
+        return jsonify(body, status_code)
+
+    return idempotent(handler) if route.idempotent else handler
+
+
+async def execute_saga(request):
+    data = await read_json(request)
+    transaction_id = data.get('transactionId')
+    steps = data.get('steps')  # Steps define the saga flow, optionally as a DAG via dependsOn
+
+    if not transaction_id or not steps:
+        return jsonify({"status": "failed", "reason": "Missing required fields"}, 400)
+
+    try:
+        run = SagaRun(transaction_id, parse_steps(steps), saga_deadline(data.get('deadline')))
+    except SagaDefinitionError as e:
+        return jsonify({"status": "failed", "reason": str(e)}, 400)
+
+    try:
+        if 'respond-async' in request.headers.get('Prefer', ''):
+            saga_orchestrator.submit_async(run)
+            response = jsonify({"status": "running", "transactionId": transaction_id}, 202)
+            response.headers['Location'] = f"/api/saga/{transaction_id}"
+            return response
+        body, status_code = await saga_orchestrator.run_async(run)
+    except SagaExists as e:
+        return jsonify({"status": "failed", "reason": str(e)}, 409)
+    return jsonify(body, status_code)
+
+
+async def saga_status(request):
+    body = saga_orchestrator.status(request.match_info['transaction_id'])
+    if body is None:
+        return jsonify({"error": "Saga not found"}, 404)
+    return jsonify(body, 200)
+
+
+# Recent spans of this process with TRACE_EXPORTER=memory, newest first; ?traceId= for one trace
+async def traces(request):
+    try:
+        limit = int(request.query.get('limit', 100))
+    except ValueError:
+        limit = 100
+    spans = tracing.recent_spans(request.query.get('traceId'), limit)
+    if spans is None:
+        return jsonify({"error": "Spans are only kept with TRACE_EXPORTER=memory"}, 404)
+    return jsonify({"spans": spans}, 200)
+
+
+async def status(request):
+    return jsonify({"status": "API Gateway is running"}, 200)
+
+
+async def metrics_endpoint(request):
+    # Under several gunicorn workers every worker's samples are read from PROMETHEUS_MULTIPROC_DIR
+    registry = multiprocess_metrics.collector_registry() if MULTIPROCESS else REGISTRY
+    return web.Response(body=generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+# Started per worker on startup rather than at import, so a gunicorn master that preloads the
+# module does not start threads that would not survive the fork
+async def start_background_tasks(app):
+    discovery.start()
+    rate_limiter.start()
+    multiprocess_metrics.start_refresher()
+    app['saga_recovery'] = asyncio.ensure_future(saga_orchestrator.recovery_loop_async())
+
+
+async def stop_saga_recovery(app):
+    app['saga_recovery'].cancel()
+
+
+async def close_upstream_pools(app):
+    await async_upstream_pools.close()
+    await async_grpc_channels.close()
+
+
+def create_app():
+    app = web.Application(middlewares=[request_id_middleware, metrics_middleware, tracing_middleware,
+                                       rate_limit_middleware, load_shedding_middleware])
+    # Proxied routes, see routes.py
+    for route in ROUTES:
+        app.router.add_post(route.path, proxy_handler(route))
+        if route.batch_path:
+            app.router.add_post(route.batch_path, batch_handler(route))
+    app.router.add_post('/api/saga', execute_saga)
+    app.router.add_get('/api/saga/{transaction_id}', saga_status)
+    app.router.add_get('/traces', traces)
+    app.router.add_get('/status', status)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.on_startup.append(start_background_tasks)
+    app.on_cleanup.append(stop_saga_recovery)
+    app.on_cleanup.append(close_upstream_pools)
+    return app
+
+
+async def gunicorn_app():
+    """App factory for aiohttp.GunicornWebWorker, see gunicorn.conf.py."""
+    return create_app()
+
+
+def main(host='0.0.0.0', port=5000):
+    web.run_app(create_app(), host=host, port=port)
+
+
+if __name__ == '__main__':
+    main()
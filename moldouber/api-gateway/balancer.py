@@ -0,0 +1,155 @@
+# api-gateway/balancer.py
+#
+# Pluggable upstream instance selection. Every balancer keeps the same per-instance
+# state (in-flight count, peak EWMA latency) and only differs in how it orders instances.
+
+import itertools
+import math
+import os
+import random
+import threading
+import time
+
+from prometheus_client import Counter, Gauge
+
+from multiprocess_metrics import set_function
+
+LOAD_BALANCER = os.environ.get('LOAD_BALANCER', 'peak_ewma')
+# Decay time constant of the latency EWMA
+EWMA_DECAY_SECONDS = float(os.environ.get('LOAD_BALANCER_EWMA_DECAY', 10))
+
+
+class InstanceState:
+
+    def __init__(self, decay=EWMA_DECAY_SECONDS):
+        self.decay = decay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.ewma = 0.0
+        self.last_update = time.monotonic()
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish(self, latency):
+        with self.lock:
+            self.in_flight -= 1
+            if latency is None:
+                return
+            now = time.monotonic()
+            if latency > self.ewma:
+                # Peak sensitivity: jump straight up, decay back down slowly
+                self.ewma = latency
+            else:
+                weight = math.exp(-(now - self.last_update) / self.decay)
+                self.ewma = self.ewma * weight + latency * (1 - weight)
+            self.last_update = now
+
+    def cost(self):
+        return self.ewma * (self.in_flight + 1)
+
+
+class Balancer:
+    """Base class: subclasses implement order(); state tracking and metrics are shared."""
+
+    name = None
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+        self.selections = Counter('api_gateway_balancer_selections_total', 'Upstream attempts routed to each instance',
+                                  ['service', 'instance'], registry=None)
+        # Each worker process balances on its own latency view, so those are reported per process
+        self.ewma_latency = Gauge('api_gateway_balancer_ewma_latency_seconds', 'Peak EWMA latency per instance',
+                                  ['service', 'instance'], registry=None, multiprocess_mode='liveall')
+        self.in_flight = Gauge('api_gateway_balancer_in_flight', 'Outstanding upstream attempts per instance',
+                               ['service', 'instance'], registry=None, multiprocess_mode='livesum')
+
+    def register_metrics(self, registry):
+        registry.register(self.selections)
+        registry.register(self.ewma_latency)
+        registry.register(self.in_flight)
+
+    def state(self, service_type, host):
+        key = (service_type, host)
+        state = self.states.get(key)
+        if state is None:
+            with self.lock:
+                state = self.states.get(key)
+                if state is None:
+                    state = InstanceState()
+                    self.states[key] = state
+                    set_function(self.ewma_latency.labels(service=service_type, instance=host), lambda: state.ewma)
+                    set_function(self.in_flight.labels(service=service_type, instance=host), lambda: state.in_flight)
+        return state
+
+    def begin(self, service_type, host):
+        self.selections.labels(service=service_type, instance=host).inc()
+        state = self.state(service_type, host)
+        state.begin()
+        return time.monotonic()
+
+    def finish(self, service_type, host, started, ok=True):
+        # Failed attempts release their slot but do not feed the latency average
+        latency = time.monotonic() - started if ok else None
+        self.state(service_type, host).finish(latency)
+
+    def order(self, service_type, instances):
+        """Return instances, a list of (instance_index, host), in preferred order."""
+        raise NotImplementedError
+
+
+class RoundRobinBalancer(Balancer):
+
+    name = 'round_robin'
+
+    def __init__(self):
+        super().__init__()
+        self.counters = {}
+
+    def order(self, service_type, instances):
+        if not instances:
+            return instances
+        counter = self.counters.get(service_type)
+        if counter is None:
+            with self.lock:
+                counter = self.counters.setdefault(service_type, itertools.count())
+        # itertools.count is atomic under the GIL, no lock on the hot path
+        start = next(counter) % len(instances)
+        return instances[start:] + instances[:start]
+
+
+class LeastOutstandingBalancer(Balancer):
+
+    name = 'least_outstanding'
+
+    def order(self, service_type, instances):
+        # Shuffle first so ties do not always land on instance 0
+        shuffled = random.sample(instances, len(instances))
+        return sorted(shuffled, key=lambda instance: self.state(service_type, instance[1]).in_flight)
+
+
+class PeakEwmaBalancer(Balancer):
+    """Power of two choices on peak-EWMA latency weighted by outstanding requests."""
+
+    name = 'peak_ewma'
+
+    def order(self, service_type, instances):
+        if len(instances) < 2:
+            return instances
+        first, second = random.sample(instances, 2)
+        if self.state(service_type, second[1]).cost() < self.state(service_type, first[1]).cost():
+            first, second = second, first
+        rest = [instance for instance in instances if instance is not first and instance is not second]
+        rest.sort(key=lambda instance: self.state(service_type, instance[1]).cost())
+        return [first, second] + rest
+
+
+BALANCERS = {cls.name: cls for cls in (RoundRobinBalancer, LeastOutstandingBalancer, PeakEwmaBalancer)}
+
+
+def create_balancer(name=LOAD_BALANCER):
+    if name not in BALANCERS:
+        raise ValueError(f"Unknown load balancer: {name}")
+    return BALANCERS[name]()
@@ -0,0 +1,108 @@
+# api-gateway/batch.py
+#
+# Fan-out for the batch routes (/api/user/accept_orders, /api/ride/process_payments). Each
+# item goes through the same handler code as its single-item route, at most
+# BATCH_CONCURRENCY items of one batch in flight at once, and the reply lists every item's
+# own status and body in request order.
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from prometheus_client import Counter, Histogram
+
+from concurrency_limit import ConcurrencyLimitExceeded
+from structured_log import submit_in_context
+
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1000))
+# Items of one batch in flight at once
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 16))
+# Item calls in flight across all batches in sync mode
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 64))
+
+
+class BatchError(ValueError):
+    """The batch itself is malformed: not a list, empty, or over BATCH_MAX_ITEMS."""
+
+
+class BatchExecutor:
+
+    def __init__(self, max_items=BATCH_MAX_ITEMS, concurrency=BATCH_CONCURRENCY, workers=BATCH_WORKERS):
+        self.max_items = max_items
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch-item')
+        self.batch_size = Histogram('api_gateway_batch_size', 'Items per batch request', ['route'],
+                                    buckets=(1, 10, 50, 100, 250, 500, 1000), registry=None)
+        self.items = Counter('api_gateway_batch_items_total', 'Batch items processed, by outcome',
+                             ['route', 'outcome'], registry=None)
+
+    def register_metrics(self, registry):
+        registry.register(self.batch_size)
+        registry.register(self.items)
+
+    def validate(self, route, items):
+        if not isinstance(items, list) or not items:
+            raise BatchError("Expected a non-empty list of items")
+        if len(items) > self.max_items:
+            raise BatchError(f"A batch may hold at most {self.max_items} items")
+        self.batch_size.labels(route=route).observe(len(items))
+
+    def _result(self, route, position, body, status_code):
+        self.items.labels(route=route, outcome='success' if status_code < 400 else 'failed').inc()
+        return {"position": position, "status": status_code, "body": body}
+
+    def response(self, results):
+        """Response body and status: 200 if every item succeeded, 207 otherwise."""
+        failed = sum(1 for result in results if result['status'] >= 400)
+        body = {"results": results, "succeeded": len(results) - failed, "failed": failed}
+        return body, 200 if not failed else 207
+
+    @staticmethod
+    def _call(handle, item):
+        if not isinstance(item, dict):
+            return {"error": "Expected a JSON object"}, 400
+        try:
+            return handle(item)
+        except ConcurrencyLimitExceeded as e:
+            return {"error": str(e), "retryAfter": e.retry_after}, e.status_code
+        except Exception as e:
+            return {"error": str(e)}, 500
+
+    def run(self, route, items, handle):
+        """Call handle(item) -> (body, status_code) for every item and return the response."""
+        self.validate(route, items)
+        results = [None] * len(items)
+        pending = iter(enumerate(items))
+        in_flight = {}
+        while True:
+            for position, item in pending:
+                in_flight[submit_in_context(self.executor, self._call, handle, item)] = position
+                if len(in_flight) >= self.concurrency:
+                    break
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                position = in_flight.pop(future)
+                results[position] = self._result(route, position, *future.result())
+        return self.response(results)
+
+    async def run_async(self, route, items, handle):
+        self.validate(route, items)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def call(position, item):
+            async with semaphore:
+                if not isinstance(item, dict):
+                    body, status_code = {"error": "Expected a JSON object"}, 400
+                else:
+                    try:
+                        body, status_code = await handle(item)
+                    except ConcurrencyLimitExceeded as e:
+                        body, status_code = {"error": str(e), "retryAfter": e.retry_after}, e.status_code
+                    except Exception as e:
+                        body, status_code = {"error": str(e)}, 500
+            return self._result(route, position, body, status_code)
+
+        results = await asyncio.gather(*(call(position, item) for position, item in enumerate(items)))
+        return self.response(list(results))
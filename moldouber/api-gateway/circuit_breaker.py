@@ -0,0 +1,189 @@
+# api-gateway/circuit_breaker.py
+#
+# Per-instance closed/open/half-open circuit breakers. Each instance has its own lock and
+# a rolling window of time buckets, so requests to different instances never contend.
+
+import logging
+import os
+import threading
+import time
+
+from prometheus_client import Counter, Gauge
+
+from multiprocess_metrics import set_function
+from structured_log import get_logger, fields
+
+log = get_logger('circuit_breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+BREAKER_WINDOW_SECONDS = float(os.environ.get('BREAKER_WINDOW_SECONDS', 10))
+BREAKER_BUCKETS = int(os.environ.get('BREAKER_BUCKETS', 10))
+# Rates are only evaluated once the window holds this many calls
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 5))
+BREAKER_FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', 0.5))
+BREAKER_SLOW_CALL_RATE = float(os.environ.get('BREAKER_SLOW_CALL_RATE', 0.8))
+BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('BREAKER_SLOW_CALL_SECONDS', 5))
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 60))
+BREAKER_HALF_OPEN_CALLS = int(os.environ.get('BREAKER_HALF_OPEN_CALLS', 3))
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is attempted on an instance whose circuit does not admit it."""
+
+
+class InstanceBreaker:
+
+    def __init__(self, on_transition=None, window_seconds=BREAKER_WINDOW_SECONDS, buckets=BREAKER_BUCKETS,
+                 min_calls=BREAKER_MIN_CALLS, failure_rate=BREAKER_FAILURE_RATE,
+                 slow_call_rate=BREAKER_SLOW_CALL_RATE, slow_call_seconds=BREAKER_SLOW_CALL_SECONDS,
+                 open_seconds=BREAKER_OPEN_SECONDS, half_open_calls=BREAKER_HALF_OPEN_CALLS):
+        self.on_transition = on_transition
+        self.bucket_seconds = window_seconds / buckets
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # Ring of [bucket_id, calls, failures, slow_calls]
+        self.buckets = [[-1, 0, 0, 0] for _ in range(buckets)]
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+
+    def _transition(self, new_state, now):
+        old_state = self.state
+        self.state = new_state
+        if new_state == OPEN:
+            self.opened_at = now
+        if new_state != CLOSED:
+            self.probes_in_flight = 0
+            self.probe_successes = 0
+        if new_state == CLOSED:
+            for bucket in self.buckets:
+                bucket[0] = -1
+        if self.on_transition is not None:
+            self.on_transition(old_state, new_state)
+
+    def _bucket(self, now):
+        bucket_id = int(now / self.bucket_seconds)
+        bucket = self.buckets[bucket_id % len(self.buckets)]
+        if bucket[0] != bucket_id:
+            bucket[0], bucket[1], bucket[2], bucket[3] = bucket_id, 0, 0, 0
+        return bucket
+
+    def _window_totals(self, now):
+        oldest = int(now / self.bucket_seconds) - len(self.buckets) + 1
+        calls = failures = slow = 0
+        for bucket_id, bucket_calls, bucket_failures, bucket_slow in self.buckets:
+            if bucket_id >= oldest:
+                calls += bucket_calls
+                failures += bucket_failures
+                slow += bucket_slow
+        return calls, failures, slow
+
+    def is_available(self):
+        """Whether allow_request() would currently admit a call, without claiming a probe slot."""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return time.monotonic() - self.opened_at >= self.open_seconds
+        return self.probes_in_flight + self.probe_successes < self.half_open_calls
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self.opened_at < self.open_seconds:
+                    return False
+                self._transition(HALF_OPEN, now)
+            if self.probes_in_flight + self.probe_successes >= self.half_open_calls:
+                return False
+            self.probes_in_flight += 1
+            return True
+
+    def release(self):
+        """Give back an admitted call that ended without an outcome, such as a cancelled hedge."""
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+
+    def record(self, ok, duration):
+        now = time.monotonic()
+        slow = duration >= self.slow_call_seconds
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+                if not ok or slow:
+                    self._transition(OPEN, now)
+                else:
+                    self.probe_successes += 1
+                    if self.probe_successes >= self.half_open_calls:
+                        self._transition(CLOSED, now)
+                return
+            if self.state == OPEN:
+                # Late result from a call admitted before the circuit opened
+                return
+
+            bucket = self._bucket(now)
+            bucket[1] += 1
+            if not ok:
+                bucket[2] += 1
+            if slow:
+                bucket[3] += 1
+
+            calls, failures, slow_calls = self._window_totals(now)
+            if calls >= self.min_calls and (failures / calls >= self.failure_rate
+                                            or slow_calls / calls >= self.slow_call_rate):
+                self._transition(OPEN, now)
+
+
+class CircuitBreakers:
+    """Lazily created breaker per (service_type, host), with Prometheus state export."""
+
+    def __init__(self, **breaker_options):
+        self.breaker_options = breaker_options
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.state_gauge = Gauge('api_gateway_circuit_breaker_state',
+                                 'Circuit state per instance (0 closed, 1 open, 2 half-open)',
+                                 ['service', 'instance'], registry=None, multiprocess_mode='liveall')
+        self.transitions = Counter('api_gateway_circuit_breaker_transitions_total',
+                                   'Circuit breaker state transitions per instance',
+                                   ['service', 'instance', 'from_state', 'to_state'], registry=None)
+
+    def register_metrics(self, registry):
+        registry.register(self.state_gauge)
+        registry.register(self.transitions)
+
+    def get(self, service_type, host):
+        key = (service_type, host)
+        breaker = self.breakers.get(key)
+        if breaker is not None:
+            return breaker
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                def on_transition(old_state, new_state):
+                    self.transitions.labels(service=service_type, instance=host,
+                                            from_state=old_state, to_state=new_state).inc()
+                    level = logging.INFO if new_state == CLOSED else logging.WARNING
+                    log.log(level, "Circuit moved from %s to %s.", old_state, new_state,
+                            extra=fields(service=service_type, instance=host))
+
+                breaker = InstanceBreaker(on_transition=on_transition, **self.breaker_options)
+                self.breakers[key] = breaker
+                set_function(self.state_gauge.labels(service=service_type, instance=host),
+                             lambda: STATE_VALUES[breaker.state])
+        return breaker
@@ -0,0 +1,156 @@
+# api-gateway/concurrency_limit.py
+#
+# Adaptive per-service concurrency limits. Each upstream service type gets a limit on calls in
+# flight that follows a gradient of its observed latency: while latency stays near its
+# long-term average the limit grows, and when latency rises (the upstream is queueing) or calls
+# fail, the limit shrinks. Calls over the limit are rejected at once instead of piling up.
+#
+# Priority classes may use different shares of the limit, so under load status polling is shed
+# first, then ordinary order traffic, and payments last.
+
+import math
+import os
+import threading
+import time
+
+from prometheus_client import Counter, Gauge
+
+ADAPTIVE_CONCURRENCY = os.environ.get('ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+# Starts at the connections two instances' pools hold (UPSTREAM_POOL_SIZE each)
+CONCURRENCY_INITIAL_LIMIT = float(os.environ.get('CONCURRENCY_INITIAL_LIMIT', 40))
+CONCURRENCY_MIN_LIMIT = float(os.environ.get('CONCURRENCY_MIN_LIMIT', 8))
+CONCURRENCY_MAX_LIMIT = float(os.environ.get('CONCURRENCY_MAX_LIMIT', 200))
+# Latency may rise this much over the long-term average before the limit starts shrinking
+CONCURRENCY_TOLERANCE = float(os.environ.get('CONCURRENCY_TOLERANCE', 1.5))
+# Weight of each new limit estimate
+CONCURRENCY_SMOOTHING = float(os.environ.get('CONCURRENCY_SMOOTHING', 0.2))
+# Multiplicative decrease applied when a call fails
+CONCURRENCY_BACKOFF = float(os.environ.get('CONCURRENCY_BACKOFF', 0.9))
+# Upstream endpoint -> priority class; unlisted endpoints are "normal"
+CONCURRENCY_PRIORITIES = dict(
+    item.split('=', 1) for item in filter(None, os.environ.get(
+        'CONCURRENCY_PRIORITIES', 'payment_check=low,pay_ride=critical,process_payment=critical').split(',')))
+
+# Share of the limit each priority class may fill
+PRIORITY_SHARES = {'critical': 1.0, 'normal': 0.9, 'low': 0.7}
+# Samples in the long-term latency average
+LONG_WINDOW = 600
+
+
+class ConcurrencyLimitExceeded(Exception):
+    """The service is at its concurrency limit for this request's priority class."""
+
+    def __init__(self, service_type, priority, status_code, retry_after):
+        super().__init__(f"{service_type} is over its concurrency limit for {priority} requests")
+        self.service_type = service_type
+        self.priority = priority
+        # 503 when the service is full, 429 when only lower priorities are being shed
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class GradientLimit:
+    """Concurrency limit for one service, adjusted from each completed call's latency."""
+
+    def __init__(self, initial=CONCURRENCY_INITIAL_LIMIT, min_limit=CONCURRENCY_MIN_LIMIT,
+                 max_limit=CONCURRENCY_MAX_LIMIT, tolerance=CONCURRENCY_TOLERANCE,
+                 smoothing=CONCURRENCY_SMOOTHING, backoff=CONCURRENCY_BACKOFF):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.long_rtt = None
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, share):
+        with self.lock:
+            if self.in_flight >= max(1, int(self.limit * share)):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, rtt, ok):
+        with self.lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            if not ok:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                return
+
+            if self.long_rtt is None:
+                self.long_rtt = rtt
+            else:
+                alpha = 2 / (LONG_WINDOW + 1)
+                self.long_rtt += alpha * (rtt - self.long_rtt)
+                # Latency dropped well below the average (e.g. the upstream recovered): let the
+                # average catch up faster so the limit can grow again
+                if self.long_rtt > 2 * rtt:
+                    self.long_rtt *= 0.95
+
+            # Lightly loaded: latency says nothing about how much more the upstream could take
+            if in_flight < self.limit / 2:
+                return
+
+            gradient = max(0.5, min(1.0, self.tolerance * self.long_rtt / max(rtt, 1e-6)))
+            estimate = self.limit * gradient + math.sqrt(self.limit)
+            self.limit = self.limit * (1 - self.smoothing) + estimate * self.smoothing
+            self.limit = max(self.min_limit, min(self.max_limit, self.limit))
+
+    def retry_after(self):
+        # Whole seconds for the header; a client should come back after a few call latencies
+        return max(1, math.ceil(4 * (self.long_rtt or 0)))
+
+
+class ConcurrencyLimiter:
+
+    def __init__(self, enabled=ADAPTIVE_CONCURRENCY, priorities=CONCURRENCY_PRIORITIES):
+        self.enabled = enabled
+        self.priorities = priorities
+        self.limits = {}
+        self.lock = threading.Lock()
+        # Every worker process adapts its own limit
+        self.limit_gauge = Gauge('api_gateway_concurrency_limit', 'Current adaptive concurrency limit',
+                                 ['service'], registry=None, multiprocess_mode='liveall')
+        self.in_flight_gauge = Gauge('api_gateway_concurrency_in_flight', 'Upstream calls in flight',
+                                     ['service'], registry=None, multiprocess_mode='livesum')
+        self.rejected = Counter('api_gateway_load_shed_total', 'Requests rejected by the concurrency limiter',
+                                ['service', 'priority'], registry=None)
+
+    def register_metrics(self, registry):
+        registry.register(self.limit_gauge)
+        registry.register(self.in_flight_gauge)
+        registry.register(self.rejected)
+
+    def get(self, service_type):
+        limit = self.limits.get(service_type)
+        if limit is None:
+            with self.lock:
+                limit = self.limits.setdefault(service_type, GradientLimit())
+        return limit
+
+    def priority(self, endpoint):
+        return self.priorities.get(endpoint, 'normal')
+
+    def acquire(self, service_type, endpoint):
+        """Admit one call or raise ConcurrencyLimitExceeded; returns a ticket for release()."""
+        if not self.enabled:
+            return None
+        limit = self.get(service_type)
+        priority = self.priority(endpoint)
+        if not limit.try_acquire(PRIORITY_SHARES.get(priority, PRIORITY_SHARES['normal'])):
+            self.rejected.labels(service=service_type, priority=priority).inc()
+            status_code = 429 if limit.in_flight < max(1, int(limit.limit)) else 503
+            raise ConcurrencyLimitExceeded(service_type, priority, status_code, limit.retry_after())
+        self.in_flight_gauge.labels(service=service_type).set(limit.in_flight)
+        return service_type, limit, time.monotonic()
+
+    def release(self, ticket, ok):
+        if ticket is None:
+            return
+        service_type, limit, started = ticket
+        limit.release(time.monotonic() - started, ok)
+        self.limit_gauge.labels(service=service_type).set(limit.limit)
+        self.in_flight_gauge.labels(service=service_type).set(limit.in_flight)
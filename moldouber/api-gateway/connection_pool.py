@@ -0,0 +1,261 @@
+# api-gateway/connection_pool.py
+
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from prometheus_client import Gauge
+
+import fast_json
+from multiprocess_metrics import set_function
+
+# Pool settings, overridable from docker-compose
+POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 20))
+KEEP_ALIVE = os.environ.get('UPSTREAM_KEEP_ALIVE', 'true').lower() == 'true'
+# Node's default keepAliveTimeout is 5s, so drop idle sockets before the upstream does
+IDLE_TIMEOUT = float(os.environ.get('UPSTREAM_POOL_IDLE_TIMEOUT', 4))
+REAPER_INTERVAL = 1.0
+
+
+def host_of(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def pool_gauges(registry):
+    return {
+        'hits': Gauge('api_gateway_upstream_pool_hits', 'Upstream requests served on a reused connection',
+                      ['host'], registry=registry, multiprocess_mode='livesum'),
+        'misses': Gauge('api_gateway_upstream_pool_misses', 'Upstream connections opened',
+                        ['host'], registry=registry, multiprocess_mode='livesum'),
+        'in_use': Gauge('api_gateway_upstream_pool_in_use', 'Upstream requests currently holding a connection',
+                        ['host'], registry=registry, multiprocess_mode='livesum'),
+    }
+
+
+class HostPool:
+    """Keep-alive session for a single upstream host."""
+
+    def __init__(self, host, pool_size=POOL_SIZE, keep_alive=KEEP_ALIVE, idle_timeout=IDLE_TIMEOUT):
+        self.host = host
+        self.idle_timeout = idle_timeout
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount(host, self.adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        # urllib3 resets its counters when the pool is cleared, keep the totals here
+        self.evicted_requests = 0
+        self.evicted_connections = 0
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.in_use += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            with self.lock:
+                self.in_use -= 1
+                self.last_used = time.monotonic()
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _live_counts(self):
+        # The pool key depends on the requests/urllib3 versions, so sum whatever is mounted
+        poolmanager = self.adapter.poolmanager
+        pools = [poolmanager.pools.get(key) for key in poolmanager.pools.keys()]
+        pools = [pool for pool in pools if pool is not None]
+        return sum(p.num_requests for p in pools), sum(p.num_connections for p in pools)
+
+    def requests_total(self):
+        return self.evicted_requests + self._live_counts()[0]
+
+    def connections_total(self):
+        return self.evicted_connections + self._live_counts()[1]
+
+    def hits(self):
+        # Every request that did not need a fresh TCP connection reused a pooled one
+        return max(self.requests_total() - self.connections_total(), 0)
+
+    def misses(self):
+        return self.connections_total()
+
+    def evict_if_idle(self, now):
+        with self.lock:
+            if self.in_use or now - self.last_used < self.idle_timeout:
+                return False
+            live_requests, live_connections = self._live_counts()
+            if live_requests == 0:
+                return False
+            self.evicted_requests += live_requests
+            self.evicted_connections += live_connections
+            self.adapter.poolmanager.clear()
+            return True
+
+
+class UpstreamPools:
+    """Registry of per-host pools shared by every gateway route and the saga runner."""
+
+    def __init__(self, hosts=(), pool_size=POOL_SIZE, keep_alive=KEEP_ALIVE, idle_timeout=IDLE_TIMEOUT):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.gauges = None
+        self._reaper = None
+        for host in hosts:
+            self.for_host(host)
+
+    def for_host(self, host):
+        pool = self.pools.get(host)
+        if pool is not None:
+            return pool
+        with self.lock:
+            pool = self.pools.get(host)
+            if pool is None:
+                pool = HostPool(host, self.pool_size, self.keep_alive, self.idle_timeout)
+                self.pools[host] = pool
+                self._bind_gauges(pool)
+        return pool
+
+    def post(self, url, **kwargs):
+        return self.for_host(host_of(url)).post(url, **kwargs)
+
+    def register_metrics(self, registry):
+        self.gauges = pool_gauges(registry)
+        for pool in list(self.pools.values()):
+            self._bind_gauges(pool)
+
+    def _bind_gauges(self, pool):
+        if self.gauges is None:
+            return
+        set_function(self.gauges['hits'].labels(host=pool.host), pool.hits)
+        set_function(self.gauges['misses'].labels(host=pool.host), pool.misses)
+        set_function(self.gauges['in_use'].labels(host=pool.host), lambda: pool.in_use)
+
+    def evict_idle(self):
+        now = time.monotonic()
+        return [pool.host for pool in list(self.pools.values()) if pool.evict_if_idle(now)]
+
+    def start_reaper(self, interval=REAPER_INTERVAL):
+        if self._reaper is not None:
+            return
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        self._reaper = threading.Thread(target=reap, name='upstream-pool-reaper', daemon=True)
+        self._reaper.start()
+
+
+class UpstreamHTTPError(aiohttp.ClientError):
+    """Raised by UpstreamResponse.raise_for_status for 4xx/5xx replies."""
+
+
+class UpstreamResponse:
+    """Fully read upstream reply, shaped like the parts of requests.Response the routes use."""
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    def json(self):
+        return fast_json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise UpstreamHTTPError(f"{self.status_code} Error from upstream")
+
+
+class AsyncHostPool:
+    """aiohttp counterpart of HostPool; the connector handles keep-alive and idle eviction itself."""
+
+    def __init__(self, host, pool_size=POOL_SIZE, keep_alive=KEEP_ALIVE, idle_timeout=IDLE_TIMEOUT):
+        self.host = host
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.session = None
+        self.in_use = 0
+        self.hit_count = 0
+        self.miss_count = 0
+
+    async def _on_reuse(self, session, context, params):
+        self.hit_count += 1
+
+    async def _on_create(self, session, context, params):
+        self.miss_count += 1
+
+    def _session(self):
+        # Sessions bind to the running loop, so they are created lazily on first use
+        if self.session is None or self.session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_reuseconn.append(self._on_reuse)
+            trace.on_connection_create_end.append(self._on_create)
+            connector = aiohttp.TCPConnector(limit=self.pool_size, force_close=not self.keep_alive,
+                                             keepalive_timeout=None if not self.keep_alive else self.idle_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        return self.session
+
+    async def request(self, method, url, json=None, timeout=None, headers=None):
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        self.in_use += 1
+        try:
+            async with self._session().request(method, url, json=json, timeout=client_timeout,
+                                               headers=headers) as response:
+                content = await response.read()
+                return UpstreamResponse(response.status, content, response.headers)
+        finally:
+            self.in_use -= 1
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    def hits(self):
+        return self.hit_count
+
+    def misses(self):
+        return self.miss_count
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class AsyncUpstreamPools(UpstreamPools):
+    """Per-host aiohttp sessions for the async gateway, exporting the same pool gauges."""
+
+    def for_host(self, host):
+        pool = self.pools.get(host)
+        if pool is None:
+            # Only touched from the event loop thread, no lock needed
+            pool = AsyncHostPool(host, self.pool_size, self.keep_alive, self.idle_timeout)
+            self.pools[host] = pool
+            self._bind_gauges(pool)
+        return pool
+
+    async def post(self, url, **kwargs):
+        return await self.for_host(host_of(url)).post(url, **kwargs)
+
+    def evict_idle(self):
+        return []
+
+    def start_reaper(self, interval=REAPER_INTERVAL):
+        pass
+
+    async def close(self):
+        for pool in list(self.pools.values()):
+            await pool.close()
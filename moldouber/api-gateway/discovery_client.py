@@ -0,0 +1,139 @@
+# api-gateway/discovery_client.py
+#
+# Local cache of upstream instances resolved from service-discovery. One watcher thread per
+# service long-polls the registry with the last seen index, so membership changes arrive
+# as soon as they happen and the request path only ever reads the cached list. Entries
+# older than the stale limit (watcher cut off from the registry) fall back to the static
+# SERVICE_HOSTS.
+
+import os
+import threading
+import time
+
+import requests
+from prometheus_client import Counter, Gauge
+
+from structured_log import get_logger, fields
+
+log = get_logger('discovery')
+
+SERVICE_DISCOVERY_URL = os.environ.get('SERVICE_DISCOVERY_URL', '')
+# Pause before re-watching after the registry failed to answer
+DISCOVERY_TTL = float(os.environ.get('DISCOVERY_TTL', 5))
+DISCOVERY_STALE_TTL = float(os.environ.get('DISCOVERY_STALE_TTL', 60))
+DISCOVERY_TIMEOUT = float(os.environ.get('DISCOVERY_TIMEOUT', 2))
+# How long the registry may hold a watch request open before answering unchanged
+DISCOVERY_WATCH_WAIT = float(os.environ.get('DISCOVERY_WATCH_WAIT', 30))
+# Floor between refreshes so an unreachable registry is not hammered
+DISCOVERY_MIN_INTERVAL = 0.5
+
+# Gateway service type -> name the Node services register under
+DISCOVERY_NAMES = {
+    'user-location': os.environ.get('USER_LOCATION_SERVICE_NAME', 'user-location-service'),
+    'ride-payment': os.environ.get('RIDE_PAYMENT_SERVICE_NAME', 'ride-payment-service'),
+}
+
+
+class CacheEntry:
+
+    def __init__(self, hosts, fetched_at, index=0):
+        self.hosts = hosts
+        self.fetched_at = fetched_at
+        self.index = index
+
+
+class DiscoveryCache:
+
+    def __init__(self, base_url=SERVICE_DISCOVERY_URL, names=None, ttl=DISCOVERY_TTL,
+                 stale_ttl=DISCOVERY_STALE_TTL, timeout=DISCOVERY_TIMEOUT, watch_wait=DISCOVERY_WATCH_WAIT):
+        self.base_url = base_url.rstrip('/')
+        self.names = dict(DISCOVERY_NAMES if names is None else names)
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.watch_wait = watch_wait
+        self.entries = {}
+        self.session = requests.Session()
+        self._watchers = {}
+
+        self.instances_gauge = Gauge('api_gateway_discovery_instances', 'Instances currently resolved per service',
+                                     ['service'], registry=None, multiprocess_mode='livemax')
+        self.refresh_errors = Counter('api_gateway_discovery_refresh_errors_total',
+                                      'Failed refreshes of the discovery cache', ['service'], registry=None)
+
+    @property
+    def enabled(self):
+        return bool(self.base_url)
+
+    def register_metrics(self, registry):
+        registry.register(self.instances_gauge)
+        registry.register(self.refresh_errors)
+
+    def fetch(self, service_type, index=None):
+        """Return (hosts, index). With an index, blocks until the registry moves past it."""
+        name = self.names[service_type]
+        params = None
+        timeout = self.timeout
+        if index is not None:
+            params = {'index': index, 'wait': f"{self.watch_wait}s"}
+            timeout = self.watch_wait + self.timeout
+        response = self.session.get(f"{self.base_url}/services/{name}/instances", params=params, timeout=timeout)
+        new_index = int(response.headers.get('X-Registry-Index', 0))
+        if response.status_code == 404:
+            return [], new_index
+        response.raise_for_status()
+        hosts = [f"http://{instance['address']}:{instance['port']}" for instance in response.json()['instances']]
+        return hosts, new_index
+
+    def refresh(self, service_type, index=None):
+        try:
+            hosts, new_index = self.fetch(service_type, index)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            self.refresh_errors.labels(service=service_type).inc()
+            log.warning("Discovery refresh failed: %s", e, extra=fields(service=service_type))
+            return False
+        # Swap the whole entry so readers never see a half-built list
+        self.entries[service_type] = CacheEntry(hosts, time.monotonic(), new_index)
+        self.instances_gauge.labels(service=service_type).set(len(hosts))
+        return True
+
+    def refresh_all(self):
+        for service_type in self.names:
+            self.refresh(service_type)
+
+    def resolve(self, service_type, fallback):
+        """Cached instances for service_type; never blocks on the registry."""
+        if not self.enabled or service_type not in self.names:
+            return fallback
+        entry = self.entries.get(service_type)
+        if entry is None:
+            return fallback
+        # A healthy watcher re-stamps the entry at least every watch_wait seconds, so
+        # anything older than that plus the stale limit means the registry is unreachable
+        if time.monotonic() - entry.fetched_at >= self.watch_wait + self.stale_ttl or not entry.hosts:
+            return fallback
+        return entry.hosts
+
+    def watch(self, service_type):
+        """Blocking query loop for one service; runs on its own watcher thread."""
+        while True:
+            entry = self.entries.get(service_type)
+            index = entry.index if entry is not None else None
+            started = time.monotonic()
+            if not self.refresh(service_type, index):
+                # Keep serving the last list; it ages into the fallback if the outage lasts
+                time.sleep(max(self.ttl, DISCOVERY_MIN_INTERVAL))
+                continue
+            # Floor the loop in case the registry answers watches without blocking
+            elapsed = time.monotonic() - started
+            if elapsed < DISCOVERY_MIN_INTERVAL:
+                time.sleep(DISCOVERY_MIN_INTERVAL - elapsed)
+
+    def start(self):
+        if not self.enabled or self._watchers:
+            return
+        for service_type in self.names:
+            watcher = threading.Thread(target=self.watch, args=(service_type,),
+                                       name=f"discovery-watch-{service_type}", daemon=True)
+            self._watchers[service_type] = watcher
+            watcher.start()
@@ -0,0 +1,91 @@
+# api-gateway/fake_grpc_server.py
+#
+# In-process fake of the user-location and ride-payment gRPC services, so the gateway's
+# gRPC transport can be exercised without the Node services.
+#
+#   python fake_grpc_server.py --port 50051
+
+import argparse
+import uuid
+from concurrent import futures
+
+import grpc
+
+import user_location_pb2
+import user_location_pb2_grpc
+import ride_payment_pb2
+import ride_payment_pb2_grpc
+
+
+class FakeUserLocationService(user_location_pb2_grpc.UserLocationServiceServicer):
+
+    def __init__(self):
+        self.orders = {}
+        self.rides = {}
+        self.ride_users = {}
+
+    def MakeOrder(self, request, context):
+        order_id = str(uuid.uuid4())
+        self.orders[order_id] = request
+        return user_location_pb2.OrderResponse(orderId=order_id, estimatedPrice=42.0)
+
+    def AcceptOrder(self, request, context):
+        order = self.orders.get(request.orderId)
+        if order is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"Order {request.orderId} not found")
+        ride_id = str(uuid.uuid4())
+        self.rides[ride_id] = 'orderNotPaid'
+        self.ride_users[ride_id] = order.userId
+        return user_location_pb2.AcceptOrderResponse(
+            rideId=ride_id,
+            startLongitude=order.startLongitude,
+            startLatitude=order.startLatitude,
+            endLongitude=order.endLongitude,
+            endLatitude=order.endLatitude,
+            estimatedPrice=42.0,
+        )
+
+    def FinishOrder(self, request, context):
+        if request.rideId not in self.rides:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"Ride {request.rideId} not found")
+        return user_location_pb2.FinishOrderResponse(paymentStatus='pending')
+
+    def PaymentCheck(self, request, context):
+        if request.rideId not in self.rides:
+            context.abort(grpc.StatusCode.NOT_FOUND, "Ride not found")
+        return user_location_pb2.PaymentCheckResponse(status=self.rides[request.rideId],
+                                                      userId=self.ride_users[request.rideId])
+
+
+class FakeRidePaymentService(ride_payment_pb2_grpc.RidePaymentServiceServicer):
+
+    def __init__(self, user_location):
+        self.user_location = user_location
+
+    def PayRide(self, request, context):
+        self.user_location.rides[request.rideId] = 'paid'
+        return ride_payment_pb2.PayRideResponse(rideId=request.rideId, status='paid')
+
+    def ProcessPayment(self, request, context):
+        return ride_payment_pb2.ProcessPaymentResponse(rideId=request.rideId, status='processed')
+
+
+def start_fake_server(port=0, max_workers=10):
+    """Start both fake services on one port (0 picks a free one). Returns (server, port)."""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    user_location = FakeUserLocationService()
+    user_location_pb2_grpc.add_UserLocationServiceServicer_to_server(user_location, server)
+    ride_payment_pb2_grpc.add_RidePaymentServiceServicer_to_server(FakeRidePaymentService(user_location), server)
+    bound_port = server.add_insecure_port(f'127.0.0.1:{port}')
+    server.start()
+    return server, bound_port
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the fake gRPC upstreams')
+    parser.add_argument('--port', type=int, default=50051)
+    args = parser.parse_args()
+
+    server, port = start_fake_server(args.port)
+    print(f"Fake gRPC upstreams listening on 127.0.0.1:{port}")
+    server.wait_for_termination()
@@ -0,0 +1,84 @@
+# api-gateway/fast_json.py
+#
+# JSON for the bodies the gateway has to decode or build itself. Upstream replies that are
+# returned unchanged are not decoded at all (see relay_headers and UPSTREAM_PASSTHROUGH); what
+# is left goes through orjson when it is installed, which encodes straight to bytes and is
+# several times faster than the json module, and falls back to the json module otherwise.
+
+import decimal
+import json
+import os
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Return upstream bodies to the client as received instead of decoding and re-encoding them
+UPSTREAM_PASSTHROUGH = os.environ.get('UPSTREAM_PASSTHROUGH', 'true').lower() == 'true'
+# Upstream headers returned with a passed-through body. Length, encoding and hop-by-hop
+# headers are left out: the client library has already decoded the body and the server frames
+# the reply itself.
+PASSTHROUGH_HEADERS = tuple(filter(None, os.environ.get(
+    'PASSTHROUGH_HEADERS', 'Content-Type,Cache-Control,ETag,Last-Modified,Expires').split(',')))
+
+JSON_CONTENT_TYPE = 'application/json'
+
+
+def _default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+    # orjson >= 3.9 can splice an already encoded body into a larger document
+    Fragment = getattr(orjson, 'Fragment', None)
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    Fragment = None
+
+    def dumps(obj):
+        return json.dumps(obj, default=_default, separators=(',', ':')).encode()
+
+    def loads(data):
+        return json.loads(data)
+
+
+def dumps_str(obj):
+    return dumps(obj).decode()
+
+
+def is_json(content_type):
+    return (content_type or '').split(';', 1)[0].strip().lower() == JSON_CONTENT_TYPE
+
+
+def parse_response(response):
+    """Decoded body of an upstream reply; HTTP bodies go through the fast decoder."""
+    if isinstance(response, requests.Response):
+        return loads(response.content)
+    return response.json()
+
+
+def embed(response):
+    """Upstream body to place inside a gateway-built document, e.g. one batch item's result.
+
+    With orjson Fragments the bytes are spliced in as they are; otherwise they are decoded.
+    """
+    if Fragment is not None and UPSTREAM_PASSTHROUGH and is_json(response.headers.get('Content-Type')):
+        return Fragment(response.content)
+    return parse_response(response)
+
+
+def relay_headers(response):
+    headers = {name: response.headers[name] for name in PASSTHROUGH_HEADERS if name in response.headers}
+    headers.setdefault('Content-Type', JSON_CONTENT_TYPE)
+    return headers
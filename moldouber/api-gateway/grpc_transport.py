@@ -0,0 +1,179 @@
+# api-gateway/grpc_transport.py
+#
+# gRPC upstream transport built on the generated stubs. Channels are persistent and
+# multiplexed: one per instance, shared by every request to that instance.
+
+import os
+import threading
+from urllib.parse import urlsplit
+
+import grpc
+from google.protobuf.json_format import MessageToDict, ParseDict
+
+import user_location_pb2
+import user_location_pb2_grpc
+import ride_payment_pb2
+import ride_payment_pb2_grpc
+import fast_json
+
+# Which transport each service type uses: 'http' (JSON over HTTP/1.1) or 'grpc'
+UPSTREAM_TRANSPORTS = {
+    'user-location': os.environ.get('USER_LOCATION_TRANSPORT', 'http'),
+    'ride-payment': os.environ.get('RIDE_PAYMENT_TRANSPORT', 'http'),
+}
+
+# gRPC listens next to the HTTP port on the same instance hostname
+GRPC_PORTS = {
+    'user-location': int(os.environ.get('USER_LOCATION_GRPC_PORT', 50051)),
+    'ride-payment': int(os.environ.get('RIDE_PAYMENT_GRPC_PORT', 50052)),
+}
+
+# gRPC statuses that mean the request itself is wrong, answered like the HTTP upstream would
+# answer it: a 4xx reply the walk returns instead of retrying
+CLIENT_ERROR_STATUSES = {
+    grpc.StatusCode.NOT_FOUND: 404,
+    grpc.StatusCode.INVALID_ARGUMENT: 400,
+    grpc.StatusCode.FAILED_PRECONDITION: 400,
+}
+
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+]
+
+# Gateway endpoint -> (stub class, rpc name, request message)
+GRPC_METHODS = {
+    'user-location': {
+        'make_order': (user_location_pb2_grpc.UserLocationServiceStub, 'MakeOrder', user_location_pb2.OrderRequest),
+        'accept_order': (user_location_pb2_grpc.UserLocationServiceStub, 'AcceptOrder', user_location_pb2.AcceptOrderRequest),
+        'finish_order': (user_location_pb2_grpc.UserLocationServiceStub, 'FinishOrder', user_location_pb2.FinishOrderRequest),
+        'payment_check': (user_location_pb2_grpc.UserLocationServiceStub, 'PaymentCheck', user_location_pb2.PaymentCheckRequest),
+    },
+    'ride-payment': {
+        'pay_ride': (ride_payment_pb2_grpc.RidePaymentServiceStub, 'PayRide', ride_payment_pb2.PayRideRequest),
+        'process_payment': (ride_payment_pb2_grpc.RidePaymentServiceStub, 'ProcessPayment', ride_payment_pb2.ProcessPaymentRequest),
+    },
+}
+
+
+def uses_grpc(service_type, endpoint):
+    return UPSTREAM_TRANSPORTS.get(service_type) == 'grpc' and endpoint in GRPC_METHODS.get(service_type, {})
+
+
+def grpc_target(service_type, host):
+    return f"{urlsplit(host).hostname}:{GRPC_PORTS[service_type]}"
+
+
+class GrpcResponse:
+    """RPC reply, shaped like the parts of requests.Response the routes use."""
+
+    status_code = 200
+    headers = {'Content-Type': fast_json.JSON_CONTENT_TYPE}
+
+    def __init__(self, message):
+        self.message = message
+
+    def json(self):
+        return MessageToDict(self.message, preserving_proto_field_name=True,
+                             always_print_fields_with_no_presence=True)
+
+    @property
+    def content(self):
+        # There is no JSON body on the wire to pass through, so the message is encoded here once
+        return fast_json.dumps(self.json())
+
+    def raise_for_status(self):
+        # Other non-OK status codes surface as grpc.RpcError from the call itself
+        pass
+
+
+class GrpcClientError(GrpcResponse):
+    """A client error status as the 4xx reply the HTTP transport would get, {"error": details}."""
+
+    def __init__(self, status_code, details):
+        self.status_code = status_code
+        self.details = details
+
+    def json(self):
+        return {"error": self.details}
+
+
+def _client_error(error):
+    """The 4xx reply for a client error status; any other RpcError is raised again."""
+    status_code = CLIENT_ERROR_STATUSES.get(error.code())
+    if status_code is None:
+        raise error
+    return GrpcClientError(status_code, error.details())
+
+
+def _build_request(request_type, payload):
+    return ParseDict(payload, request_type(), ignore_unknown_fields=True)
+
+
+class GrpcChannels:
+    """One persistent channel and stub set per upstream target."""
+
+    def __init__(self, options=CHANNEL_OPTIONS):
+        self.options = options
+        self.channels = {}
+        self.stubs = {}
+        self.lock = threading.Lock()
+
+    def _new_channel(self, target):
+        return grpc.insecure_channel(target, options=self.options)
+
+    def stub(self, target, stub_class):
+        key = (target, stub_class)
+        stub = self.stubs.get(key)
+        if stub is not None:
+            return stub
+        with self.lock:
+            stub = self.stubs.get(key)
+            if stub is None:
+                channel = self.channels.get(target)
+                if channel is None:
+                    channel = self._new_channel(target)
+                    self.channels[target] = channel
+                stub = stub_class(channel)
+                self.stubs[key] = stub
+        return stub
+
+    def call(self, service_type, host, endpoint, payload, timeout=None, metadata=None):
+        stub_class, rpc_name, request_type = GRPC_METHODS[service_type][endpoint]
+        stub = self.stub(grpc_target(service_type, host), stub_class)
+        try:
+            return GrpcResponse(getattr(stub, rpc_name)(_build_request(request_type, payload), timeout=timeout,
+                                                        metadata=metadata))
+        except grpc.RpcError as e:
+            return _client_error(e)
+
+    def close(self):
+        with self.lock:
+            for channel in self.channels.values():
+                channel.close()
+            self.channels.clear()
+            self.stubs.clear()
+
+
+class AsyncGrpcChannels(GrpcChannels):
+    """grpc.aio channels for the async gateway; only used from the event loop thread."""
+
+    def _new_channel(self, target):
+        return grpc.aio.insecure_channel(target, options=self.options)
+
+    async def call(self, service_type, host, endpoint, payload, timeout=None, metadata=None):
+        stub_class, rpc_name, request_type = GRPC_METHODS[service_type][endpoint]
+        stub = self.stub(grpc_target(service_type, host), stub_class)
+        try:
+            return GrpcResponse(await getattr(stub, rpc_name)(_build_request(request_type, payload),
+                                                              timeout=timeout, metadata=metadata))
+        except grpc.RpcError as e:
+            return _client_error(e)
+
+    async def close(self):
+        for channel in list(self.channels.values()):
+            await channel.close()
+        self.channels.clear()
+        self.stubs.clear()
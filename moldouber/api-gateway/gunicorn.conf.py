@@ -0,0 +1,76 @@
+# api-gateway/gunicorn.conf.py
+#
+# Production serving: several worker processes, so the gateway is not held to one core by the
+# GIL. Start it with `python serve.py --server gunicorn` (or GATEWAY_SERVER=gunicorn). Sync
+# mode runs app.py on threaded workers; GATEWAY_MODE=async runs async_app.py on aiohttp workers.
+#
+# The app is preloaded once in the master and forked into the workers. Background threads
+# (discovery watchers, saga recovery, pool reaper, rate limit sync) are started in each worker
+# after the fork. Metrics go through PROMETHEUS_MULTIPROC_DIR, so /metrics on any worker
+# reports every worker's counters and histograms.
+#
+# Per-worker state: circuit breakers, balancer latencies, concurrency limits and retry budgets
+# are kept by each worker for the traffic it sees, and their gauges carry a pid label. State
+# that has to hold across workers needs a shared backend: IDEMPOTENCY_BACKEND=redis and
+# RATE_LIMIT_BACKEND=redis. With the in-memory defaults each worker keeps its own keys and
+# buckets. Sagas in the shared SAGA_LOG_PATH are owned per worker, and a dead worker's
+# sagas are recovered by the others.
+
+import os
+import shutil
+
+GATEWAY_MODE = os.environ.get('GATEWAY_MODE', 'sync')
+
+bind = f"{os.environ.get('GATEWAY_HOST', '0.0.0.0')}:{os.environ.get('GATEWAY_PORT', 5000)}"
+workers = int(os.environ.get('GATEWAY_WORKERS', os.cpu_count() or 1))
+# Request threads per sync worker; async workers serve everything on their event loop
+threads = int(os.environ.get('GATEWAY_THREADS', 16))
+preload_app = os.environ.get('GATEWAY_PRELOAD', 'true').lower() == 'true'
+timeout = int(os.environ.get('GATEWAY_WORKER_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GATEWAY_GRACEFUL_TIMEOUT', 30))
+# Longer than the keep-alive of a typical load balancer in front, so it closes idle connections first
+keepalive = int(os.environ.get('GATEWAY_KEEPALIVE', 75))
+# Recycle workers after this many requests (plus jitter) to bound slow leaks; 0 never recycles
+max_requests = int(os.environ.get('GATEWAY_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+if GATEWAY_MODE == 'async':
+    worker_class = 'aiohttp.GunicornWebWorker'
+    wsgi_app = 'async_app:gunicorn_app'
+else:
+    worker_class = 'gthread'
+    wsgi_app = 'app:app'
+
+# Both must be set before the app, and with it prometheus_client, is imported
+os.environ['GATEWAY_SERVER'] = 'gunicorn'
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/api-gateway-metrics')
+METRICS_DIR = os.environ['PROMETHEUS_MULTIPROC_DIR']
+# Samples left by an earlier run would be added to this one's. Only on first start: a reload
+# (SIGHUP) reads this file again while the workers are still writing there
+if os.environ.get('GATEWAY_METRICS_DIR_CLEARED') != METRICS_DIR:
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    os.environ['GATEWAY_METRICS_DIR_CLEARED'] = METRICS_DIR
+
+
+def when_ready(server):
+    if workers > 1:
+        if os.environ.get('IDEMPOTENCY_BACKEND', 'memory') == 'memory':
+            server.log.warning("IDEMPOTENCY_BACKEND=memory with %d workers: a retried request that lands on "
+                               "another worker runs again", workers)
+        if os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true' and \
+                os.environ.get('RATE_LIMIT_BACKEND', 'local') == 'local':
+            server.log.warning("RATE_LIMIT_BACKEND=local with %d workers: each worker enforces the limits "
+                               "on its own", workers)
+
+
+def post_fork(server, worker):
+    if GATEWAY_MODE != 'async':
+        # The async app starts its background tasks from its own startup hook
+        from app import start_background_tasks
+        start_background_tasks()
+
+
+def child_exit(server, worker):
+    from multiprocess_metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -0,0 +1,198 @@
+# api-gateway/hedging.py
+#
+# Hedged requests for idempotent upstream endpoints: if the primary instance has not
+# answered within the observed latency percentile, a duplicate goes to the next instance
+# and whichever answers first wins.
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from prometheus_client import Counter
+
+from structured_log import submit_in_context
+
+# Only endpoints that are safe to execute twice
+HEDGE_ENDPOINTS = set(filter(None, os.environ.get('HEDGE_ENDPOINTS', 'payment_check').split(',')))
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))
+# Used until the window has enough samples to trust the percentile
+HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', 0.2))
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.01))
+# At most this fraction of requests may fire a hedge, with a small burst allowance
+HEDGE_BUDGET_RATIO = float(os.environ.get('HEDGE_BUDGET_RATIO', 0.1))
+HEDGE_BUDGET_BURST = float(os.environ.get('HEDGE_BUDGET_BURST', 10))
+HEDGE_MAX_WORKERS = int(os.environ.get('HEDGE_MAX_WORKERS', 32))
+
+WINDOW_SIZE = 512
+MIN_SAMPLES = 20
+RECOMPUTE_EVERY = 16
+
+
+class LatencyWindow:
+    """Sliding window of recent successful latencies with a cached percentile."""
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, size=WINDOW_SIZE):
+        self.percentile = percentile
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.since_recompute = 0
+        self.cached = None
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.since_recompute += 1
+            if len(self.samples) >= MIN_SAMPLES and (self.cached is None or self.since_recompute >= RECOMPUTE_EVERY):
+                ordered = sorted(self.samples)
+                index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+                self.cached = ordered[index]
+                self.since_recompute = 0
+
+    def value(self):
+        return self.cached
+
+
+class HedgeBudget:
+    """Token bucket refilled by each request, so hedges stay a bounded fraction of traffic."""
+
+    def __init__(self, ratio=HEDGE_BUDGET_RATIO, burst=HEDGE_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.lock = threading.Lock()
+
+    def on_request(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class HedgePolicy:
+
+    def __init__(self, endpoints=HEDGE_ENDPOINTS, percentile=HEDGE_PERCENTILE, default_delay=HEDGE_DEFAULT_DELAY,
+                 min_delay=HEDGE_MIN_DELAY, budget_ratio=HEDGE_BUDGET_RATIO, budget_burst=HEDGE_BUDGET_BURST,
+                 max_workers=HEDGE_MAX_WORKERS):
+        self.endpoints = set(endpoints)
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.max_workers = max_workers
+        self.windows = {}
+        self.budgets = {}
+        self.lock = threading.Lock()
+        self._executor = None
+
+        self.fired = Counter('api_gateway_hedges_fired_total', 'Hedged duplicate requests sent',
+                             ['service', 'endpoint'], registry=None)
+        self.won = Counter('api_gateway_hedges_won_total', 'Hedged duplicates that answered before the primary',
+                           ['service', 'endpoint'], registry=None)
+
+    def register_metrics(self, registry):
+        registry.register(self.fired)
+        registry.register(self.won)
+
+    def is_hedgeable(self, endpoint):
+        return endpoint in self.endpoints
+
+    def _window(self, service_type, endpoint):
+        key = (service_type, endpoint)
+        window = self.windows.get(key)
+        if window is None:
+            with self.lock:
+                window = self.windows.setdefault(key, LatencyWindow(self.percentile))
+        return window
+
+    def _budget(self, service_type):
+        budget = self.budgets.get(service_type)
+        if budget is None:
+            with self.lock:
+                budget = self.budgets.setdefault(service_type, HedgeBudget(self.budget_ratio, self.budget_burst))
+        return budget
+
+    def delay(self, service_type, endpoint):
+        observed = self._window(service_type, endpoint).value()
+        if observed is None:
+            return self.default_delay
+        return max(observed, self.min_delay)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self.lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='hedge')
+        return self._executor
+
+    def _should_hedge(self, service_type, instances):
+        return len(instances) > 1 and self._budget(service_type).try_spend()
+
+    def call(self, send, service_type, endpoint, instances):
+        """Run send(instance) on instances[0], hedging onto instances[1] after the delay.
+
+        Returns the first successful result; raises the last error if every attempt failed.
+        """
+        self._budget(service_type).on_request()
+        attempts = {submit_in_context(self.executor, send, instances[0]): (False, time.monotonic())}
+
+        done, _ = wait(attempts, timeout=self.delay(service_type, endpoint))
+        if not done and self._should_hedge(service_type, instances):
+            self.fired.labels(service=service_type, endpoint=endpoint).inc()
+            attempts[submit_in_context(self.executor, send, instances[1])] = (True, time.monotonic())
+
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                # The losing attempt keeps running on its worker; its result is dropped
+                self._finish(service_type, endpoint, *attempts[future])
+                return result
+        raise error
+
+    async def call_async(self, send, service_type, endpoint, instances):
+        """asyncio variant of call(); the losing attempt is cancelled."""
+        self._budget(service_type).on_request()
+        attempts = {asyncio.ensure_future(send(instances[0])): (False, time.monotonic())}
+
+        done, _ = await asyncio.wait(list(attempts), timeout=self.delay(service_type, endpoint))
+        if not done and self._should_hedge(service_type, instances):
+            self.fired.labels(service=service_type, endpoint=endpoint).inc()
+            attempts[asyncio.ensure_future(send(instances[1]))] = (True, time.monotonic())
+
+        pending = set(attempts)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    self._finish(service_type, endpoint, *attempts[task])
+                    return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise error
+
+    def _finish(self, service_type, endpoint, hedged, start):
+        # Per-attempt latency, so a winning hedge does not inflate the primary's percentile
+        self._window(service_type, endpoint).record(time.monotonic() - start)
+        if hedged:
+            self.won.labels(service=service_type, endpoint=endpoint).inc()
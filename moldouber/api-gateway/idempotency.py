@@ -0,0 +1,250 @@
+# api-gateway/idempotency.py
+#
+# Idempotency-Key support for mutating routes. The first request with a key runs and its
+# response is stored; repeats get the stored response back, and duplicates that arrive while
+# the first is still running wait for it instead of calling the upstream again. Within one
+# process waiting goes through SingleFlight; across gateway processes the backend's
+# in-progress claim does the same job, so a shared backend (redis) covers several workers.
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+from singleflight import SingleFlight, AsyncSingleFlight
+
+IDEMPOTENCY_BACKEND = os.environ.get('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_REDIS_URL = os.environ.get('IDEMPOTENCY_REDIS_URL', 'redis://localhost:6379/0')
+# How long a completed response can be replayed
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 100000))
+# An in-progress claim expires after this long, in case its owner died mid-request
+IDEMPOTENCY_LOCK_TTL = float(os.environ.get('IDEMPOTENCY_LOCK_TTL', 30))
+# How long a duplicate waits for another process to finish the first request
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.environ.get('IDEMPOTENCY_WAIT_TIMEOUT', 15))
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+MAX_KEY_LENGTH = 255
+
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+
+class IdempotencyError(Exception):
+    """Base class for requests that cannot be executed or replayed under their key."""
+
+
+class IdempotencyKeyInvalid(IdempotencyError):
+    """The Idempotency-Key header is empty or too long."""
+
+
+class IdempotencyConflict(IdempotencyError):
+    """The key was already used for a request with a different body."""
+
+
+class IdempotencyInProgress(IdempotencyError):
+    """Another process is still executing the first request with this key."""
+
+
+class MemoryBackend:
+    """Process-local store, bounded to max_entries with least recently used eviction."""
+
+    blocking = False
+
+    def __init__(self, max_entries=IDEMPOTENCY_MAX_KEYS):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            record, expires_at = item
+            if time.monotonic() >= expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return record
+
+    def _set(self, key, record, ttl):
+        # Caller holds self.lock
+        self.entries[key] = (record, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def claim(self, key, record, ttl):
+        """Store record only if the key is unused; returns whether it was stored."""
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None and time.monotonic() < item[1]:
+                return False
+            self._set(key, record, ttl)
+            return True
+
+    def put(self, key, record, ttl):
+        with self.lock:
+            self._set(key, record, ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class RedisBackend:
+    """Shared store so every gateway process sees the same keys. Needs the redis package."""
+
+    blocking = True
+
+    def __init__(self, url=IDEMPOTENCY_REDIS_URL, prefix='idempotency:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def claim(self, key, record, ttl):
+        return bool(self.client.set(self.prefix + key, json.dumps(record), nx=True, px=int(ttl * 1000)))
+
+    def put(self, key, record, ttl):
+        self.client.set(self.prefix + key, json.dumps(record), px=int(ttl * 1000))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+BACKENDS = {'memory': MemoryBackend, 'redis': RedisBackend}
+
+
+def create_backend(name=IDEMPOTENCY_BACKEND):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown idempotency backend: {name}")
+    return BACKENDS[name]()
+
+
+class IdempotencyStore:
+
+    def __init__(self, backend=None, ttl=IDEMPOTENCY_TTL, lock_ttl=IDEMPOTENCY_LOCK_TTL,
+                 wait_timeout=IDEMPOTENCY_WAIT_TIMEOUT):
+        self.backend = backend if backend is not None else create_backend()
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self.flights = SingleFlight()
+        self.async_flights = AsyncSingleFlight()
+        self.requests = Counter('api_gateway_idempotency_requests_total',
+                                'Requests carrying an Idempotency-Key, by outcome',
+                                ['route', 'outcome'], registry=None)
+
+    def register_metrics(self, registry):
+        registry.register(self.requests)
+
+    @staticmethod
+    def fingerprint(body):
+        return hashlib.sha256(body or b'').hexdigest()
+
+    def _store_key(self, scope, key):
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise IdempotencyKeyInvalid(f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters")
+        return f"{scope}:{key}"
+
+    def _replay(self, scope, record, fingerprint, outcome):
+        if record['fingerprint'] != fingerprint:
+            self.requests.labels(route=scope, outcome='conflict').inc()
+            raise IdempotencyConflict("Idempotency-Key was already used with a different request body")
+        self.requests.labels(route=scope, outcome=outcome).inc()
+        return (record['status'], record['body'], record['content_type']), True
+
+    def _execute(self, store_key, fingerprint, run):
+        """Leader path within this process: claim the key, run, store or release."""
+        deadline = time.monotonic() + self.wait_timeout
+        claim = {"state": IN_PROGRESS, "fingerprint": fingerprint}
+        while not self.backend.claim(store_key, claim, self.lock_ttl):
+            record = self.backend.get(store_key)
+            if record is not None and record['state'] == COMPLETED:
+                return record
+            if time.monotonic() >= deadline:
+                raise IdempotencyInProgress("A request with this Idempotency-Key is still being processed")
+            # Another process holds the claim; wait for it to finish or expire
+            time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+        try:
+            status, body, content_type = run()
+        except BaseException:
+            self.backend.delete(store_key)
+            raise
+        record = {"state": COMPLETED, "fingerprint": fingerprint, "status": status, "body": body,
+                  "content_type": content_type}
+        if status >= 500:
+            # Server-side failures are not final; let the client retry them for real
+            self.backend.delete(store_key)
+        else:
+            self.backend.put(store_key, record, self.ttl)
+        return record
+
+    def execute(self, scope, key, body, run):
+        """Run run() -> (status, body, content_type) at most once per (scope, key).
+
+        Returns (result, replayed).
+        """
+        store_key = self._store_key(scope, key)
+        fingerprint = self.fingerprint(body)
+        record = self.backend.get(store_key)
+        if record is not None and record['state'] == COMPLETED:
+            return self._replay(scope, record, fingerprint, 'replayed')
+
+        record, shared = self.flights.do(store_key, lambda: self._execute(store_key, fingerprint, run))
+        if shared or record['fingerprint'] != fingerprint:
+            return self._replay(scope, record, fingerprint, 'coalesced')
+        self.requests.labels(route=scope, outcome='executed').inc()
+        return (record['status'], record['body'], record['content_type']), False
+
+    async def _call_backend(self, method, *args):
+        if self.backend.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def _execute_async(self, store_key, fingerprint, run):
+        deadline = time.monotonic() + self.wait_timeout
+        claim = {"state": IN_PROGRESS, "fingerprint": fingerprint}
+        while not await self._call_backend(self.backend.claim, store_key, claim, self.lock_ttl):
+            record = await self._call_backend(self.backend.get, store_key)
+            if record is not None and record['state'] == COMPLETED:
+                return record
+            if time.monotonic() >= deadline:
+                raise IdempotencyInProgress("A request with this Idempotency-Key is still being processed")
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+        try:
+            status, body, content_type = await run()
+        except BaseException:
+            await self._call_backend(self.backend.delete, store_key)
+            raise
+        record = {"state": COMPLETED, "fingerprint": fingerprint, "status": status, "body": body,
+                  "content_type": content_type}
+        if status >= 500:
+            await self._call_backend(self.backend.delete, store_key)
+        else:
+            await self._call_backend(self.backend.put, store_key, record, self.ttl)
+        return record
+
+    async def execute_async(self, scope, key, body, run):
+        store_key = self._store_key(scope, key)
+        fingerprint = self.fingerprint(body)
+        record = await self._call_backend(self.backend.get, store_key)
+        if record is not None and record['state'] == COMPLETED:
+            return self._replay(scope, record, fingerprint, 'replayed')
+
+        record, shared = await self.async_flights.do(store_key, lambda: self._execute_async(store_key, fingerprint, run))
+        if shared or record['fingerprint'] != fingerprint:
+            return self._replay(scope, record, fingerprint, 'coalesced')
+        self.requests.labels(route=scope, outcome='executed').inc()
+        return (record['status'], record['body'], record['content_type']), False
@@ -0,0 +1,62 @@
+# api-gateway/multiprocess_metrics.py
+#
+# Prometheus metrics when the gateway runs as several worker processes (gunicorn.conf.py).
+# With PROMETHEUS_MULTIPROC_DIR set, prometheus_client keeps every counter, histogram and
+# gauge sample in per-process files in that directory and /metrics adds them up. Gauges
+# computed at scrape time (set_function) cannot be kept that way, so in multiprocess mode each
+# worker copies their current values into the gauges every MULTIPROC_REFRESH_INTERVAL instead.
+
+import os
+import threading
+import time
+
+from prometheus_client import CollectorRegistry
+from prometheus_client import multiprocess
+
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+MULTIPROC_REFRESH_INTERVAL = float(os.environ.get('MULTIPROC_REFRESH_INTERVAL', 5))
+
+# (gauge child, function) pairs refreshed by each worker
+_functions = []
+_refresher = None
+
+
+def set_function(gauge, function):
+    """gauge.set_function(function) that also works across worker processes."""
+    if MULTIPROCESS:
+        _functions.append((gauge, function))
+        gauge.set(function())
+    else:
+        gauge.set_function(function)
+
+
+def refresh():
+    for gauge, function in list(_functions):
+        gauge.set(function())
+
+
+def start_refresher(interval=MULTIPROC_REFRESH_INTERVAL):
+    """Start this process's refresh thread; call it in each worker, threads do not survive fork."""
+    global _refresher
+    if not MULTIPROCESS or (_refresher is not None and _refresher.is_alive()):
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            refresh()
+
+    _refresher = threading.Thread(target=run, name='metrics-refresh', daemon=True)
+    _refresher.start()
+
+
+def collector_registry():
+    """Registry that reads every worker's samples, for serving /metrics."""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def mark_process_dead(pid):
+    # Drops the exited worker's live* gauges; its counters and histograms keep counting
+    multiprocess.mark_process_dead(pid)
@@ -0,0 +1,227 @@
+# api-gateway/rate_limit.py
+#
+# Per-client rate limits, keyed on the request's userId together with the client address, or
+# on the address alone. Routes are named by their template (/api/saga/<transaction_id>), so
+# RATE_LIMITS entries and the route label of api_gateway_rate_limited_total stay bounded. Each
+# (route, client) bucket is a token bucket kept as a single "theoretical arrival time" (GCRA),
+# so a check is one dict read and one dict write with no lock. Two threads racing on the same
+# bucket can let one extra request through; they can never reject one that should pass.
+#
+# With RATE_LIMIT_BACKEND=redis, every gateway process still decides locally, and a sync
+# thread periodically adds its hit counts to shared counters and charges the hits the other
+# processes made to the local buckets, so the limits hold roughly across a scaled-out gateway.
+
+import functools
+import math
+import os
+import threading
+import time
+from collections import Counter as Tally, deque
+
+from prometheus_client import Counter
+
+from structured_log import get_logger
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+# requests per second:burst for every /api/ route without its own entry in RATE_LIMITS
+RATE_LIMIT_DEFAULT = os.environ.get('RATE_LIMIT_DEFAULT', '50:100')
+# Comma-separated route=rate:burst overrides
+RATE_LIMITS = os.environ.get('RATE_LIMITS', '/api/user/check_payment_status=5:10')
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'local')
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/1')
+RATE_LIMIT_SYNC_INTERVAL = float(os.environ.get('RATE_LIMIT_SYNC_INTERVAL', 1))
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+# Only behind a proxy that sets X-Forwarded-For; otherwise clients could pick their own key
+RATE_LIMIT_TRUST_FORWARDED = os.environ.get('RATE_LIMIT_TRUST_FORWARDED', 'false').lower() == 'true'
+
+LIMITED_PREFIX = '/api/'
+
+log = get_logger('rate_limit')
+
+
+@functools.lru_cache(maxsize=None)
+def route_template(canonical):
+    """An aiohttp resource's canonical path in the Flask form RATE_LIMITS and the metrics use."""
+    # /api/saga/{transaction_id} -> /api/saga/<transaction_id>
+    return canonical.replace('{', '<').replace('}', '>')
+
+
+class Limit:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.interval = 1 / rate
+        # How far ahead of now the arrival time may run before requests are refused
+        self.tolerance = self.interval * (burst - 1)
+
+
+def parse_limit(spec):
+    rate, _, burst = spec.partition(':')
+    rate = float(rate)
+    return Limit(rate, int(burst) if burst else max(1, math.ceil(rate)))
+
+
+def parse_limits(specs):
+    limits = {}
+    for item in filter(None, specs.split(',')):
+        route, _, spec = item.partition('=')
+        limits[route.strip()] = parse_limit(spec)
+    return limits
+
+
+class Decision:
+
+    def __init__(self, allowed, limit, remaining, reset, retry_after=0):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        self.retry_after = retry_after
+
+    def headers(self):
+        headers = {'RateLimit-Limit': str(self.limit.burst), 'RateLimit-Remaining': str(self.remaining),
+                   'RateLimit-Reset': str(math.ceil(self.reset))}
+        if not self.allowed:
+            headers['Retry-After'] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class RedisRateStore:
+    """Shared hit counters so several gateway processes see each other's traffic."""
+
+    def __init__(self, url=RATE_LIMIT_REDIS_URL, prefix='ratelimit:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def add(self, counts, ttl):
+        """Add local hit counts; returns the new shared totals in the same order."""
+        pipeline = self.client.pipeline(transaction=False)
+        for (route, client), count in counts:
+            key = f"{self.prefix}{route}:{client}"
+            pipeline.incrby(key, count)
+            pipeline.expire(key, ttl)
+        return pipeline.execute()[::2]
+
+
+class RateLimiter:
+
+    def __init__(self, enabled=RATE_LIMIT_ENABLED, default=RATE_LIMIT_DEFAULT, limits=RATE_LIMITS,
+                 backend=RATE_LIMIT_BACKEND, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.enabled = enabled
+        self.default = parse_limit(default) if default else None
+        self.limits = parse_limits(limits)
+        self.max_keys = max_keys
+        # (route, client) -> theoretical arrival time of the next request, in monotonic seconds
+        self.buckets = {}
+        self.evict_lock = threading.Lock()
+        self.store = RedisRateStore() if backend == 'redis' else None
+        # Admitted hits not yet pushed to the store; deque appends are atomic, so no lock
+        self.hits = deque()
+        # (route, client) -> shared total seen at the last sync
+        self.seen = {}
+        self._sync_thread = None
+        self.rejected = Counter('api_gateway_rate_limited_total', 'Requests refused by the per-client rate limit',
+                                ['route'], registry=None)
+
+    def register_metrics(self, registry):
+        registry.register(self.rejected)
+
+    def limit_for(self, route):
+        limit = self.limits.get(route)
+        if limit is None and route.startswith(LIMITED_PREFIX):
+            limit = self.default
+        return limit
+
+    @staticmethod
+    def client_key(user_id, remote_addr, forwarded_for=None):
+        address = forwarded_for.split(',')[0].strip() if RATE_LIMIT_TRUST_FORWARDED and forwarded_for else remote_addr
+        # The userId is unauthenticated: with the address in the key nobody can drain another
+        # user's bucket from elsewhere, though rotating userIds from one address still gets
+        # each a fresh bucket
+        if user_id:
+            return f"user:{user_id}@{address}"
+        return f"ip:{address}"
+
+    def check(self, route, client):
+        """Admit or refuse one request; returns a Decision, or None when the route is not limited."""
+        if not self.enabled:
+            return None
+        limit = self.limit_for(route)
+        if limit is None:
+            return None
+
+        key = (route, client)
+        now = time.monotonic()
+        arrival = max(self.buckets.get(key, now), now)
+        if arrival - now > limit.tolerance:
+            self.rejected.labels(route=route).inc()
+            return Decision(False, limit, 0, arrival - now, arrival - now - limit.tolerance)
+
+        arrival += limit.interval
+        self.buckets[key] = arrival
+        if self.store is not None:
+            self.hits.append(key)
+        if len(self.buckets) > self.max_keys:
+            self._evict(now)
+        return Decision(True, limit, math.floor((limit.tolerance - (arrival - now)) / limit.interval) + 1, arrival - now)
+
+    def _evict(self, now):
+        if not self.evict_lock.acquire(blocking=False):
+            return
+        try:
+            # A bucket whose arrival time has passed is full again, the same as a missing one
+            buckets = list(self.buckets.items())
+            for key, arrival in buckets:
+                if arrival <= now:
+                    self.buckets.pop(key, None)
+                    self.seen.pop(key, None)
+            # Still too many live clients: forget the fullest buckets, leaving headroom so the
+            # next sweep is not on the very next request
+            excess = len(self.buckets) - int(self.max_keys * 0.9)
+            if excess > 0:
+                for key, _ in sorted((item for item in buckets if item[1] > now), key=lambda item: item[1])[:excess]:
+                    self.buckets.pop(key, None)
+                    self.seen.pop(key, None)
+        finally:
+            self.evict_lock.release()
+
+    def sync(self):
+        counts = Tally()
+        while self.hits:
+            counts[self.hits.popleft()] += 1
+        if not counts:
+            return
+        counts = list(counts.items())
+        # Shared counters outlive the longest bucket a little, then expire
+        ttl = int(max(limit.burst * limit.interval for limit in [self.default, *self.limits.values()] if limit)) + 60
+        totals = self.store.add(counts, ttl)
+
+        now = time.monotonic()
+        for (key, count), total in zip(counts, totals):
+            previous = self.seen.get(key)
+            self.seen[key] = total
+            if previous is None:
+                continue
+            # Whatever the shared counter grew by beyond our own hits came from other processes
+            others = total - previous - count
+            limit = self.limit_for(key[0])
+            if others > 0 and limit is not None:
+                self.buckets[key] = max(self.buckets.get(key, now), now) + others * limit.interval
+
+    def start(self, interval=RATE_LIMIT_SYNC_INTERVAL):
+        if self.store is None or self._sync_thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sync()
+                except Exception as e:
+                    # Keep limiting locally while the shared store is unreachable
+                    log.warning("Rate limit sync failed: %s", e)
+
+        self._sync_thread = threading.Thread(target=run, name='rate-limit-sync', daemon=True)
+        self._sync_thread.start()
@@ -0,0 +1,137 @@
+# api-gateway/retry_policy.py
+#
+# Retry pacing for call_service_with_retry: exponential backoff with decorrelated jitter,
+# one deadline for the whole request, and a per-service retry budget so retries stay a
+# bounded fraction of successful traffic while an upstream is struggling.
+
+import os
+import random
+import threading
+import time
+
+from prometheus_client import Counter
+
+RETRIES_PER_INSTANCE = int(os.environ.get('RETRIES_PER_INSTANCE', 5))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.05))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 2))
+# Total time a request may spend on upstream attempts and backoff
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 10))
+# Cap for a single attempt, within the remaining deadline
+ATTEMPT_TIMEOUT = float(os.environ.get('ATTEMPT_TIMEOUT', 5))
+# Each successful request earns this many retries, up to RETRY_BUDGET_BURST banked
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0.2))
+RETRY_BUDGET_BURST = float(os.environ.get('RETRY_BUDGET_BURST', 10))
+
+
+class RetriesExhaustedError(Exception):
+    """Raised when the deadline or the retry budget stops a request before an instance answered."""
+
+
+class RetryBudget:
+    """Token bucket: successes deposit a fraction of a token, every retry withdraws one."""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, burst=RETRY_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_withdraw(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class RetryState:
+    """Per-request view of the policy: counts attempts, paces retries and tracks the deadline."""
+
+    def __init__(self, policy, service_type):
+        self.policy = policy
+        self.service_type = service_type
+        self.deadline = time.monotonic() + policy.deadline
+        self.attempts = 0
+        self.previous_delay = policy.base_delay
+        self.stop_reason = None
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def attempt_timeout(self):
+        return max(min(self.policy.attempt_timeout, self.remaining()), 0.001)
+
+    def next_delay(self):
+        """Call before every attempt. Returns the backoff to sleep first, or None to give up."""
+        if self.attempts == 0:
+            self.attempts = 1
+            return 0.0
+
+        remaining = self.remaining()
+        if remaining <= 0:
+            return self._stop('deadline')
+
+        # Decorrelated jitter: grows roughly 3x per retry but never synchronises callers
+        delay = min(self.policy.max_delay, random.uniform(self.policy.base_delay, self.previous_delay * 3))
+        if delay >= remaining:
+            return self._stop('deadline')
+
+        if not self.policy.budget(self.service_type).try_withdraw():
+            return self._stop('budget')
+
+        self.previous_delay = delay
+        self.attempts += 1
+        self.policy.retries.labels(service=self.service_type).inc()
+        return delay
+
+    def _stop(self, reason):
+        self.stop_reason = reason
+        self.policy.stopped.labels(service=self.service_type, reason=reason).inc()
+        return None
+
+    def succeeded(self):
+        self.policy.budget(self.service_type).deposit()
+
+    def exhausted_error(self):
+        return RetriesExhaustedError(
+            f"Retries stopped by {self.stop_reason} after {self.attempts} attempts to {self.service_type}")
+
+
+class RetryPolicy:
+
+    def __init__(self, retries_per_instance=RETRIES_PER_INSTANCE, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, deadline=REQUEST_DEADLINE, attempt_timeout=ATTEMPT_TIMEOUT,
+                 budget_ratio=RETRY_BUDGET_RATIO, budget_burst=RETRY_BUDGET_BURST):
+        self.retries_per_instance = retries_per_instance
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.budgets = {}
+        self.lock = threading.Lock()
+
+        self.retries = Counter('api_gateway_upstream_retries_total', 'Upstream retries sent after a failed attempt',
+                               ['service'], registry=None)
+        self.stopped = Counter('api_gateway_upstream_retries_stopped_total',
+                               'Requests whose retries were cut short by the deadline or the retry budget',
+                               ['service', 'reason'], registry=None)
+
+    def register_metrics(self, registry):
+        registry.register(self.retries)
+        registry.register(self.stopped)
+
+    def budget(self, service_type):
+        budget = self.budgets.get(service_type)
+        if budget is None:
+            with self.lock:
+                budget = self.budgets.setdefault(service_type, RetryBudget(self.budget_ratio, self.budget_burst))
+        return budget
+
+    def start(self, service_type):
+        return RetryState(self, service_type)
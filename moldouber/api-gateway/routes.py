@@ -0,0 +1,142 @@
+# api-gateway/routes.py
+#
+# The proxied routes of both gateways as one table: gateway path -> upstream service type and
+# endpoint, with the request schema taken from the message the upstream expects in
+# proto/*.proto. Each schema is compiled once at import into a validator that checks the
+# client's body and builds the upstream payload, so malformed requests are rejected before any
+# upstream work. app.py and async_app.py register a handler for every entry; a new proxied
+# endpoint only needs a new Route here.
+
+from google.protobuf.descriptor import FieldDescriptor
+
+import user_location_pb2
+import ride_payment_pb2
+
+MISSING_FIELDS = "Missing required fields"
+
+# Largest finite value of a proto float (32-bit); anything bigger would arrive as inf
+FLOAT32_MAX = 3.4028234663852886e38
+DOUBLE_MAX = 1.7976931348623157e308
+
+
+class RequestInvalid(ValueError):
+    """The request body does not match the route's schema."""
+
+
+class SchemaError(TypeError):
+    """A route's request message uses a field the gateway cannot validate."""
+
+
+def _number(limit):
+    # bool is a subclass of int, so compare types exactly; NaN and inf fail the range check
+    return lambda value: (type(value) is float or type(value) is int) and -limit <= value <= limit
+
+
+def _integer(low, high):
+    return lambda value: type(value) is int and low <= value <= high
+
+
+# Proto scalar type -> (check, what the error message says the value must be)
+_FIELD_CHECKS = {
+    FieldDescriptor.TYPE_STRING: (lambda value: type(value) is str, "a string"),
+    FieldDescriptor.TYPE_FLOAT: (_number(FLOAT32_MAX), "a number"),
+    FieldDescriptor.TYPE_DOUBLE: (_number(DOUBLE_MAX), "a number"),
+    FieldDescriptor.TYPE_INT32: (_integer(-2 ** 31, 2 ** 31 - 1), "a 32-bit integer"),
+    FieldDescriptor.TYPE_SINT32: (_integer(-2 ** 31, 2 ** 31 - 1), "a 32-bit integer"),
+    FieldDescriptor.TYPE_UINT32: (_integer(0, 2 ** 32 - 1), "an unsigned 32-bit integer"),
+    FieldDescriptor.TYPE_INT64: (_integer(-2 ** 63, 2 ** 63 - 1), "a 64-bit integer"),
+    FieldDescriptor.TYPE_SINT64: (_integer(-2 ** 63, 2 ** 63 - 1), "a 64-bit integer"),
+    FieldDescriptor.TYPE_UINT64: (_integer(0, 2 ** 64 - 1), "an unsigned 64-bit integer"),
+    FieldDescriptor.TYPE_BOOL: (lambda value: type(value) is bool, "a boolean"),
+}
+
+
+def _is_repeated(field):
+    # protobuf >= 6 deprecates label in favour of is_repeated
+    if hasattr(field, 'is_repeated'):
+        return field.is_repeated
+    return field.label == FieldDescriptor.LABEL_REPEATED
+
+
+def compile_schema(message, required=()):
+    """Validator for a JSON body shaped like the proto message.
+
+    The validator returns the upstream payload: the message's fields present in the body, with
+    anything else dropped. Required fields must be present, non-null and not an empty string;
+    zero is a valid number. Raises RequestInvalid otherwise.
+    """
+    descriptor = message.DESCRIPTOR
+    unknown = set(required) - set(descriptor.fields_by_name)
+    if unknown:
+        raise SchemaError(f"{descriptor.full_name} has no field {', '.join(sorted(unknown))}")
+
+    fields = []
+    for field in descriptor.fields:
+        if _is_repeated(field) or field.type not in _FIELD_CHECKS:
+            raise SchemaError(f"{descriptor.full_name}.{field.name}: only singular scalar fields are supported")
+        check, expected = _FIELD_CHECKS[field.type]
+        fields.append((field.name, check, f"Field '{field.name}' must be {expected}", field.name in required))
+    fields = tuple(fields)
+
+    def validate(data):
+        if type(data) is not dict:
+            raise RequestInvalid("Expected a JSON object")
+        payload = {}
+        for name, check, error, is_required in fields:
+            value = data.get(name)
+            if value is None or (is_required and value == ''):
+                if is_required:
+                    raise RequestInvalid(MISSING_FIELDS)
+                continue
+            if not check(value):
+                raise RequestInvalid(error)
+            payload[name] = value
+        return payload
+
+    return validate
+
+
+class Route:
+    """One proxied POST route and the upstream call behind it."""
+
+    def __init__(self, path, service_type, endpoint, message, required=(), idempotent=True,
+                 batch_path=None, batch_key=None, invalidates_payment_status=False,
+                 reads_payment_status=False, any_error_unavailable=False):
+        self.path = path
+        self.name = path.rsplit('/', 1)[-1]
+        self.service_type = service_type
+        self.endpoint = endpoint
+        self.validate = compile_schema(message, required)
+        # Replay responses for repeated Idempotency-Keys
+        self.idempotent = idempotent
+        # Also served as a batch route taking {batch_key: [body, ...]}
+        self.batch_path = batch_path
+        self.batch_name = batch_path.rsplit('/', 1)[-1] if batch_path else None
+        self.batch_key = batch_key
+        # A successful call changes the ride's payment status, so its cached status is dropped
+        self.invalidates_payment_status = invalidates_payment_status
+        # Goes through the payment status cache; an unknown ride is reported as not paid
+        self.reads_payment_status = reads_payment_status
+        # Report every upstream failure as 503, not only transport errors
+        self.any_error_unavailable = any_error_unavailable
+
+
+ROUTES = (
+    Route('/api/user/make_order', 'user-location', 'make_order', user_location_pb2.OrderRequest,
+          required=('userId', 'startLongitude', 'startLatitude', 'endLongitude', 'endLatitude')),
+    Route('/api/user/accept_order', 'user-location', 'accept_order', user_location_pb2.AcceptOrderRequest,
+          required=('orderId', 'driverId'),
+          batch_path='/api/user/accept_orders', batch_key='orders'),
+    Route('/api/user/finish_order', 'user-location', 'finish_order', user_location_pb2.FinishOrderRequest,
+          required=('rideId', 'realPrice')),
+    Route('/api/ride/pay', 'ride-payment', 'pay_ride', ride_payment_pb2.PayRideRequest,
+          required=('rideId', 'amount', 'userId'),
+          invalidates_payment_status=True),
+    Route('/api/ride/process_payment', 'ride-payment', 'process_payment', ride_payment_pb2.ProcessPaymentRequest,
+          required=('rideId',),
+          batch_path='/api/ride/process_payments', batch_key='payments',
+          invalidates_payment_status=True, any_error_unavailable=True),
+    Route('/api/user/check_payment_status', 'user-location', 'payment_check', user_location_pb2.PaymentCheckRequest,
+          required=('rideId',), idempotent=False,
+          reads_payment_status=True),
+)
@@ -0,0 +1,648 @@
+# api-gateway/saga.py
+#
+# Saga orchestration for /api/saga. Steps form a DAG: a step starts as soon as the steps it
+# depends on have succeeded, so independent forward actions run concurrently. On failure no
+# new step starts, in-flight steps are allowed to finish, and every succeeded step is
+# compensated once all of its succeeded dependents have been, so independent branches also
+# roll back concurrently.
+#
+# Steps without "dependsOn" depend on the step before them, which keeps the old strictly
+# sequential behaviour for existing clients.
+#
+# With a SagaLog every step transition is persisted before the saga moves on, so sagas left
+# unfinished by a crash are resumed (or compensated, when a step's outcome is unknown) by
+# the recovery loop, and a saga can run in the background while the client polls it. A step
+# that was started but never finished may or may not have taken effect, so it is compensated
+# along with the succeeded ones; compensations must therefore be idempotent. A recovered
+# saga's deadline still counts from its original created_at, so one recovered after more than
+# its deadline of downtime is compensated rather than resumed.
+
+import asyncio
+import contextlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from prometheus_client import Histogram
+
+import fast_json
+from saga_log import SagaExists, SAGA_LOG_RETENTION
+from status_cache import TTLCache
+from structured_log import get_logger, fields, submit_in_context
+import tracing
+
+# Whole-saga deadline for forward actions; a request may lower it with "deadline"
+SAGA_DEADLINE = float(os.environ.get('SAGA_DEADLINE', 30))
+# Default per-step timeout; a step may set its own with "timeout"
+SAGA_STEP_TIMEOUT = float(os.environ.get('SAGA_STEP_TIMEOUT', 10))
+# Compensations run even after the saga deadline, each bounded by this
+SAGA_COMPENSATION_TIMEOUT = float(os.environ.get('SAGA_COMPENSATION_TIMEOUT', 10))
+# Upstream calls in flight across all sagas in sync mode
+SAGA_MAX_PARALLEL = int(os.environ.get('SAGA_MAX_PARALLEL', 32))
+# Sagas run in the background (202 Accepted or recovered) at once in sync mode
+SAGA_BACKGROUND_WORKERS = int(os.environ.get('SAGA_BACKGROUND_WORKERS', 16))
+# How often running sagas are heartbeated and orphaned ones looked for; a saga whose owner
+# missed three heartbeats is taken over
+SAGA_RECOVERY_INTERVAL = float(os.environ.get('SAGA_RECOVERY_INTERVAL', 10))
+# Without a saga log, this many finished sagas stay pollable (and their transactionIds taken)
+# in memory for SAGA_LOG_RETENTION seconds
+SAGA_FINISHED_RUNS = int(os.environ.get('SAGA_FINISHED_RUNS', 10000))
+
+log = get_logger('saga')
+
+STEP_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class SagaDefinitionError(ValueError):
+    """Raised for a malformed steps list: missing fields, unknown dependencies or a cycle."""
+
+
+class StepFailed(Exception):
+    """A forward action failed, timed out or answered with anything but status 'success'."""
+
+
+class SagaStep:
+
+    def __init__(self, name, forward, compensate, depends_on, timeout):
+        self.name = name
+        self.forward = forward
+        self.compensate = compensate
+        self.depends_on = depends_on
+        self.timeout = timeout
+
+    def to_dict(self):
+        """The step in request form with every default spelled out, as stored in the saga log."""
+        step = {"name": self.name, "forward": self.forward, "dependsOn": self.depends_on, "timeout": self.timeout}
+        if self.compensate is not None:
+            step["compensate"] = self.compensate
+        return step
+
+
+def _positive(value, what):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise SagaDefinitionError(f"{what} must be a number")
+    if value <= 0:
+        raise SagaDefinitionError(f"{what} must be positive")
+    return value
+
+
+def _action(step, key, name, required):
+    action = step.get(key)
+    if action is None and not required:
+        return None
+    if not isinstance(action, dict) or not action.get('url'):
+        raise SagaDefinitionError(f"Step {name} needs a {key} action with a url")
+    return action
+
+
+def parse_steps(steps):
+    """Validate the request's steps and return them as SagaStep objects in request order."""
+    if not isinstance(steps, list) or not steps:
+        raise SagaDefinitionError("steps must be a non-empty list")
+
+    parsed = []
+    previous = None
+    for step in steps:
+        if not isinstance(step, dict) or not step.get('name'):
+            raise SagaDefinitionError("Every step needs a name")
+        name = step['name']
+        if any(existing.name == name for existing in parsed):
+            raise SagaDefinitionError(f"Duplicate step name {name}")
+
+        if 'dependsOn' in step:
+            depends_on = step['dependsOn']
+            if not isinstance(depends_on, list):
+                raise SagaDefinitionError(f"dependsOn of step {name} must be a list")
+        else:
+            depends_on = [previous] if previous is not None else []
+
+        timeout = _positive(step['timeout'], f"timeout of step {name}") if 'timeout' in step else SAGA_STEP_TIMEOUT
+        parsed.append(SagaStep(name, _action(step, 'forward', name, True), _action(step, 'compensate', name, False),
+                               list(depends_on), timeout))
+        previous = name
+
+    names = {step.name for step in parsed}
+    for step in parsed:
+        for dependency in step.depends_on:
+            if dependency not in names:
+                raise SagaDefinitionError(f"Step {step.name} depends on unknown step {dependency}")
+
+    # Kahn's algorithm: anything left unvisited sits on a cycle
+    remaining = {step.name: set(step.depends_on) for step in parsed}
+    ready = [name for name, deps in remaining.items() if not deps]
+    visited = 0
+    while ready:
+        name = ready.pop()
+        visited += 1
+        for other, deps in remaining.items():
+            if name in deps:
+                deps.discard(name)
+                if not deps:
+                    ready.append(other)
+    if visited != len(parsed):
+        raise SagaDefinitionError("Step dependencies contain a cycle")
+    return parsed
+
+
+def saga_deadline(requested):
+    """The saga deadline for a request's optional "deadline", never above SAGA_DEADLINE."""
+    if requested is None:
+        return SAGA_DEADLINE
+    return min(_positive(requested, "deadline"), SAGA_DEADLINE)
+
+
+class SagaRun:
+    """Progress of one saga: results, compensations and timings, in response shape."""
+
+    def __init__(self, transaction_id, steps, deadline=SAGA_DEADLINE, created_at=None):
+        self.transaction_id = transaction_id
+        self.steps = steps
+        self.by_name = {step.name: step for step in steps}
+        self.deadline_seconds = deadline
+        self.created_at = created_at if created_at is not None else time.time()
+        self.started = time.monotonic() - (time.time() - self.created_at)
+        self.deadline = self.started + deadline
+        self.finished = None
+        self.status = 'running'
+        self.reason = None
+        # Names of steps whose forward action succeeded, in completion order
+        self.succeeded = []
+        # Names of steps whose forward action was in flight when the gateway died
+        self.outcome_unknown = set()
+        # Names of steps whose compensation already ran, successfully or not
+        self.compensated = set()
+        self.results = {}
+        self.compensations = {}
+        self.timings = {}
+
+    @classmethod
+    def restore(cls, saga, events):
+        """Rebuild a run from its SagaLog row and events."""
+        run = cls(saga['transaction_id'], parse_steps(saga['steps']), saga['deadline'], saga['created_at'])
+        run.status = saga['status']
+        run.reason = saga['reason']
+        started = set()
+        failed = []
+        for event in events:
+            name, kind, data = event['step'], event['kind'], event['data'] or {}
+            operation = kind.split('_')[0]
+            if kind.endswith('_started'):
+                if operation == 'forward':
+                    started.add(name)
+                continue
+            if 'seconds' in data:
+                run.record_timing(name, operation, data['seconds'])
+            if operation == 'forward':
+                started.discard(name)
+                if 'result' in data:
+                    run.results[name] = data['result']
+                if kind == 'forward_success':
+                    run.succeeded.append(name)
+                else:
+                    failed.append(name)
+            else:
+                run.compensated.add(name)
+                if 'compensation' in data:
+                    run.compensations[run.by_name[name].compensate['url']] = data['compensation']
+        if run.status in ('completed', 'failed'):
+            run.finished = run.started + (saga['updated_at'] - saga['created_at'])
+        elif run.status == 'running' and failed:
+            run.reason = f"Step {failed[0]} failed"
+        elif run.status == 'running' and started:
+            # The gateway died while these calls were in flight; treat them like a timed-out step
+            run.reason = f"Step {', '.join(sorted(started))} failed: outcome unknown after gateway restart"
+        # They may have taken effect, so they are rolled back like succeeded steps
+        run.outcome_unknown = started
+        return run
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def record_timing(self, name, operation, seconds):
+        self.timings.setdefault(name, {})[operation] = round(seconds, 6)
+
+    def forward_batch(self, done, pending, failed):
+        """Steps that may start now: all dependencies done, no failure seen."""
+        if failed:
+            return []
+        return [step for step in self.steps if step.name in pending and all(d in done for d in step.depends_on)]
+
+    def to_compensate(self):
+        """Steps that may have taken effect and are not compensated yet."""
+        return (set(self.succeeded) | self.outcome_unknown) - self.compensated
+
+    def compensation_batch(self, remaining, busy):
+        """Succeeded steps none of whose succeeded dependents still await compensation."""
+        blocked = remaining | busy
+        return [name for name in remaining
+                if not any(name in self.by_name[other].depends_on for other in blocked)]
+
+    def duration(self):
+        return (self.finished if self.finished is not None else time.monotonic()) - self.started
+
+    def response(self):
+        body = {"status": self.status, "results": self.results, "timings": self.timings,
+                "durationSeconds": round(self.duration(), 6)}
+        if self.status == 'completed':
+            return body, 200
+        body["reason"] = self.reason
+        body["compensations"] = self.compensations
+        return body, 500
+
+    def snapshot(self):
+        """Current state for GET /api/saga/<transactionId>; safe while step threads still write."""
+        return {"transactionId": self.transaction_id, "status": self.status, "reason": self.reason,
+                "results": dict(self.results), "compensations": dict(self.compensations),
+                "timings": {name: dict(timing) for name, timing in list(self.timings.items())},
+                "durationSeconds": round(self.duration(), 6)}
+
+
+class _ForwardSchedule:
+    """Which forward steps may start and what their outcomes mean, for the thread and task loops."""
+
+    def __init__(self, run):
+        self.run = run
+        self.done = set(run.succeeded)
+        self.pending = {step.name for step in run.steps} - self.done
+        self.failure = None
+
+    def ready(self):
+        batch = self.run.forward_batch(self.done, self.pending, self.failure is not None)
+        for step in batch:
+            self.pending.discard(step.name)
+        return batch
+
+    def finished(self, step, future):
+        """Take the outcome of a finished Future or Task."""
+        try:
+            future.result()
+            self.done.add(step.name)
+            self.run.succeeded.append(step.name)
+        except StepFailed as e:
+            self.failure = self.failure or str(e)
+
+
+class _CompensationSchedule:
+    """Which compensations may start, for the thread and task loops."""
+
+    def __init__(self, run):
+        self.run = run
+        self.remaining = run.to_compensate()
+        self.busy = set()
+
+    def ready(self):
+        steps = []
+        while not steps:
+            batch = self.run.compensation_batch(self.remaining, self.busy)
+            if not batch:
+                break
+            for name in batch:
+                self.remaining.discard(name)
+                step = self.run.by_name[name]
+                # Steps without a compensation stay in the ordering so they still hold back their dependencies
+                if step.compensate is not None:
+                    self.busy.add(name)
+                    steps.append(step)
+        return steps
+
+    def finished(self, step):
+        self.busy.discard(step.name)
+
+
+class SagaOrchestrator:
+
+    def __init__(self, pools, async_pools, log=None, max_parallel=SAGA_MAX_PARALLEL,
+                 compensation_timeout=SAGA_COMPENSATION_TIMEOUT, background_workers=SAGA_BACKGROUND_WORKERS,
+                 finished_runs=SAGA_FINISHED_RUNS, retention=SAGA_LOG_RETENTION):
+        self.pools = pools
+        self.async_pools = async_pools
+        self.log = log
+        self.compensation_timeout = compensation_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='saga-step')
+        # Separate from the step pool: a coordinator waiting on its steps must never hold a step slot
+        self.runners = ThreadPoolExecutor(max_workers=background_workers, thread_name_prefix='saga-runner')
+        # transaction id -> SagaRun for sagas executing in this process
+        self.active = {}
+        # transaction id -> finished SagaRun, kept only when there is no log to load it from
+        self.finished = TTLCache(finished_runs, retention) if log is None else None
+        self.lock = threading.Lock()
+        self.tasks = set()
+        self._recovery = None
+        self.step_duration = Histogram('api_gateway_saga_step_duration_seconds', 'Saga step latency',
+                                       ['operation', 'outcome'], buckets=STEP_BUCKETS, registry=None)
+        self.saga_duration = Histogram('api_gateway_saga_duration_seconds', 'End-to-end saga latency',
+                                       ['outcome'], buckets=STEP_BUCKETS, registry=None)
+
+    def register_metrics(self, registry):
+        registry.register(self.step_duration)
+        registry.register(self.saga_duration)
+
+    # Bookkeeping shared by both modes
+
+    def _begin(self, run):
+        """Register a new saga, raising SagaExists if its transaction id was used before."""
+        with self.lock:
+            if run.transaction_id in self.active or (self.finished is not None
+                                                      and self.finished.get(run.transaction_id) is not None):
+                raise SagaExists(f"Saga {run.transaction_id} already exists")
+            if self.log is not None:
+                self.log.create(run.transaction_id, [step.to_dict() for step in run.steps], run.deadline_seconds,
+                                run.created_at)
+            self.active[run.transaction_id] = run
+
+    def _record(self, run, step, kind, data=None):
+        if self.log is not None:
+            self.log.event(run.transaction_id, step.name, kind, data)
+
+    def _set_status(self, run, status, reason=None):
+        run.status = status
+        run.reason = reason
+        if self.log is not None:
+            self.log.set_status(run.transaction_id, status, reason)
+
+    def _step_timeout(self, run, step):
+        timeout = min(step.timeout, run.remaining())
+        if timeout <= 0:
+            raise StepFailed(f"Step {step.name} failed: saga deadline exceeded")
+        return timeout
+
+    def _finish_forward(self, run, step, response):
+        step_result = fast_json.parse_response(response)
+        if not isinstance(step_result, dict):
+            step_result = {"response": step_result}
+        # Include operation in the response for clarity
+        step_result['operation'] = 'forward'
+        run.results[step.name] = step_result
+        if response.status_code != 200 or step_result.get('status') != 'success':
+            raise StepFailed(f"Step {step.name} failed")
+
+    @contextlib.contextmanager
+    def _forwarding(self, run, step):
+        """Span, log events and timing around one forward call; yields the call's timeout.
+
+        Any failure inside leaves as StepFailed.
+        """
+        with tracing.span('saga.forward', transaction_id=run.transaction_id, step=step.name,
+                          url=step.forward['url']):
+            started = time.monotonic()
+            outcome = 'failed'
+            try:
+                timeout = self._step_timeout(run, step)
+                log.debug("Executing forward action",
+                          extra=fields(transaction_id=run.transaction_id, step=step.name, url=step.forward['url']))
+                self._record(run, step, 'forward_started')
+                yield timeout
+                outcome = 'success'
+            except StepFailed:
+                raise
+            except Exception as e:
+                # asyncio.TimeoutError has an empty message
+                raise StepFailed(f"Step {step.name} failed: {str(e) or type(e).__name__}")
+            finally:
+                self._observe(run, step, 'forward', started, outcome)
+
+    @contextlib.contextmanager
+    def _compensating(self, run, step):
+        """Span, log events and timing around one compensate call; a failure is recorded, not raised."""
+        with tracing.span('saga.compensate', transaction_id=run.transaction_id, step=step.name,
+                          url=step.compensate['url']) as span:
+            started = time.monotonic()
+            outcome = 'failed'
+            try:
+                log.debug("Executing compensate action",
+                          extra=fields(transaction_id=run.transaction_id, step=step.name, url=step.compensate['url']))
+                self._record(run, step, 'compensate_started')
+                yield
+                self._compensated(run, step)
+                outcome = 'success'
+            except Exception as e:
+                span.set_error(e)
+                self._compensation_failed(run, step, e)
+            finally:
+                self._observe(run, step, 'compensate', started, outcome)
+
+    def _observe(self, run, step, operation, started, outcome):
+        elapsed = time.monotonic() - started
+        run.record_timing(step.name, operation, elapsed)
+        # Step names come from the request body, so they stay out of the labels; per-step timings
+        # are in the saga's response and its trace
+        self.step_duration.labels(operation=operation, outcome=outcome).observe(elapsed)
+        data = {"seconds": round(elapsed, 6)}
+        if operation == 'forward':
+            if step.name in run.results:
+                data["result"] = run.results[step.name]
+        else:
+            run.compensated.add(step.name)
+            data["compensation"] = run.compensations.get(step.compensate['url'])
+        self._record(run, step, f"{operation}_{outcome}", data)
+
+    def _compensated(self, run, step):
+        compensation = step.compensate
+        transaction_id = (compensation.get('payload') or {}).get('transactionId', run.transaction_id)
+        run.compensations[compensation['url']] = {
+            "status": "compensated",
+            "operation": "compensate",
+            "message": f"Compensate operation completed for transaction {transaction_id}"
+        }
+
+    def _compensation_failed(self, run, step, error):
+        log.error("Compensation failed: %s", error,
+                  extra=fields(transaction_id=run.transaction_id, step=step.name, url=step.compensate['url']))
+        run.compensations[step.compensate['url']] = {
+            "status": "failed",
+            "operation": "compensate",
+            "reason": str(error)
+        }
+
+    def _failed(self, run, failure):
+        if run.status != 'compensating':
+            self._set_status(run, 'compensating', failure)
+
+    def _finish(self, run, failure):
+        run.finished = time.monotonic()
+        self._set_status(run, 'completed' if failure is None else 'failed', failure)
+        self.saga_duration.labels(outcome=run.status).observe(run.duration())
+        with self.lock:
+            self.active.pop(run.transaction_id, None)
+            if self.finished is not None:
+                self.finished.put(run.transaction_id, run)
+        return run.response()
+
+    def status(self, transaction_id):
+        """Snapshot of a running or logged saga, or None if it is unknown."""
+        run = self.active.get(transaction_id)
+        if run is None and self.finished is not None:
+            with self.lock:
+                run = self.finished.get(transaction_id)
+        if run is None and self.log is not None:
+            logged = self.log.load(transaction_id)
+            if logged is not None:
+                run = SagaRun.restore(*logged)
+        return run.snapshot() if run is not None else None
+
+    def _orphans(self):
+        """Claim sagas left unfinished by a dead gateway and return them ready to resume."""
+        if self.log is None:
+            return []
+        with self.lock:
+            self.log.heartbeat(list(self.active))
+            claimed = self.log.claim_orphans(set(self.active), 3 * SAGA_RECOVERY_INTERVAL)
+        self.log.prune()
+        runs = []
+        for transaction_id in claimed:
+            run = SagaRun.restore(*self.log.load(transaction_id))
+            log.info("Recovering saga", extra=fields(transaction_id=transaction_id, status=run.status))
+            with self.lock:
+                self.active[transaction_id] = run
+            runs.append(run)
+        return runs
+
+    # Sync mode: step calls go to a shared thread pool, the request thread coordinates
+
+    def _forward(self, run, step):
+        with self._forwarding(run, step) as timeout:
+            response = self.pools.post(step.forward['url'], json=step.forward.get('payload'), timeout=timeout,
+                                       headers=tracing.inject())
+            self._finish_forward(run, step, response)
+
+    def _compensate(self, run, step):
+        with self._compensating(run, step):
+            self.pools.post(step.compensate['url'], json=step.compensate.get('payload'),
+                            timeout=self.compensation_timeout, headers=tracing.inject())
+
+    def run_forward(self, run):
+        """Run every forward action not yet succeeded; returns the failure reason or None."""
+        schedule = _ForwardSchedule(run)
+        in_flight = {}
+        while True:
+            for step in schedule.ready():
+                in_flight[submit_in_context(self.executor, self._forward, run, step)] = step
+            if not in_flight:
+                return schedule.failure
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                schedule.finished(in_flight.pop(future), future)
+
+    def run_compensations(self, run):
+        schedule = _CompensationSchedule(run)
+        in_flight = {}
+        while True:
+            for step in schedule.ready():
+                in_flight[submit_in_context(self.executor, self._compensate, run, step)] = step
+            if not in_flight:
+                return
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                schedule.finished(in_flight.pop(future))
+
+    def execute(self, run):
+        # Recovered runs have no request around them and start a trace of their own
+        with tracing.span('saga', transaction_id=run.transaction_id) as span:
+            # A recovered run may already have failed, or be halfway through compensating
+            failure = run.reason or self.run_forward(run)
+            if failure is not None:
+                span.set_error(failure)
+                self._failed(run, failure)
+                self.run_compensations(run)
+            return self._finish(run, failure)
+
+    def run(self, run):
+        """Execute the saga and return (body, status_code) for the response."""
+        self._begin(run)
+        return self.execute(run)
+
+    def submit(self, run):
+        """Start the saga in the background; poll it with status()."""
+        self._begin(run)
+        submit_in_context(self.runners, self.execute, run)
+
+    def start_recovery(self, interval=SAGA_RECOVERY_INTERVAL):
+        if self._recovery is not None or self.log is None:
+            return
+
+        def recover():
+            while True:
+                try:
+                    for run in self._orphans():
+                        self.runners.submit(self.execute, run)
+                except Exception as e:
+                    log.exception("Saga recovery failed: %s", e)
+                time.sleep(interval)
+
+        self._recovery = threading.Thread(target=recover, name='saga-recovery', daemon=True)
+        self._recovery.start()
+
+    # Async mode: the same scheduling with tasks on the event loop
+
+    async def _forward_async(self, run, step):
+        with self._forwarding(run, step) as timeout:
+            response = await self.async_pools.post(step.forward['url'], json=step.forward.get('payload'),
+                                                   timeout=timeout, headers=tracing.inject())
+            self._finish_forward(run, step, response)
+
+    async def _compensate_async(self, run, step):
+        with self._compensating(run, step):
+            await self.async_pools.post(step.compensate['url'], json=step.compensate.get('payload'),
+                                        timeout=self.compensation_timeout, headers=tracing.inject())
+
+    async def run_forward_async(self, run):
+        schedule = _ForwardSchedule(run)
+        in_flight = {}
+        while True:
+            for step in schedule.ready():
+                in_flight[asyncio.ensure_future(self._forward_async(run, step))] = step
+            if not in_flight:
+                return schedule.failure
+            finished, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                schedule.finished(in_flight.pop(task), task)
+
+    async def run_compensations_async(self, run):
+        schedule = _CompensationSchedule(run)
+        in_flight = {}
+        while True:
+            for step in schedule.ready():
+                in_flight[asyncio.ensure_future(self._compensate_async(run, step))] = step
+            if not in_flight:
+                return
+            finished, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                schedule.finished(in_flight.pop(task))
+
+    async def execute_async(self, run):
+        with tracing.span('saga', transaction_id=run.transaction_id) as span:
+            failure = run.reason or await self.run_forward_async(run)
+            if failure is not None:
+                span.set_error(failure)
+                self._failed(run, failure)
+                await self.run_compensations_async(run)
+            return self._finish(run, failure)
+
+    async def run_async(self, run):
+        self._begin(run)
+        return await self.execute_async(run)
+
+    def _spawn(self, run):
+        task = asyncio.ensure_future(self.execute_async(run))
+        # Keep a reference until it finishes so the task is not garbage collected
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def submit_async(self, run):
+        self._begin(run)
+        self._spawn(run)
+
+    async def recovery_loop_async(self, interval=SAGA_RECOVERY_INTERVAL):
+        # The log is local SQLite with short transactions, so it is called inline on the loop
+        if self.log is None:
+            return
+        while True:
+            try:
+                for run in self._orphans():
+                    self._spawn(run)
+            except Exception as e:
+                log.exception("Saga recovery failed: %s", e)
+            await asyncio.sleep(interval)
@@ -0,0 +1,183 @@
+# api-gateway/saga_log.py
+#
+# Durable saga log in a local SQLite file. Each saga has a row with its definition and
+# current status, plus one event per step transition (forward started / succeeded / failed,
+# compensation started / done / failed), so a gateway that died mid-saga can tell on restart
+# which steps took effect and which compensations are still owed.
+#
+# Every gateway process owns the sagas it runs and heartbeats them; a saga whose owner
+# stopped heartbeating, or that belongs to an earlier incarnation of this very process,
+# can be claimed and finished by another.
+#
+# The log is off unless SAGA_LOG_PATH names a file (docker-compose.yml keeps it on the
+# gateway's data volume). The file is opened on first use, not at import.
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+SAGA_LOG_PATH = os.environ.get('SAGA_LOG_PATH', '')
+# Finished sagas stay pollable for this long
+SAGA_LOG_RETENTION = float(os.environ.get('SAGA_LOG_RETENTION', 24 * 3600))
+
+UNFINISHED = ('running', 'compensating')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sagas (
+    transaction_id TEXT PRIMARY KEY,
+    steps TEXT NOT NULL,
+    deadline REAL NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT,
+    owner TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sagas_status ON sagas (status, updated_at);
+CREATE TABLE IF NOT EXISTS saga_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id TEXT NOT NULL,
+    step TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS saga_events_transaction ON saga_events (transaction_id, id);
+"""
+
+
+class SagaExists(Exception):
+    """A saga with this transactionId was already started."""
+
+
+class SagaLog:
+
+    def __init__(self, path=SAGA_LOG_PATH, owner=None):
+        self.path = path
+        self.fixed_owner = owner
+        self.db = None
+        self._reset()
+        # Workers forked from a preloading parent (gunicorn.conf.py) each need their own
+        # connection and own the sagas they run under their own pid
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.owner = self.fixed_owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.lock = threading.Lock()
+        # A connection inherited across fork must be neither used nor closed by the child, so
+        # it is only kept referenced
+        self.inherited = self.db
+        self.db = None
+
+    def _connection(self):
+        # Called with self.lock held; one connection shared by every thread, serialised by it
+        if self.db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            # A committed transition survives a process crash; only power loss can drop the last few
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+            self.db = db
+        return self.db
+
+    def create(self, transaction_id, steps, deadline, created_at):
+        with self.lock:
+            db = self._connection()
+            try:
+                db.execute('INSERT INTO sagas VALUES (?, ?, ?, ?, NULL, ?, ?, ?)',
+                           (transaction_id, json.dumps(steps), deadline, 'running', self.owner,
+                            created_at, created_at))
+            except sqlite3.IntegrityError:
+                raise SagaExists(f"Saga {transaction_id} already exists")
+
+    def event(self, transaction_id, step, kind, data=None):
+        now = time.time()
+        with self.lock:
+            db = self._connection()
+            db.execute('BEGIN')
+            db.execute('INSERT INTO saga_events (transaction_id, step, kind, data, at) VALUES (?, ?, ?, ?, ?)',
+                       (transaction_id, step, kind, json.dumps(data) if data is not None else None, now))
+            db.execute('UPDATE sagas SET updated_at = ? WHERE transaction_id = ?', (now, transaction_id))
+            db.execute('COMMIT')
+
+    def set_status(self, transaction_id, status, reason=None):
+        with self.lock:
+            db = self._connection()
+            db.execute('UPDATE sagas SET status = ?, reason = ?, updated_at = ? WHERE transaction_id = ?',
+                       (status, reason, time.time(), transaction_id))
+
+    def load(self, transaction_id):
+        """Return (saga row as a dict, [event dicts in order]) or None."""
+        with self.lock:
+            db = self._connection()
+            row = db.execute('SELECT transaction_id, steps, deadline, status, reason, owner, created_at, '
+                             'updated_at FROM sagas WHERE transaction_id = ?', (transaction_id,)).fetchone()
+            if row is None:
+                return None
+            events = db.execute('SELECT step, kind, data, at FROM saga_events WHERE transaction_id = ? '
+                                'ORDER BY id', (transaction_id,)).fetchall()
+        saga = dict(zip(('transaction_id', 'steps', 'deadline', 'status', 'reason', 'owner', 'created_at',
+                         'updated_at'), row))
+        saga['steps'] = json.loads(saga['steps'])
+        return saga, [{"step": step, "kind": kind, "data": json.loads(data) if data is not None else None, "at": at}
+                      for step, kind, data, at in events]
+
+    def heartbeat(self, transaction_ids):
+        """Mark this process's running sagas as alive so nobody else recovers them."""
+        if not transaction_ids:
+            return
+        now = time.time()
+        with self.lock:
+            db = self._connection()
+            db.execute('BEGIN')
+            db.executemany('UPDATE sagas SET updated_at = ? WHERE transaction_id = ? AND owner = ?',
+                           [(now, transaction_id, self.owner) for transaction_id in transaction_ids])
+            db.execute('COMMIT')
+
+    def claim_orphans(self, active, grace):
+        """Take over unfinished sagas nobody is running; returns their transaction ids.
+
+        A saga is orphaned when it belongs to this owner but is not in active (an earlier
+        process with the same host and pid), or its owner stopped heartbeating grace seconds ago.
+        """
+        now = time.time()
+        claimed = []
+        with self.lock:
+            db = self._connection()
+            rows = db.execute('SELECT transaction_id, owner, updated_at FROM sagas WHERE status IN (?, ?)',
+                              UNFINISHED).fetchall()
+            for transaction_id, owner, updated_at in rows:
+                if owner == self.owner:
+                    if transaction_id in active:
+                        continue
+                elif updated_at > now - grace:
+                    continue
+                # Compare-and-set so two processes cannot both claim the same saga
+                cursor = db.execute('UPDATE sagas SET owner = ?, updated_at = ? WHERE transaction_id = ? '
+                                    'AND owner = ? AND updated_at = ?',
+                                    (self.owner, now, transaction_id, owner, updated_at))
+                if cursor.rowcount:
+                    claimed.append(transaction_id)
+        return claimed
+
+    def prune(self, retention=SAGA_LOG_RETENTION):
+        cutoff = time.time() - retention
+        with self.lock:
+            db = self._connection()
+            db.execute('BEGIN')
+            db.execute('DELETE FROM saga_events WHERE transaction_id IN (SELECT transaction_id FROM sagas '
+                       'WHERE status NOT IN (?, ?) AND updated_at < ?)', UNFINISHED + (cutoff,))
+            db.execute('DELETE FROM sagas WHERE status NOT IN (?, ?) AND updated_at < ?', UNFINISHED + (cutoff,))
+            db.execute('COMMIT')
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
@@ -0,0 +1,37 @@
+# api-gateway/serve.py
+#
+# Entry point that picks the serving mode: the threaded Flask app (sync) or the aiohttp app (async),
+# on the single-process development server or on gunicorn workers (see gunicorn.conf.py).
+
+import argparse
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the API gateway')
+    parser.add_argument('--mode', choices=['sync', 'async'], default=os.environ.get('GATEWAY_MODE', 'sync'))
+    parser.add_argument('--server', choices=['dev', 'gunicorn'], default=os.environ.get('GATEWAY_SERVER', 'dev'))
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('GATEWAY_PORT', 5000)))
+    args = parser.parse_args()
+
+    if args.server == 'gunicorn':
+        # Workers, threads and the rest come from the GATEWAY_* settings in gunicorn.conf.py
+        os.environ.update(GATEWAY_MODE=args.mode, GATEWAY_HOST=args.host, GATEWAY_PORT=str(args.port))
+        os.execv(sys.executable, [sys.executable, '-m', 'gunicorn', '--config', os.path.join(HERE, 'gunicorn.conf.py'),
+                                  '--chdir', HERE])
+
+    # Only import the selected app, both export the same metric names
+    if args.mode == 'async':
+        import async_app
+        async_app.main(host=args.host, port=args.port)
+    else:
+        from app import app
+        app.run(host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# api-gateway/singleflight.py
+#
+# Collapse concurrent identical calls: the first caller for a key runs the function and
+# everyone who arrives while it is in flight waits for and shares its result (or exception).
+
+import asyncio
+import threading
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return (result, shared); shared is True when another caller's execution was reused."""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self, key):
+        return key in self.calls
+
+
+class AsyncSingleFlight:
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        """Await fn() once per key at a time; returns (result, shared) like SingleFlight.do."""
+        future = self.calls.get(key)
+        if future is not None:
+            # Shielded so one waiter being cancelled does not cancel the shared call
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await fn()
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so an unshared failure is not reported as never awaited
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.calls[key]
+        return result, False
+
+    def in_flight(self, key):
+        return key in self.calls
@@ -0,0 +1,147 @@
+# api-gateway/status_cache.py
+#
+# Payment status reads for check_payment_status. Identical reads that overlap share one
+# upstream call, and terminal statuses (which never change) are kept in a bounded LRU/TTL
+# cache until a payment for the ride succeeds again.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+import fast_json
+from singleflight import SingleFlight, AsyncSingleFlight
+
+PAYMENT_STATUS_CACHE_SIZE = int(os.environ.get('PAYMENT_STATUS_CACHE_SIZE', 10000))
+PAYMENT_STATUS_CACHE_TTL = float(os.environ.get('PAYMENT_STATUS_CACHE_TTL', 30))
+TERMINAL_PAYMENT_STATUSES = set(filter(None, os.environ.get('TERMINAL_PAYMENT_STATUSES', 'Paid,orderPaid').split(',')))
+
+
+class TTLCache:
+    """LRU bounded to max_entries whose entries also expire ttl seconds after being stored."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if time.monotonic() >= expires_at:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+
+class PaymentStatusCache:
+
+    def __init__(self, max_entries=PAYMENT_STATUS_CACHE_SIZE, ttl=PAYMENT_STATUS_CACHE_TTL,
+                 terminal_statuses=TERMINAL_PAYMENT_STATUSES):
+        self.cache = TTLCache(max_entries, ttl)
+        self.terminal_statuses = terminal_statuses
+        self.lock = threading.Lock()
+        self.flights = SingleFlight()
+        self.async_flights = AsyncSingleFlight()
+        # ride -> invalidations seen while a read for it was in flight, so a read that
+        # started before a payment cannot cache its outdated answer
+        self.generations = {}
+
+        self.hits = Counter('api_gateway_payment_status_cache_hits_total',
+                            'Payment status reads answered from the cache', registry=None)
+        self.misses = Counter('api_gateway_payment_status_cache_misses_total',
+                              'Payment status reads that went upstream', registry=None)
+        self.coalesced = Counter('api_gateway_payment_status_coalesced_total',
+                                 'Payment status reads that shared an in-flight upstream call', registry=None)
+
+    def register_metrics(self, registry):
+        registry.register(self.hits)
+        registry.register(self.misses)
+        registry.register(self.coalesced)
+
+    def _is_terminal(self, response):
+        if response.status_code != 200:
+            return False
+        try:
+            return fast_json.parse_response(response).get('status') in self.terminal_statuses
+        except (ValueError, AttributeError):
+            return False
+
+    def _cached(self, key):
+        with self.lock:
+            response = self.cache.get(key)
+        if response is not None:
+            self.hits.inc()
+        return response
+
+    def _store(self, key, generation, response):
+        with self.lock:
+            if response is not None and self._is_terminal(response) and self.generations.get(key, 0) == generation:
+                self.cache.put(key, response)
+            self.generations.pop(key, None)
+
+    def _shared(self, shared):
+        if shared:
+            self.coalesced.inc()
+        else:
+            self.misses.inc()
+
+    def lookup(self, ride_id, fetch):
+        """Upstream response for ride_id from the cache or a single shared fetch() call."""
+        key = str(ride_id)
+        response = self._cached(key)
+        if response is not None:
+            return response
+
+        def load():
+            generation = self.generations.get(key, 0)
+            response = None
+            try:
+                response = fetch()
+            finally:
+                self._store(key, generation, response)
+            return response
+
+        response, shared = self.flights.do(key, load)
+        self._shared(shared)
+        return response
+
+    async def lookup_async(self, ride_id, fetch):
+        key = str(ride_id)
+        response = self._cached(key)
+        if response is not None:
+            return response
+
+        async def load():
+            generation = self.generations.get(key, 0)
+            response = None
+            try:
+                response = await fetch()
+            finally:
+                self._store(key, generation, response)
+            return response
+
+        response, shared = await self.async_flights.do(key, load)
+        self._shared(shared)
+        return response
+
+    def invalidate(self, ride_id):
+        key = str(ride_id)
+        with self.lock:
+            self.cache.pop(key)
+            if self.flights.in_flight(key) or self.async_flights.in_flight(key):
+                self.generations[key] = self.generations.get(key, 0) + 1
@@ -0,0 +1,143 @@
+# api-gateway/structured_log.py
+#
+# JSON lines logging for the gateway. Request threads and the event loop only put the log
+# record on a bounded queue; a background thread formats and writes it, so a slow or blocked
+# stdout never holds up a request. When the queue is full records are dropped and counted
+# rather than waited for.
+#
+# Every record carries the current request ID (taken from X-Request-ID or generated per
+# request) so one order can be followed across retries and instances. Per-attempt lines are
+# sampled with LOG_SAMPLE_RATE; warnings and errors are always kept.
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+
+from prometheus_client import Counter
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Fraction of noisy per-attempt lines (attempt started, attempt succeeded) that are written
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+MAX_REQUEST_ID_LENGTH = 128
+
+request_id = contextvars.ContextVar('request_id', default=None)
+
+DROPPED = Counter('api_gateway_log_records_dropped_total', 'Log records dropped because the log queue was full',
+                  registry=None)
+
+_listener = None
+
+
+def get_logger(name):
+    return logging.getLogger(f"api_gateway.{name}")
+
+
+def fields(**values):
+    """Structured fields for a record: log.info("...", extra=fields(service=...))."""
+    return {"fields": values}
+
+
+def sampled(logger, level=logging.INFO, rate=None):
+    """Whether a noisy line should be logged; check it before building the message."""
+    rate = LOG_SAMPLE_RATE if rate is None else rate
+    return logger.isEnabledFor(level) and (rate >= 1 or random.random() < rate)
+
+
+def submit_in_context(executor, fn, *args):
+    """executor.submit that keeps the caller's request ID (and other context) in the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def new_request_id(incoming=None):
+    """Use the caller's X-Request-ID if it is sane, otherwise make one; sets it for this context."""
+    if not incoming or len(incoming) > MAX_REQUEST_ID_LENGTH:
+        incoming = uuid.uuid4().hex
+    request_id.set(incoming)
+    return incoming
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry["request_id"] = record.request_id
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread as they are; never formats or blocks on the caller."""
+
+    def prepare(self, record):
+        # The record stays in this process, so there is no need to pre-format it for pickling;
+        # only the context-bound request ID must be captured before the record leaves the caller
+        record.request_id = request_id.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+
+def configure_logging(level=LOG_LEVEL, stream=None, queue_size=LOG_QUEUE_SIZE):
+    """Route the api_gateway loggers through the queue to a JSON writer thread (once)."""
+    global _listener
+    if _listener is not None:
+        return
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(JsonFormatter())
+    records = queue.Queue(maxsize=queue_size)
+    logger = logging.getLogger('api_gateway')
+    logger.setLevel(level)
+    logger.addHandler(NonBlockingQueueHandler(records))
+    logger.propagate = False
+    _listener = logging.handlers.QueueListener(records, writer, respect_handler_level=False)
+    _listener.start()
+
+
+def _restart_after_fork():
+    # The writer thread does not survive a fork (gunicorn workers forked from the preloading
+    # master), so the child gets its own queue and writer
+    global _listener
+    if _listener is None:
+        return
+    inherited, _listener = _listener, None
+    logger = logging.getLogger('api_gateway')
+    for handler in list(logger.handlers):
+        if isinstance(handler, NonBlockingQueueHandler):
+            logger.removeHandler(handler)
+    configure_logging(level=logger.level, stream=inherited.handlers[0].stream, queue_size=inherited.queue.maxsize)
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def flush_logging(timeout=5):
+    """Wait for queued records to be written, e.g. before exit."""
+    deadline = time.monotonic() + timeout
+    while _listener is not None and not _listener.queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def register_metrics(registry):
+    registry.register(DROPPED)
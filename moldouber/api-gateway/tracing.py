@@ -0,0 +1,350 @@
+# api-gateway/tracing.py
+#
+# Per-request tracing. Every gateway request gets a trace with a span for the handler, one for
+# each upstream call and one for every attempt inside it (retries, hedges and the instance
+# tried), and one for each saga forward and compensate step. Trace context arrives and leaves
+# as a W3C traceparent header, so the upstream services can continue the same trace.
+#
+# The current span lives in a context variable: it follows the request into asyncio tasks and
+# into executor threads started with submit_in_context. A new trace is recorded with
+# probability TRACE_SAMPLE_RATE, and an incoming traceparent's sampled flag is honoured.
+# Unsampled requests still pass their trace ID on but build no spans, so their cost is one
+# object per request. Finished spans go to TRACE_EXPORTER:
+#   memory  the last TRACE_MEMORY_SPANS spans, served by GET /traces (default); under several
+#           gunicorn workers each worker keeps and serves its own
+#   file    JSON lines appended to TRACE_FILE by a background thread
+#   none    spans are dropped; only propagation remains
+
+import collections
+import contextvars
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+from prometheus_client import Counter
+
+import fast_json
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'memory')
+TRACE_MEMORY_SPANS = int(os.environ.get('TRACE_MEMORY_SPANS', 10000))
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl')
+TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', 10000))
+
+TRACEPARENT_HEADER = 'traceparent'
+_TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$')
+_INVALID_TRACE_ID = '0' * 32
+_INVALID_SPAN_ID = '0' * 16
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+SPANS = Counter('api_gateway_trace_spans_total', 'Finished trace spans, by what happened to them',
+                ['outcome'], registry=None)
+# Bound once, labels() is too slow to call for every span
+EXPORTED = SPANS.labels(outcome='exported')
+DROPPED = SPANS.labels(outcome='dropped')
+DISCARDED = SPANS.labels(outcome='discarded')
+
+# Span start times are taken from perf_counter and turned into wall-clock time with this
+_WALL_CLOCK_OFFSET = time.time() - time.perf_counter()
+
+
+def _trace_id():
+    return random.randbytes(16).hex()
+
+
+def _span_id():
+    return random.randbytes(8).hex()
+
+
+def _ids():
+    # A new trace ID and root span ID from one call
+    ids = random.randbytes(24).hex()
+    return ids[:32], ids[32:]
+
+
+def parse_traceparent(header):
+    """(trace_id, parent span id, sampled) from a traceparent header, or None if it is invalid."""
+    match = _TRACEPARENT.match(header.strip().lower()) if header else None
+    if match is None:
+        return None
+    version, trace_id, span_id, flags, rest = match.groups()
+    # Version ff is invalid; version 00 has nothing after the flags
+    if version == 'ff' or (version == '00' and rest) or trace_id == _INVALID_TRACE_ID or span_id == _INVALID_SPAN_ID:
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+class NonRecordingSpan:
+    """Trace context of an unsampled request: propagated, never exported.
+
+    Child spans of an unsampled request are its passive span, so they cost nothing.
+    """
+
+    recording = False
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.token = None
+        self.header = None
+        # What span() returns for children: this span, never made current again by their blocks
+        self.passive = self
+
+    def traceparent(self):
+        if self.header is None:
+            self.header = f"00-{self.trace_id}-{self.span_id}-00"
+        return self.header
+
+    def set(self, **attributes):
+        pass
+
+    def set_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class UnsampledTrace(NonRecordingSpan):
+    """Unsampled root started by span() outside a request; current for its block like a Span."""
+
+    def __init__(self, trace_id, span_id):
+        super().__init__(trace_id, span_id)
+        self.passive = NonRecordingSpan(trace_id, span_id)
+
+    def __enter__(self):
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current_span.reset(self.token)
+        return False
+
+
+class Span(NonRecordingSpan):
+    """A recorded span; use it as a context manager to make it current for its block."""
+
+    recording = True
+
+    def __init__(self, name, trace_id, parent_id=None, kind='internal', attributes=None):
+        # Fields set inline rather than through NonRecordingSpan.__init__, this runs for every span
+        self.trace_id = trace_id
+        self.span_id = _span_id()
+        self.token = None
+        self.header = None
+        self.passive = self
+        self.name = name
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.status = 'ok'
+        self.error = None
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def traceparent(self):
+        if self.header is None:
+            self.header = f"00-{self.trace_id}-{self.span_id}-01"
+        return self.header
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def set_error(self, error):
+        self.status = 'error'
+        self.error = str(error) or type(error).__name__
+
+    def end(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.started
+            _exporter.export(self)
+
+    def __enter__(self):
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current_span.reset(self.token)
+        if exc is not None:
+            self.set_error(exc)
+        self.end()
+        return False
+
+    def to_dict(self):
+        span = {"traceId": self.trace_id, "spanId": self.span_id, "parentId": self.parent_id,
+                "name": self.name, "kind": self.kind, "start": round(_WALL_CLOCK_OFFSET + self.started, 6),
+                "durationSeconds": round(self.duration, 6), "status": self.status,
+                "attributes": self.attributes}
+        if self.error is not None:
+            span["error"] = self.error
+        return span
+
+
+def _sampled():
+    return TRACE_SAMPLE_RATE >= 1 or random.random() < TRACE_SAMPLE_RATE
+
+
+def span(name, kind='internal', **attributes):
+    """Child span of the current one, or the root of a new trace outside any request.
+
+    with span('upstream', service=...) as s: ... makes it current for the block and ends it.
+    """
+    parent = current_span.get()
+    if parent is None:
+        if _sampled():
+            return Span(name, _trace_id(), None, kind, attributes)
+        return UnsampledTrace(*_ids())
+    if not parent.recording:
+        return parent.passive
+    return Span(name, parent.trace_id, parent.span_id, kind, attributes)
+
+
+def start_request(name, traceparent=None, **attributes):
+    """Server span for an incoming request, current until finish_request."""
+    incoming = parse_traceparent(traceparent)
+    if incoming is None:
+        if _sampled():
+            request_span = Span(name, _trace_id(), None, 'server', attributes)
+        else:
+            request_span = NonRecordingSpan(*_ids())
+    else:
+        trace_id, parent_id, sampled = incoming
+        if sampled:
+            request_span = Span(name, trace_id, parent_id, 'server', attributes)
+        else:
+            # Not sampled upstream of us: pass the caller's context on unchanged
+            request_span = NonRecordingSpan(trace_id, parent_id)
+    request_span.token = current_span.set(request_span)
+    return request_span
+
+
+def finish_request(request_span, status_code=None, error=None):
+    current_span.reset(request_span.token)
+    if not request_span.recording:
+        return
+    if error is not None:
+        request_span.set_error(error)
+    if status_code is not None:
+        request_span.set(status_code=status_code)
+        if status_code >= 500:
+            request_span.status = 'error'
+    request_span.end()
+
+
+def inject(headers=None):
+    """Headers (a new dict, or headers updated in place) carrying the current trace context."""
+    headers = {} if headers is None else headers
+    current = current_span.get()
+    if current is not None:
+        headers[TRACEPARENT_HEADER] = current.traceparent()
+    return headers
+
+
+def grpc_metadata():
+    current = current_span.get()
+    return ((TRACEPARENT_HEADER, current.traceparent()),) if current is not None else None
+
+
+class NoExporter:
+
+    def export(self, finished):
+        DISCARDED.inc()
+
+    def spans(self, trace_id=None, limit=None):
+        return None
+
+
+class MemoryExporter(NoExporter):
+    """Keeps the most recent spans for GET /traces."""
+
+    def __init__(self, size=TRACE_MEMORY_SPANS):
+        self.finished = collections.deque(maxlen=size)
+
+    def export(self, finished):
+        # deque.append is atomic, request threads need no lock
+        self.finished.append(finished)
+        EXPORTED.inc()
+
+    def spans(self, trace_id=None, limit=None):
+        """Most recent first, optionally only one trace's."""
+        found = []
+        for finished in reversed(self.finished):
+            if trace_id is None or finished.trace_id == trace_id:
+                found.append(finished.to_dict())
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+
+class FileExporter(NoExporter):
+    """Appends spans as JSON lines from a writer thread; a full queue drops spans instead of waiting."""
+
+    def __init__(self, path=TRACE_FILE, queue_size=TRACE_QUEUE_SIZE):
+        self.path = path
+        self.queue_size = queue_size
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        # Started lazily and again after a fork, since the writer thread does not survive one
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(maxsize=self.queue_size)
+                threading.Thread(target=self._write, args=(self.queue,), name='trace-writer', daemon=True).start()
+                self.pid = os.getpid()
+
+    def _write(self, pending):
+        with open(self.path, 'ab') as out:
+            while True:
+                batch = [pending.get()]
+                while len(batch) < 256 and not pending.empty():
+                    batch.append(pending.get_nowait())
+                out.write(b''.join(fast_json.dumps(item.to_dict()) + b'\n' for item in batch))
+                out.flush()
+
+    def export(self, finished):
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(finished)
+            EXPORTED.inc()
+        except queue.Full:
+            DROPPED.inc()
+
+
+def create_exporter(kind=TRACE_EXPORTER):
+    if kind == 'memory':
+        return MemoryExporter()
+    if kind == 'file':
+        return FileExporter()
+    if kind == 'none':
+        return NoExporter()
+    raise ValueError(f"Unknown TRACE_EXPORTER: {kind}")
+
+
+_exporter = create_exporter()
+
+
+def set_exporter(exporter):
+    global _exporter
+    _exporter = exporter
+
+
+def recent_spans(trace_id=None, limit=None):
+    """Spans held by the memory exporter, or None when another exporter is configured."""
+    return _exporter.spans(trace_id, limit)
+
+
+def register_metrics(registry):
+    registry.register(SPANS)
@@ -0,0 +1,364 @@
+# api-gateway/upstream.py
+#
+# Upstream instance selection and retries, shared by the sync (Flask) and async (aiohttp) gateways.
+
+import asyncio
+import contextlib
+import time
+
+import aiohttp
+import grpc
+import requests
+
+from connection_pool import UpstreamPools, AsyncUpstreamPools, UpstreamHTTPError
+from grpc_transport import GrpcChannels, AsyncGrpcChannels, uses_grpc
+from hedging import HedgePolicy
+from balancer import create_balancer
+from circuit_breaker import CircuitBreakers, CircuitOpenError
+from concurrency_limit import ConcurrencyLimiter
+from retry_policy import RetryPolicy
+from discovery_client import DiscoveryCache
+from status_cache import PaymentStatusCache
+from idempotency import IdempotencyStore
+from saga import SagaOrchestrator
+from batch import BatchExecutor
+from rate_limit import RateLimiter
+from structured_log import get_logger, fields, sampled
+from saga_log import SagaLog, SAGA_LOG_PATH
+import tracing
+
+log = get_logger('upstream')
+
+SERVICE_HOSTS = {
+    'user-location': [
+        'http://user-location-service-1:5001',
+        'http://user-location-service-2:5001'
+    ],
+    'ride-payment': [
+        'http://ride-payment-service-1:5002',
+        'http://ride-payment-service-2:5002'
+    ]
+}
+
+# Instances registered with service-discovery; SERVICE_HOSTS is the fallback
+discovery = DiscoveryCache()
+
+# Keep-alive connection pools, one per upstream host, shared by all routes and the saga
+upstream_pools = UpstreamPools(host for hosts in SERVICE_HOSTS.values() for host in hosts)
+async_upstream_pools = AsyncUpstreamPools()
+# Persistent gRPC channels for service types switched to the gRPC transport
+grpc_channels = GrpcChannels()
+async_grpc_channels = AsyncGrpcChannels()
+
+# Picks which instance gets tried first, see LOAD_BALANCER
+balancer = create_balancer()
+
+# Duplicate slow idempotent reads onto a second instance
+hedge_policy = HedgePolicy()
+
+# Backoff, whole-request deadline and retry budget, see RETRY_* settings
+retry_policy = RetryPolicy()
+
+# Closed/open/half-open state per instance, see BREAKER_* settings
+circuit_breakers = CircuitBreakers()
+
+# Adaptive in-flight limit per service type with priority-based shedding, see CONCURRENCY_* settings
+concurrency_limiter = ConcurrencyLimiter()
+
+# Coalesced payment status reads with a cache of terminal statuses
+payment_status_cache = PaymentStatusCache()
+
+# Stored responses for requests carrying an Idempotency-Key, see IDEMPOTENCY_* settings
+idempotency_store = IdempotencyStore()
+
+# Runs /api/saga step DAGs over the same pools, see SAGA_* settings. Without a SAGA_LOG_PATH
+# (the default) sagas are kept in memory only, so a crash mid-saga is not recovered
+saga_orchestrator = SagaOrchestrator(upstream_pools, async_upstream_pools,
+                                     SagaLog(SAGA_LOG_PATH) if SAGA_LOG_PATH else None)
+
+# Bounded fan-out for the batch routes, see BATCH_* settings
+batch_executor = BatchExecutor()
+
+# Per-client token buckets per route, see RATE_LIMIT_* settings
+rate_limiter = RateLimiter()
+
+UPSTREAM_ERRORS = (requests.exceptions.RequestException, grpc.RpcError, CircuitOpenError)
+ASYNC_UPSTREAM_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, grpc.RpcError, CircuitOpenError)
+
+
+def _circuit_breaker_triggered(service_type, endpoint, all_instances_open):
+    if all_instances_open:
+        # If every instance has an open circuit
+        log.error("All instances have open circuits. Circuit breaker is triggered.",
+                  extra=fields(service=service_type, endpoint=endpoint))
+    else:
+        # If some instances were available but all failed
+        log.error("All available instances have failed. Circuit breaker is triggered.",
+                  extra=fields(service=service_type, endpoint=endpoint))
+
+    # If all retries are exhausted on all instances, raise an exception with a custom message
+    return Exception("Circuit breaker is triggered. All instances are unavailable.")
+
+
+def _admit(service_type, host):
+    breaker = circuit_breakers.get(service_type, host)
+    if not breaker.allow_request():
+        raise CircuitOpenError(f"Circuit for {host} is {breaker.state}")
+    return breaker
+
+
+@contextlib.contextmanager
+def _attempt(service_type, host, endpoint):
+    """Span, circuit breaker and balancer bookkeeping around one attempt.
+
+    Shared by _send and _send_async, which pass the upstream's reply through what it yields.
+    """
+    # One span per attempt, including attempts the instance's circuit turns away
+    with tracing.span('upstream.attempt', 'client', service=service_type, endpoint=endpoint, instance=host) as span:
+        breaker = _admit(service_type, host)
+        started = balancer.begin(service_type, host)
+        ok = False
+
+        def replied(response):
+            nonlocal ok
+            ok = response.status_code < 500
+            span.set(status_code=response.status_code)
+            if not ok:
+                span.set_error(f"{response.status_code} from upstream")
+            return response
+        cancelled = False
+        try:
+            yield replied
+        except asyncio.CancelledError:
+            # The losing hedged attempt, cancelled by the winner: it says nothing about the instance
+            cancelled = True
+            raise
+        finally:
+            balancer.finish(service_type, host, started, ok)
+            if cancelled:
+                breaker.release()
+            else:
+                # 4xx is the caller's fault, only transport errors and 5xx count against the instance
+                breaker.record(ok, time.monotonic() - started)
+
+
+def _send(service_type, host, endpoint, payload, timeout):
+    with _attempt(service_type, host, endpoint) as replied:
+        if uses_grpc(service_type, endpoint):
+            return replied(grpc_channels.call(service_type, host, endpoint, payload, timeout=timeout,
+                                              metadata=tracing.grpc_metadata()))
+        return replied(upstream_pools.post(f"{host}/{endpoint}", json=payload, timeout=timeout,
+                                           headers=tracing.inject()))
+
+
+async def _send_async(service_type, host, endpoint, payload, timeout):
+    with _attempt(service_type, host, endpoint) as replied:
+        if uses_grpc(service_type, endpoint):
+            return replied(await async_grpc_channels.call(service_type, host, endpoint, payload,
+                                                          timeout=timeout, metadata=tracing.grpc_metadata()))
+        return replied(await async_upstream_pools.post(f"{host}/{endpoint}", json=payload, timeout=timeout,
+                                                       headers=tracing.inject()))
+
+
+def resolve_instances(service_type):
+    return discovery.resolve(service_type, SERVICE_HOSTS[service_type])
+
+
+def _ordered_instances(service_type, service_instances):
+    return balancer.order(service_type, list(enumerate(service_instances)))
+
+
+def _available_instances(service_type, service_instances):
+    return [(instance_index, host) for instance_index, host in _ordered_instances(service_type, service_instances)
+            if circuit_breakers.get(service_type, host).is_available()]
+
+
+def call_service_with_retry(endpoint, payload, service_type):
+    if service_type not in SERVICE_HOSTS:
+        raise ValueError(f"Unknown service type: {service_type}")
+
+    with tracing.span('upstream.call', service=service_type, endpoint=endpoint):
+        # Rejects with ConcurrencyLimitExceeded before any upstream work when the service is saturated
+        ticket = concurrency_limiter.acquire(service_type, endpoint)
+        ok = False
+        try:
+            response = _call_service_with_retry(endpoint, payload, service_type)
+            ok = True
+            return response
+        finally:
+            concurrency_limiter.release(ticket, ok)
+
+
+class _Walk:
+    """The decisions of one retried upstream call, shared by the sync and async walks.
+
+    Those only do the I/O: the hedged pair from hedge_candidates(), then every attempt that
+    attempts() yields, sleeping its backoff first and reporting back to succeeded() or failed().
+    """
+
+    def __init__(self, service_type, endpoint):
+        self.service_type = service_type
+        self.endpoint = endpoint
+        self.instances = resolve_instances(service_type)
+        self.retry_state = retry_policy.start(service_type)
+        self.all_instances_open = True  # Flag to check if every circuit is open
+        self.moving_on = False
+
+    def timeout(self):
+        return self.retry_state.attempt_timeout()
+
+    def hedge_candidates(self):
+        """The instances to hedge the first attempt across, or None to go straight to the walk."""
+        if not hedge_policy.is_hedgeable(self.endpoint):
+            return None
+        candidates = _available_instances(self.service_type, self.instances)
+        if not candidates:
+            return None
+        self.retry_state.next_delay()  # The hedged pair counts as the first attempt
+        return candidates[:2]
+
+    def hedge_failed(self, error):
+        # Fall back to the regular per-instance retries
+        log.warning("Hedged attempt failed: %s", error, extra=fields(service=self.service_type, endpoint=self.endpoint))
+
+    def attempts(self):
+        """(attempt on this instance, host, backoff to sleep first) for each attempt to make."""
+        for instance_index, host in _ordered_instances(self.service_type, self.instances):
+            breaker = circuit_breakers.get(self.service_type, host)
+            if not breaker.is_available():
+                log.info("Instance circuit is %s. Skipping...", breaker.state,
+                         extra=fields(service=self.service_type, endpoint=self.endpoint, instance=host))
+                continue
+
+            # If we reach here, the instance admits calls
+            self.all_instances_open = False  # At least one instance is available
+            self.moving_on = False
+
+            for retry in range(1, retry_policy.retries_per_instance + 1):
+                delay = self.retry_state.next_delay()
+                if delay is None:
+                    log.warning("Giving up: retry %s exhausted.", self.retry_state.stop_reason,
+                                extra=fields(service=self.service_type, endpoint=self.endpoint,
+                                             attempts=self.retry_state.attempts))
+                    raise self.retry_state.exhausted_error()
+                if sampled(log):
+                    log.info("Attempt %d/%d", retry, retry_policy.retries_per_instance,
+                             extra=fields(service=self.service_type, endpoint=self.endpoint, instance=host,
+                                          sampled=True))
+                yield retry, host, delay
+                if self.moving_on:
+                    break
+
+    @staticmethod
+    def checked(response):
+        # A 4xx is the upstream's answer to this request and would be the same on any retry, so it
+        # goes back to the caller; only a 5xx raises (HTTPError) and is retried
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response
+
+    def succeeded(self, response, retry=None, host=None):
+        if host is not None and sampled(log):
+            log.info("Success: received status %d", response.status_code,
+                     extra=fields(service=self.service_type, endpoint=self.endpoint, instance=host, attempt=retry,
+                                  sampled=True))
+        self.retry_state.succeeded()
+        return response
+
+    def failed(self, retry, host, error):
+        where = fields(service=self.service_type, endpoint=self.endpoint, instance=host)
+        if isinstance(error, CircuitOpenError):
+            # The breaker tripped during this walk; move on to the next instance
+            log.info("%s. Moving on from this instance.", error, extra=where)
+            self.moving_on = True
+        elif isinstance(error, grpc.RpcError):
+            log.warning("RpcError on attempt %d: %s", retry, error.code(), extra=where)
+        elif isinstance(error, (requests.exceptions.HTTPError, UpstreamHTTPError)):
+            log.warning("HTTPError on attempt %d: %s", retry, error, extra=where)
+        else:
+            log.warning("RequestException on attempt %d: %s", retry, error, extra=where)
+
+    def unavailable(self):
+        return _circuit_breaker_triggered(self.service_type, self.endpoint, self.all_instances_open)
+
+
+def _call_service_with_retry(endpoint, payload, service_type):
+    walk = _Walk(service_type, endpoint)
+
+    candidates = walk.hedge_candidates()
+    if candidates:
+        def attempt(instance):
+            return walk.checked(_send(service_type, instance[1], endpoint, payload, walk.timeout()))
+        try:
+            return walk.succeeded(hedge_policy.call(attempt, service_type, endpoint, candidates))
+        except UPSTREAM_ERRORS as e:
+            walk.hedge_failed(e)
+
+    for retry, host, delay in walk.attempts():
+        if delay:
+            time.sleep(delay)
+        try:
+            response = walk.checked(_send(service_type, host, endpoint, payload, walk.timeout()))
+        except UPSTREAM_ERRORS as e:
+            walk.failed(retry, host, e)
+            continue
+        return walk.succeeded(response, retry, host)
+
+    raise walk.unavailable()
+
+
+async def call_service_with_retry_async(endpoint, payload, service_type):
+    if service_type not in SERVICE_HOSTS:
+        raise ValueError(f"Unknown service type: {service_type}")
+
+    with tracing.span('upstream.call', service=service_type, endpoint=endpoint):
+        ticket = concurrency_limiter.acquire(service_type, endpoint)
+        ok = False
+        try:
+            response = await _call_service_with_retry_async(endpoint, payload, service_type)
+            ok = True
+            return response
+        finally:
+            concurrency_limiter.release(ticket, ok)
+
+
+async def _call_service_with_retry_async(endpoint, payload, service_type):
+    # Same walk as _call_service_with_retry, but awaiting the upstream instead of holding a thread
+    walk = _Walk(service_type, endpoint)
+
+    candidates = walk.hedge_candidates()
+    if candidates:
+        async def attempt(instance):
+            return walk.checked(await _send_async(service_type, instance[1], endpoint, payload, walk.timeout()))
+        try:
+            return walk.succeeded(await hedge_policy.call_async(attempt, service_type, endpoint, candidates))
+        except ASYNC_UPSTREAM_ERRORS as e:
+            walk.hedge_failed(e)
+
+    for retry, host, delay in walk.attempts():
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            response = walk.checked(await _send_async(service_type, host, endpoint, payload, walk.timeout()))
+        except ASYNC_UPSTREAM_ERRORS as e:
+            walk.failed(retry, host, e)
+            continue
+        return walk.succeeded(response, retry, host)
+
+    raise walk.unavailable()
+
+
+def call_user_location_service(endpoint, payload):
+    return call_service_with_retry(endpoint, payload, "user-location")
+
+
+def call_ride_payment_service(endpoint, payload):
+    return call_service_with_retry(endpoint, payload, "ride-payment")
+
+
+async def call_user_location_service_async(endpoint, payload):
+    return await call_service_with_retry_async(endpoint, payload, "user-location")
+
+
+async def call_ride_payment_service_async(endpoint, payload):
+    return await call_service_with_retry_async(endpoint, payload, "ride-payment")
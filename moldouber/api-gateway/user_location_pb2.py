@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x13user_location.proto\x12\x0cuserLocation\"x\n\x0cOrderRequest\x12\x0e\n\x06userId\x18\x01 \x01(\t\x12\x16\n\x0estartLongitude\x18\x02 \x01(\x02\x12\x15\n\rstartLatitude\x18\x03 \x01(\x02\x12\x14\n\x0c\x65ndLongitude\x18\x04 \x01(\x02\x12\x13\n\x0b\x65ndLatitude\x18\x05 \x01(\x02\"8\n\rOrderResponse\x12\x0f\n\x07orderId\x18\x01 \x01(\t\x12\x16\n\x0e\x65stimatedPrice\x18\x02 \x01(\x02\"\x91\x01\n\x12\x41\x63\x63\x65ptOrderRequest\x12\x0f\n\x07orderId\x18\x01 \x01(\t\x12\x10\n\x08\x64riverId\x18\x02 \x01(\t\x12\x16\n\x0estartLongitude\x18\x03 \x01(\x02\x12\x15\n\rstartLatitude\x18\x04 \x01(\x02\x12\x14\n\x0c\x65ndLongitude\x18\x05 \x01(\x02\x12\x13\n\x0b\x65ndLatitude\x18\x06 \x01(\x02\"\x97\x01\n\x13\x41\x63\x63\x65ptOrderResponse\x12\x0e\n\x06rideId\x18\x01 \x01(\t\x12\x16\n\x0estartLongitude\x18\x02 \x01(\x02\x12\x15\n\rstartLatitude\x18\x03 \x01(\x02\x12\x14\n\x0c\x65ndLongitude\x18\x04 \x01(\x02\x12\x13\n\x0b\x65ndLatitude\x18\x05 \x01(\x02\x12\x16\n\x0e\x65stimatedPrice\x18\x06 \x01(\x02\"7\n\x12\x46inishOrderRequest\x12\x0e\n\x06rideId\x18\x01 \x01(\t\x12\x11\n\trealPrice\x18\x02 \x01(\x02\",\n\x13\x46inishOrderResponse\x12\x15\n\rpaymentStatus\x18\x01 \x01(\t\"%\n\x13PaymentCheckRequest\x12\x0e\n\x06rideId\x18\x01 \x01(\t\"&\n\x14PaymentCheckResponse\x12\x0e\n\x06status\x18\x01 \x01(\t2\xda\x02\n\x13UserLocationService\x12\x44\n\tMakeOrder\x12\x1a.userLocation.OrderRequest\x1a\x1b.userLocation.OrderResponse\x12R\n\x0b\x41\x63\x63\x65ptOrder\x12 .userLocation.AcceptOrderRequest\x1a!.userLocation.AcceptOrderResponse\x12R\n\x0b\x46inishOrder\x12 .userLocation.FinishOrderRequest\x1a!.userLocation.FinishOrderResponse\x12U\n\x0cPaymentCheck\x12!.userLocation.PaymentCheckRequest\x1a\".userLocation.PaymentCheckResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x13user_location.proto\x12\x0cuserLocation\"x\n\x0cOrderRequest\x12\x0e\n\x06userId\x18\x01 \x01(\t\x12\x16\n\x0estartLongitude\x18\x02 \x01(\x02\x12\x15\n\rstartLatitude\x18\x03 \x01(\x02\x12\x14\n\x0c\x65ndLongitude\x18\x04 \x01(\x02\x12\x13\n\x0b\x65ndLatitude\x18\x05 \x01(\x02\"8\n\rOrderResponse\x12\x0f\n\x07orderId\x18\x01 \x01(\t\x12\x16\n\x0e\x65stimatedPrice\x18\x02 \x01(\x02\"\x91\x01\n\x12\x41\x63\x63\x65ptOrderRequest\x12\x0f\n\x07orderId\x18\x01 \x01(\t\x12\x10\n\x08\x64riverId\x18\x02 \x01(\t\x12\x16\n\x0estartLongitude\x18\x03 \x01(\x02\x12\x15\n\rstartLatitude\x18\x04 \x01(\x02\x12\x14\n\x0c\x65ndLongitude\x18\x05 \x01(\x02\x12\x13\n\x0b\x65ndLatitude\x18\x06 \x01(\x02\"\x97\x01\n\x13\x41\x63\x63\x65ptOrderResponse\x12\x0e\n\x06rideId\x18\x01 \x01(\t\x12\x16\n\x0estartLongitude\x18\x02 \x01(\x02\x12\x15\n\rstartLatitude\x18\x03 \x01(\x02\x12\x14\n\x0c\x65ndLongitude\x18\x04 \x01(\x02\x12\x13\n\x0b\x65ndLatitude\x18\x05 \x01(\x02\x12\x16\n\x0e\x65stimatedPrice\x18\x06 \x01(\x02\"7\n\x12\x46inishOrderRequest\x12\x0e\n\x06rideId\x18\x01 \x01(\t\x12\x11\n\trealPrice\x18\x02 \x01(\x02\",\n\x13\x46inishOrderResponse\x12\x15\n\rpaymentStatus\x18\x01 \x01(\t\"%\n\x13PaymentCheckRequest\x12\x0e\n\x06rideId\x18\x01 \x01(\t\"6\n\x14PaymentCheckResponse\x12\x0e\n\x06status\x18\x01 \x01(\t\x12\x0e\n\x06userId\x18\x02 \x01(\t2\xda\x02\n\x13UserLocationService\x12\x44\n\tMakeOrder\x12\x1a.userLocation.OrderRequest\x1a\x1b.userLocation.OrderResponse\x12R\n\x0b\x41\x63\x63\x65ptOrder\x12 .userLocation.AcceptOrderRequest\x1a!.userLocation.AcceptOrderResponse\x12R\n\x0b\x46inishOrder\x12 .userLocation.FinishOrderRequest\x1a!.userLocation.FinishOrderResponse\x12U\n\x0cPaymentCheck\x12!.userLocation.PaymentCheckRequest\x1a\".userLocation.PaymentCheckResponseb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -46,7 +46,7 @@ if not _descriptor._USE_C_DESCRIPTORS:
   _globals['_PAYMENTCHECKREQUEST']._serialized_start=622
   _globals['_PAYMENTCHECKREQUEST']._serialized_end=659
   _globals['_PAYMENTCHECKRESPONSE']._serialized_start=661
-  _globals['_PAYMENTCHECKRESPONSE']._serialized_end=699
-  _globals['_USERLOCATIONSERVICE']._serialized_start=702
-  _globals['_USERLOCATIONSERVICE']._serialized_end=1048
+  _globals['_PAYMENTCHECKRESPONSE']._serialized_end=715
+  _globals['_USERLOCATIONSERVICE']._serialized_start=718
+  _globals['_USERLOCATIONSERVICE']._serialized_end=1064
 # @@protoc_insertion_point(module_scope)
@@ -0,0 +1,75 @@
+# benchmarks/hedge_breakers.py
+#
+# Drives hedged async payment checks against one slow-but-healthy and one fast stub upstream,
+# alternating which goes first, so every call to the slow instance is hedged and then
+# cancelled. Checks that those cancellations leave the slow instance's circuit closed and its
+# in-flight count at zero: hedging should trim tail latency, not take instances out of rotation.
+#
+#   python benchmarks/hedge_breakers.py --requests 20 --slow-latency 0.5
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# Round robin puts the slow instance first on every other call; a low minimum lets a
+# miscounted cancellation open the circuit within a few calls
+os.environ.setdefault('LOAD_BALANCER', 'round_robin')
+os.environ.setdefault('HEDGE_ENDPOINTS', 'payment_check')
+os.environ.setdefault('HEDGE_DEFAULT_DELAY', '0.05')
+os.environ.setdefault('HEDGE_BUDGET_BURST', '1000')
+os.environ.setdefault('BREAKER_MIN_CALLS', '2')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api-gateway'))
+
+import upstream  # noqa: E402
+from circuit_breaker import CLOSED  # noqa: E402
+from stub_upstream import StubUpstream  # noqa: E402
+
+
+async def run(requests_count, slow_latency):
+    slow = StubUpstream(latency=slow_latency).start()
+    fast = StubUpstream().start()
+    upstream.SERVICE_HOSTS['user-location'] = [slow.url, fast.url]
+
+    latencies = []
+    try:
+        for _ in range(requests_count):
+            started = time.perf_counter()
+            await upstream.call_service_with_retry_async('payment_check', {"rideId": "bench"}, 'user-location')
+            latencies.append(time.perf_counter() - started)
+        # Let the cancelled attempts unwind before looking at the breaker
+        await asyncio.sleep(0)
+    finally:
+        await upstream.async_upstream_pools.close()
+        slow.shutdown()
+        fast.shutdown()
+
+    latencies.sort()
+    breaker = upstream.circuit_breakers.get('user-location', slow.url)
+    return {
+        "requests": requests_count,
+        "p50": round(latencies[len(latencies) // 2], 4),
+        "max": round(latencies[-1], 4),
+        "slow_instance_calls": slow.requests,
+        "slow_breaker": breaker.state,
+        "slow_in_flight": upstream.balancer.state('user-location', slow.url).in_flight,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that cancelled hedges do not trip circuit breakers')
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--slow-latency', type=float, default=0.5)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.requests, args.slow_latency))
+    print(result)
+    if result["slow_breaker"] != CLOSED or result["slow_in_flight"] != 0:
+        print("Cancelled hedged attempts were counted against the slow instance")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
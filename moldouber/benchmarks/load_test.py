@@ -0,0 +1,402 @@
+# benchmarks/load_test.py
+#
+# Load test for the gateway. Starts the gateway (api-gateway/app.py, or async_app.py with
+# --mode async) in its own process in front of stub upstreams (stub_upstream.py) with the given
+# latency and error rate, then drives every route, the /api/saga flow and the
+# service-discovery endpoints. Each scenario can run closed-loop (a fixed number of clients
+# sending back to back) or open-loop, with requests arriving at a fixed rate or as a Poisson
+# process. Open-loop latency is measured from when a request was due, not when a client got
+# round to sending it, so a stalled gateway shows up in the percentiles.
+#
+# Results (throughput, error counts, p50/p99/p999 latency) are written as JSON; --compare
+# prints the change against an earlier run, e.g. from the previous commit.
+#
+#   python benchmarks/load_test.py --duration 10 --rate 200 --output before.json
+#   python benchmarks/load_test.py --duration 10 --rate 200 --output after.json --compare before.json
+
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+API_GATEWAY = os.path.join(BENCHMARKS, '..', 'api-gateway')
+
+sys.path.insert(0, BENCHMARKS)
+
+from registry_replication import Node, free_port  # noqa: E402
+
+ARRIVALS = ('closed', 'fixed', 'poisson')
+
+
+def gateway_scenarios(stub_url):
+    """name -> (method, path, body for the i-th request) for the gateway's routes."""
+    def saga(i):
+        steps = [{"name": name, "forward": {"url": f"{stub_url}/saga/{name}", "payload": {"n": i}},
+                  "compensate": {"url": f"{stub_url}/saga/{name}/undo", "payload": {"n": i}}}
+                 for name in ('reserve', 'charge', 'confirm')]
+        return {"transactionId": f"bench-{os.getpid()}-{i}-{random.getrandbits(32)}", "steps": steps}
+
+    return {
+        'make_order': ('POST', '/api/user/make_order', lambda i: {
+            "userId": f"u{i % 1000}", "startLongitude": 28.8, "startLatitude": 47.0,
+            "endLongitude": 28.9, "endLatitude": 47.1}),
+        'accept_order': ('POST', '/api/user/accept_order', lambda i: {"orderId": f"o{i}", "driverId": f"d{i % 100}"}),
+        'accept_orders': ('POST', '/api/user/accept_orders', lambda i: {
+            "orders": [{"orderId": f"o{i}-{n}", "driverId": f"d{n}"} for n in range(10)]}),
+        'finish_order': ('POST', '/api/user/finish_order', lambda i: {"rideId": f"r{i}", "realPrice": 42.5}),
+        'pay': ('POST', '/api/ride/pay', lambda i: {"rideId": f"r{i}", "amount": 42.5, "userId": f"u{i % 1000}"}),
+        'process_payment': ('POST', '/api/ride/process_payment', lambda i: {"rideId": f"r{i}"}),
+        'process_payments': ('POST', '/api/ride/process_payments', lambda i: {
+            "payments": [{"rideId": f"r{i}-{n}"} for n in range(10)]}),
+        # A working set of rides, so the payment status cache sees repeats as it would in production
+        'check_payment_status': ('POST', '/api/user/check_payment_status', lambda i: {"rideId": f"r{i % 1000}"}),
+        'saga': ('POST', '/api/saga', saga),
+        'status': ('GET', '/status', None),
+    }
+
+
+def discovery_scenarios():
+    def instance(i):
+        return {"service_name": "bench-service", "service_address": f"10.1.{(i // 250) % 250}.{i % 250}",
+                "service_port": "5001", "ttl": 300}
+
+    return {
+        'discovery_register': ('POST', '/register', instance),
+        'discovery_renew': ('POST', '/renew', lambda i: instance(i % DISCOVERY_INSTANCES)),
+        'discovery_service': ('GET', '/services/bench-service', None),
+        'discovery_instances': ('GET', '/services/bench-service/instances', None),
+        'discovery_services': ('GET', '/services', None),
+    }
+
+
+# Instances registered before the discovery scenarios run
+DISCOVERY_INSTANCES = 100
+
+
+def serve_stubs(conn, instances, latency, error_rate):
+    sys.path.insert(0, BENCHMARKS)
+    from stub_upstream import StubUpstream
+    stubs = [StubUpstream(latency=latency, error_rate=error_rate).start() for _ in range(instances)]
+    conn.send([stub.url for stub in stubs])
+    conn.recv()
+    conn.send([stub.requests for stub in stubs])
+
+
+def serve_gateway(mode, port, hosts, env):
+    os.environ.update(env)
+    os.chdir(API_GATEWAY)
+    sys.path.insert(0, API_GATEWAY)
+    import upstream
+    upstream.SERVICE_HOSTS.update(hosts)
+    if mode == 'async':
+        import async_app
+        async_app.main(host='127.0.0.1', port=port)
+    else:
+        from app import app
+        # Per-request access lines would cost more than some of the routes being measured
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def wait_until_up(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"{url}/status", timeout=2):
+                return
+        except (OSError, urllib.error.HTTPError):
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} did not start")
+            time.sleep(0.1)
+
+
+class Client:
+    """One keep-alive connection per load generator thread."""
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def request(self, method, path, body):
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        for attempt in (1, 2):
+            conn = getattr(self.local, 'conn', None)
+            if conn is None:
+                conn = self.local.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            try:
+                conn.request(method, path, payload, headers)
+                response = conn.getresponse()
+                response.read()
+                return response.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                self.local.conn = None
+                # A kept-alive connection the server already closed: reconnect once
+                if attempt == 2:
+                    return 0
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def change(new, old):
+    return f"{(new - old) / old * 100:+7.1f}%" if new is not None and old else '    n/a'
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for _, latency in samples)
+    statuses = {}
+    for status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(samples),
+        "throughput": round(len(samples) / elapsed, 2) if elapsed else 0,
+        "errors": sum(count for status, count in statuses.items() if not 200 <= int(status) < 300),
+        "statuses": statuses,
+        "latency_ms": {
+            "mean": milliseconds(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": milliseconds(percentile(latencies, 0.50)),
+            "p99": milliseconds(percentile(latencies, 0.99)),
+            "p999": milliseconds(percentile(latencies, 0.999)),
+            "max": milliseconds(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def run_closed(client, scenario, concurrency, duration, warmup):
+    method, path, body = scenario
+    counter = itertools.count()
+    samples = []
+    start = time.monotonic()
+    measure_from, stop_at = start + warmup, start + warmup + duration
+
+    def worker():
+        local = []
+        while True:
+            sent = time.monotonic()
+            if sent >= stop_at:
+                break
+            i = next(counter)
+            status = client.request(method, path, body(i) if body else None)
+            if sent >= measure_from:
+                local.append((status, time.monotonic() - sent))
+        samples.extend(local)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, duration
+
+
+def run_open(client, scenario, arrival, rate, connections, duration, warmup):
+    method, path, body = scenario
+    due = queue.Queue()
+    samples = []
+    lock = threading.Lock()
+    start = time.monotonic()
+    measure_from, stop_at = start + warmup, start + warmup + duration
+
+    def worker():
+        while True:
+            item = due.get()
+            if item is None:
+                return
+            i, scheduled = item
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            status = client.request(method, path, body(i) if body else None)
+            if scheduled >= measure_from:
+                with lock:
+                    samples.append((status, time.monotonic() - scheduled))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+
+    # Hand out arrival times a little ahead of when they are due; a worker that is still busy
+    # leaves its request waiting, and that wait counts towards the request's latency
+    scheduled = start
+    for i in itertools.count():
+        scheduled += random.expovariate(rate) if arrival == 'poisson' else 1 / rate
+        if scheduled >= stop_at:
+            break
+        ahead = scheduled - time.monotonic() - 0.05
+        if ahead > 0:
+            time.sleep(ahead)
+        due.put((i, scheduled))
+    for _ in threads:
+        due.put(None)
+    for thread in threads:
+        thread.join()
+    return samples, duration
+
+
+def run_scenario(client, name, scenario, arrival, args):
+    if arrival == 'closed':
+        samples, elapsed = run_closed(client, scenario, args.concurrency, args.duration, args.warmup)
+    else:
+        samples, elapsed = run_open(client, scenario, arrival, args.rate, args.connections, args.duration,
+                                    args.warmup)
+    result = {"scenario": name, "arrival": arrival,
+              "concurrency": args.concurrency if arrival == 'closed' else args.connections,
+              "target_rate": None if arrival == 'closed' else args.rate, "duration": elapsed}
+    result.update(summarize(samples, elapsed))
+    latency = result['latency_ms']
+    print(f"{name:<22} {arrival:<8} {result['throughput']:>9.1f} req/s {result['errors']:>6} errors  "
+          f"p50 {latency['p50'] or 0:>8.2f}  p99 {latency['p99'] or 0:>8.2f}  p999 {latency['p999'] or 0:>8.2f} ms")
+    return result
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['scenario'], r['arrival']): r for r in json.load(f)['results']}
+    print(f"\nchange against {baseline_path}:")
+    for result in results:
+        before = baseline.get((result['scenario'], result['arrival']))
+        if before is None:
+            continue
+        print(f"{result['scenario']:<22} {result['arrival']:<8} throughput "
+              f"{change(result['throughput'], before['throughput'])}  p50 "
+              f"{change(result['latency_ms']['p50'], before['latency_ms']['p50'])}  p99 "
+              f"{change(result['latency_ms']['p99'], before['latency_ms']['p99'])}  p999 "
+              f"{change(result['latency_ms']['p999'], before['latency_ms']['p999'])}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    all_scenarios = list(gateway_scenarios('')) + list(discovery_scenarios())
+    parser = argparse.ArgumentParser(description='Load test the gateway and service-discovery')
+    parser.add_argument('--mode', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--scenarios', default=','.join(all_scenarios),
+                        help='comma-separated subset of: ' + ', '.join(all_scenarios))
+    parser.add_argument('--arrivals', default='closed,fixed,poisson',
+                        help='comma-separated subset of: ' + ', '.join(ARRIVALS))
+    parser.add_argument('--duration', type=float, default=5, help='measured seconds per run')
+    parser.add_argument('--warmup', type=float, default=1, help='unmeasured seconds before each run')
+    parser.add_argument('--rate', type=float, default=100, help='requests per second for open-loop runs')
+    parser.add_argument('--concurrency', type=int, default=16, help='clients for closed-loop runs')
+    parser.add_argument('--connections', type=int, default=64, help='connections for open-loop runs')
+    parser.add_argument('--latency', type=float, default=0.005, help='stub upstream latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='stub upstream error rate')
+    parser.add_argument('--instances', type=int, default=2, help='stub instances per upstream service')
+    parser.add_argument('--output', default='load-test.json')
+    parser.add_argument('--compare', help='earlier --output file to compare against')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--trace-sample-rate', type=float, default=0.01,
+                        help="gateway TRACE_SAMPLE_RATE, to compare tracing overhead between runs")
+    parser.add_argument('--trace-exporter', default='memory', choices=['memory', 'file', 'none'])
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    selected = [name for name in args.scenarios.split(',') if name]
+    arrivals = [arrival for arrival in args.arrivals.split(',') if arrival]
+    unknown = [name for name in selected if name not in all_scenarios] + [a for a in arrivals if a not in ARRIVALS]
+    if unknown:
+        parser.error(f"unknown scenarios or arrivals: {', '.join(unknown)}")
+
+    spawn = multiprocessing.get_context('spawn')
+    data_dir = tempfile.mkdtemp(prefix='load-test-')
+    stubs_conn, child_conn = spawn.Pipe()
+    stubs = spawn.Process(target=serve_stubs, args=(child_conn, args.instances * 2, args.latency, args.error_rate),
+                          daemon=True)
+    stubs.start()
+    stub_urls = stubs_conn.recv()
+    hosts = {'user-location': stub_urls[:args.instances], 'ride-payment': stub_urls[args.instances:]}
+
+    results = []
+    gateway = registry = None
+    try:
+        gateway_names = [name for name in selected if name in gateway_scenarios('')]
+        if gateway_names:
+            port = free_port()
+            env = {
+                # One client address sends everything, so per-client limits would only measure themselves
+                'RATE_LIMIT_ENABLED': 'false',
+                'SAGA_LOG_PATH': os.path.join(data_dir, 'saga-log.db'),
+                'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+                'TRACE_SAMPLE_RATE': str(args.trace_sample_rate),
+                'TRACE_EXPORTER': args.trace_exporter,
+                'TRACE_FILE': os.path.join(data_dir, 'traces.jsonl'),
+            }
+            gateway = spawn.Process(target=serve_gateway, args=(args.mode, port, hosts, env), daemon=True)
+            gateway.start()
+            wait_until_up(f"http://127.0.0.1:{port}")
+            client = Client(port)
+            scenarios = gateway_scenarios(stub_urls[0])
+            for name in gateway_names:
+                for arrival in arrivals:
+                    results.append(run_scenario(client, name, scenarios[name], arrival, args))
+
+        discovery_names = [name for name in selected if name in discovery_scenarios()]
+        if discovery_names:
+            registry = Node('bench', free_port(), '', [])
+            registry.start()
+            client = Client(registry.port)
+            register = discovery_scenarios()['discovery_register'][2]
+            for i in range(DISCOVERY_INSTANCES):
+                client.request('POST', '/register', register(i))
+            scenarios = discovery_scenarios()
+            for name in discovery_names:
+                for arrival in arrivals:
+                    results.append(run_scenario(client, name, scenarios[name], arrival, args))
+    finally:
+        if registry is not None and registry.process.poll() is None:
+            registry.stop()
+        if gateway is not None:
+            gateway.terminate()
+            gateway.join()
+        stubs_conn.send('stop')
+        upstream_requests = stubs_conn.recv() if stubs_conn.poll(5) else None
+        stubs.join(5)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+        "upstream_requests": upstream_requests,
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nwrote {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# benchmarks/rate_limit_overhead.py
+#
+# Measures what the per-client rate limit adds to every request: the bucket check plus the
+# response headers, for one hot client, many distinct clients, and several threads sharing
+# the limiter. Also checks that a hot client is held to its burst.
+#
+#   python benchmarks/rate_limit_overhead.py --checks 200000 --threads 4
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api-gateway'))
+
+from rate_limit import RateLimiter  # noqa: E402
+
+ROUTE = '/api/user/check_payment_status'
+
+
+def per_check(limiter, clients, checks):
+    started = time.perf_counter()
+    for i in range(checks):
+        decision = limiter.check(ROUTE, clients[i % len(clients)])
+        decision.headers()
+    return (time.perf_counter() - started) / checks
+
+
+def scenario(name, checks, clients, threads=1, rate='1000000:1000000'):
+    limiter = RateLimiter(enabled=True, default=rate, limits='', backend='local')
+    clients = [f"user:{i}" for i in range(clients)]
+    if threads == 1:
+        seconds = per_check(limiter, clients, checks)
+    else:
+        results = []
+        workers = [threading.Thread(target=lambda: results.append(per_check(limiter, clients, checks // threads)))
+                   for _ in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # Wall time per check across all threads, which is what the gateway pays under the GIL
+        seconds = (time.perf_counter() - started) / checks
+    print(f"{name:<28} {seconds * 1e9:8.0f} ns/check")
+
+
+def burst_is_enforced(burst=10):
+    limiter = RateLimiter(enabled=True, default=f"1:{burst}", limits='', backend='local')
+    allowed = sum(1 for _ in range(burst * 5) if limiter.check(ROUTE, 'user:hot').allowed)
+    print(f"hot client at 1/s with burst {burst}: {allowed} of {burst * 5} admitted")
+    return allowed == burst
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure per-request rate limiting overhead')
+    parser.add_argument('--checks', type=int, default=200000)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    scenario('one client', args.checks, 1)
+    scenario(f'{args.clients} clients', args.checks, args.clients)
+    scenario(f'{args.clients} clients, {args.threads} threads', args.checks, args.clients, args.threads)
+    if not burst_is_enforced():
+        print("Rate limit admitted more than its burst")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
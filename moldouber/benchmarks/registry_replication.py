@@ -0,0 +1,148 @@
+# benchmarks/registry_replication.py
+#
+# Starts several service-discovery nodes as local processes, each with its own data
+# directory, and checks that registrations replicate, that a node restarted from its
+# write-ahead log catches up on changes it missed, and how long a restart takes.
+#
+#   python benchmarks/registry_replication.py --nodes 3 --instances 500
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+SERVICE_DISCOVERY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'service-discovery',
+                                 'service-discovery.py')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def call(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'},
+                                 method='POST' if body is not None else 'GET')
+    try:
+        with urllib.request.urlopen(req, timeout=5) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+class Node:
+
+    def __init__(self, node_id, port, data_dir, peers):
+        self.node_id = node_id
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.data_dir = data_dir
+        self.peers = peers
+        self.process = None
+
+    def start(self):
+        env = dict(os.environ, REGISTRY_SNAPSHOT_EVERY='200', REPLICATION_SYNC_INTERVAL='1')
+        self.process = subprocess.Popen(
+            [sys.executable, SERVICE_DISCOVERY, '--host', '127.0.0.1', '--port', str(self.port),
+             '--data-dir', self.data_dir, '--node-id', self.node_id, '--peers', ','.join(self.peers)],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        started = time.monotonic()
+        while True:
+            try:
+                call(f"{self.url}/status")
+                return time.monotonic() - started
+            except OSError:
+                if time.monotonic() - started > 30:
+                    raise RuntimeError(f"{self.node_id} did not start")
+                time.sleep(0.05)
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+
+    def instance_count(self, service_name):
+        status, body = call(f"{self.url}/services/{service_name}/instances")
+        return len(body['instances']) if status == 200 else 0
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def instances(count, offset=0):
+    return [{"service_name": "bench-service", "service_address": f"10.0.{(i // 250) % 250}.{i % 250}",
+             "service_port": str(5000 + i // 62500), "ttl": 300} for i in range(offset, offset + count)]
+
+
+def run(node_count, instance_count):
+    root = tempfile.mkdtemp(prefix='registry-replication-')
+    ports = [free_port() for _ in range(node_count)]
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    nodes = [Node(f"node-{i}", port, os.path.join(root, f"node-{i}"), [u for u in urls if u != urls[i]])
+             for i, port in enumerate(ports)]
+    failures = []
+    try:
+        for node in nodes:
+            node.start()
+
+        first, restarted = nodes[0], nodes[-1]
+        started = time.monotonic()
+        call(f"{first.url}/batch", {"register": instances(instance_count)})
+        replicated = wait_for(lambda: all(n.instance_count('bench-service') == instance_count for n in nodes))
+        print(f"replicated {instance_count} registrations to {node_count} nodes in "
+              f"{time.monotonic() - started:.3f}s")
+        if not replicated:
+            failures.append('registrations did not reach every node')
+
+        # Changes made while a node is down must reach it after it restarts from its log
+        restarted.stop()
+        call(f"{first.url}/batch", {"deregister": instances(instance_count // 2)})
+        recovery = restarted.start()
+        print(f"{restarted.node_id} restarted from its write-ahead log in {recovery:.3f}s")
+        expected = instance_count - instance_count // 2
+        if not wait_for(lambda: restarted.instance_count('bench-service') == expected):
+            failures.append(f"{restarted.node_id} has {restarted.instance_count('bench-service')} "
+                            f"instances after restart, expected {expected}")
+
+        # A whole-cluster restart must come back from disk alone
+        for node in nodes:
+            node.stop()
+        for node in nodes:
+            node.start()
+        if not all(n.instance_count('bench-service') == expected for n in nodes):
+            failures.append('registry was not recovered from disk after a full restart')
+    finally:
+        for node in nodes:
+            if node.process is not None and node.process.poll() is None:
+                node.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check registry replication and write-ahead log recovery')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--instances', type=int, default=500)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.nodes, args.instances) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# benchmarks/retry_amplification.py
+#
+# Drives call_service_with_retry against failing stub upstreams and asserts that the retry
+# budget keeps upstream attempts within N * (1 + RETRY_BUDGET_RATIO) + RETRY_BUDGET_BURST.
+# Also checks that a 4xx is never retried: a payment check for an unknown ride costs one
+# upstream call and reaches the client as orderNotPaid.
+#
+#   python benchmarks/retry_amplification.py --requests 500 --error-rate 0.5
+
+import argparse
+import os
+import sys
+
+# Keep breakers closed and backoff short so the run measures the retry budget alone
+os.environ.setdefault('BREAKER_MIN_CALLS', str(10 ** 9))
+os.environ.setdefault('RETRY_BASE_DELAY', '0.001')
+os.environ.setdefault('RETRY_MAX_DELAY', '0.005')
+os.environ.setdefault('HEDGE_ENDPOINTS', '')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api-gateway'))
+
+import app  # noqa: E402
+import upstream  # noqa: E402
+from stub_upstream import StubUpstream  # noqa: E402
+
+
+def run(requests_count, error_rate, instances):
+    stubs = [StubUpstream(error_rate=error_rate).start() for _ in range(instances)]
+    upstream.SERVICE_HOSTS['ride-payment'] = [stub.url for stub in stubs]
+
+    successes = 0
+    for _ in range(requests_count):
+        try:
+            upstream.call_ride_payment_service('process_payment', {"rideId": "bench"})
+            successes += 1
+        except Exception:
+            pass
+
+    for stub in stubs:
+        stub.shutdown()
+
+    attempts = sum(stub.requests for stub in stubs)
+    policy = upstream.retry_policy
+    bound = requests_count + successes * policy.budget_ratio + policy.budget_burst
+    return {
+        "requests": requests_count,
+        "successes": successes,
+        "upstream_attempts": attempts,
+        "amplification": attempts / requests_count,
+        "bound": bound,
+        "within_bound": attempts <= bound,
+    }
+
+
+def unknown_ride_is_not_paid(instances):
+    stubs = [StubUpstream(status=404).start() for _ in range(instances)]
+    upstream.SERVICE_HOSTS['user-location'] = [stub.url for stub in stubs]
+
+    response = app.app.test_client().post('/api/user/check_payment_status', json={"rideId": "unknown"})
+
+    for stub in stubs:
+        stub.shutdown()
+
+    attempts = sum(stub.requests for stub in stubs)
+    print(f"404 from payment_check: {response.status_code} {response.get_json()} after {attempts} upstream call(s)")
+    return response.status_code == 200 and response.get_json().get('status') == 'orderNotPaid' and attempts == 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the retry amplification bound')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--instances', type=int, default=2)
+    parser.add_argument('--error-rate', type=float, action='append')
+    args = parser.parse_args()
+
+    ok = True
+    for error_rate in args.error_rate or [0.0, 0.5, 1.0]:
+        result = run(args.requests, error_rate, args.instances)
+        print(f"error_rate={error_rate}: {result}")
+        ok = ok and result["within_bound"]
+
+    if not ok:
+        print("Retry amplification bound exceeded")
+        sys.exit(1)
+    if not unknown_ride_is_not_paid(args.instances):
+        print("A 404 from payment_check was retried or not reported as orderNotPaid")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# benchmarks/stub_upstream.py
+#
+# In-process HTTP stand-in for the Node upstreams with configurable latency, error rate and
+# reply status.
+# Counts every request it receives so callers can measure upstream amplification.
+
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, each keep-alive reply would
+    # wait out the client's delayed ACK (~40ms) and swamp the latency being measured
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        self.server.record_request()
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if random.random() < self.server.error_rate:
+            status, reply = 500, {"error": "stub failure"}
+        elif self.server.status != 200:
+            status, reply = self.server.status, {"error": "stub status"}
+        else:
+            status, reply = 200, dict(body, status='success', path=self.path)
+
+        content = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class StubUpstream(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, status=200):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        # Status of every reply that is not a random 500
+        self.status = status
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Callers that gave up (a cancelled hedge, a timeout) close the connection mid-reply
+        pass
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
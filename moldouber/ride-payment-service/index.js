@@ -75,14 +75,17 @@ const SERVICE_DISCOVERY_URL = process.env.SERVICE_DISCOVERY_URL || 'http://servi
 const SERVICE_NAME = process.env.SERVICE_NAME || 'ride-payment-service';
 const SERVICE_ADDRESS = process.env.SERVICE_ADDRESS || 'ride-payment-service';
 const SERVICE_PORT = process.env.SERVICE_PORT || 5002;
+// Registration is a lease; heartbeat well inside it so one lost renewal does not drop us
+const SERVICE_TTL = Number(process.env.SERVICE_TTL || 30);
 
 // Function to register the service
 async function registerService() {
   try {
-    await axios.post('http://service-discovery:8500/register', {
+    await axios.post(`${SERVICE_DISCOVERY_URL}/register`, {
       service_name: SERVICE_NAME,
-      service_address: 'nginx',  // Register Nginx as the service address
-      service_port: '80'          // Nginx listens on port 80 inside the container
+      service_address: SERVICE_ADDRESS,  // Register this replica so the gateway can balance across them
+      service_port: String(SERVICE_PORT),
+      ttl: SERVICE_TTL
     });
     console.log(`${SERVICE_NAME} registered with Service Discovery`);
   } catch (error) {
@@ -92,11 +95,12 @@ async function registerService() {
 
 // Function to deregister the service
 async function deregisterService() {
+  clearInterval(heartbeat);
   try {
-    await axios.post('http://service-discovery:8500/deregister', {
+    await axios.post(`${SERVICE_DISCOVERY_URL}/deregister`, {
       service_name: SERVICE_NAME,
-      service_address: 'nginx',
-      service_port: '80'
+      service_address: SERVICE_ADDRESS,
+      service_port: String(SERVICE_PORT)
     });
     console.log(`${SERVICE_NAME} deregistered from Service Discovery`);
   } catch (error) {
@@ -104,8 +108,27 @@ async function deregisterService() {
   }
 }
 
-// Register service on startup
+// Function to renew the registration lease
+async function renewService() {
+  try {
+    await axios.post(`${SERVICE_DISCOVERY_URL}/renew`, {
+      service_name: SERVICE_NAME,
+      service_address: SERVICE_ADDRESS,
+      service_port: String(SERVICE_PORT)
+    });
+  } catch (error) {
+    if (error.response && error.response.status === 404) {
+      // The lease expired (or the registry restarted), register from scratch
+      await registerService();
+    } else {
+      console.error('Error renewing service lease:', error.message);
+    }
+  }
+}
+
+// Register service on startup, then keep the lease alive
 registerService();
+const heartbeat = setInterval(renewService, (SERVICE_TTL * 1000) / 3);
 
 // Handle graceful shutdown
 process.on('SIGINT', deregisterService);
@@ -0,0 +1,118 @@
+# service-discovery/registry_log.py
+#
+# Append-only write-ahead log of registry operations plus periodic compacted snapshots.
+# Every operation carries a last-writer-wins version, so replaying the snapshot and then the
+# log segments is idempotent and order-independent, which keeps compaction simple: rotate to
+# a new segment, dump the state, then drop the segments the snapshot covers.
+
+import json
+import os
+import threading
+
+REGISTRY_FSYNC = os.environ.get('REGISTRY_FSYNC', 'true').lower() == 'true'
+# Compact once this many records were appended since the last snapshot...
+REGISTRY_SNAPSHOT_EVERY = int(os.environ.get('REGISTRY_SNAPSHOT_EVERY', 1000))
+# ...or this many seconds passed with at least one record
+REGISTRY_SNAPSHOT_INTERVAL = float(os.environ.get('REGISTRY_SNAPSHOT_INTERVAL', 60))
+
+SNAPSHOT_FILE = 'snapshot.json'
+SEGMENT_PREFIX = 'wal-'
+SEGMENT_SUFFIX = '.log'
+
+
+class RegistryLog:
+
+    def __init__(self, directory, fsync=REGISTRY_FSYNC, snapshot_every=REGISTRY_SNAPSHOT_EVERY):
+        self.directory = directory
+        self.fsync = fsync
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        self.segment = 0
+        self.file = None
+        self.records_since_snapshot = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{segment:08d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                segments.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(segments)
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def load(self):
+        """Return (snapshot state or None, ops logged after it) and open a fresh segment."""
+        state = None
+        first_segment = 0
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as f:
+                snapshot = json.load(f)
+            state = snapshot['state']
+            first_segment = snapshot['segment']
+
+        ops = []
+        segments = self._segments()
+        for segment in segments:
+            if segment < first_segment:
+                continue
+            with open(self._segment_path(segment)) as f:
+                for line in f:
+                    try:
+                        ops.append(json.loads(line))
+                    except ValueError:
+                        # Torn write from a crash; everything before it is intact
+                        break
+
+        # Never append after a possibly torn tail: start a new segment instead
+        self.segment = max(segments + [first_segment - 1]) + 1
+        self.file = open(self._segment_path(self.segment), 'a')
+        self.records_since_snapshot = len(ops)
+        return state, ops
+
+    def append(self, ops):
+        if not ops:
+            return
+        lines = ''.join(json.dumps(op, separators=(',', ':')) + '\n' for op in ops)
+        with self.lock:
+            self.file.write(lines)
+            self._sync(self.file)
+            self.records_since_snapshot += len(ops)
+
+    def needs_compaction(self):
+        return self.records_since_snapshot >= self.snapshot_every
+
+    def compact(self, export_state):
+        """Snapshot export_state() and drop the log segments it covers."""
+        with self.lock:
+            self.file.close()
+            self.segment += 1
+            self.file = open(self._segment_path(self.segment), 'a')
+            self.records_since_snapshot = 0
+            keep_from = self.segment
+
+        # Taken after the rotation, so it includes every op in the older segments
+        state = export_state()
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"segment": keep_from, "state": state}, f, separators=(',', ':'))
+            self._sync(f)
+        os.replace(tmp_path, snapshot_path)
+
+        for segment in self._segments():
+            if segment < keep_from:
+                os.remove(self._segment_path(segment))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,109 @@
+# service-discovery/replication.py
+#
+# Optional multi-node mode. Each node pushes the operations it accepts to every peer
+# (POST /replicate) from a per-peer queue, and periodically pulls each peer's full state
+# (GET /replicate/state) as anti-entropy, which repairs whatever a dropped push or a
+# partition lost. Conflicts resolve last-writer-wins on the (lamport clock, node id) version
+# carried by every operation, so all nodes converge regardless of delivery order.
+
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+
+REGISTRY_PEERS = [peer.strip().rstrip('/') for peer in os.environ.get('REGISTRY_PEERS', '').split(',') if peer.strip()]
+REPLICATION_TIMEOUT = float(os.environ.get('REPLICATION_TIMEOUT', 2))
+REPLICATION_SYNC_INTERVAL = float(os.environ.get('REPLICATION_SYNC_INTERVAL', 30))
+# Pushes queued per peer while it is unreachable; beyond this the peer catches up by anti-entropy
+REPLICATION_QUEUE_SIZE = int(os.environ.get('REPLICATION_QUEUE_SIZE', 10000))
+REPLICATION_BATCH = 500
+REPLICATION_MAX_BACKOFF = 5.0
+
+
+def request_json(url, body=None, timeout=REPLICATION_TIMEOUT):
+    data = None
+    headers = {}
+    if body is not None:
+        data = json.dumps(body, separators=(',', ':')).encode()
+        headers['Content-Type'] = 'application/json'
+    req = urllib.request.Request(url, data=data, headers=headers, method='POST' if body is not None else 'GET')
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+class Peer:
+
+    def __init__(self, url, queue_size):
+        self.url = url
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+
+class Replicator:
+
+    def __init__(self, node_id, peers, merge_state, timeout=REPLICATION_TIMEOUT,
+                 sync_interval=REPLICATION_SYNC_INTERVAL, queue_size=REPLICATION_QUEUE_SIZE):
+        self.node_id = node_id
+        self.peers = [Peer(url, queue_size) for url in peers]
+        self.merge_state = merge_state
+        self.timeout = timeout
+        self.sync_interval = sync_interval
+
+    def broadcast(self, ops):
+        if not ops:
+            return
+        for peer in self.peers:
+            for op in ops:
+                try:
+                    peer.pending.put_nowait(op)
+                except queue.Full:
+                    peer.dropped += 1
+
+    def _push_loop(self, peer):
+        backoff = 0.1
+        while True:
+            batch = [peer.pending.get()]
+            while len(batch) < REPLICATION_BATCH:
+                try:
+                    batch.append(peer.pending.get_nowait())
+                except queue.Empty:
+                    break
+            # Keep retrying the same batch so the peer sees ops in the order we accepted them
+            while True:
+                try:
+                    request_json(f"{peer.url}/replicate", {"origin": self.node_id, "ops": batch}, self.timeout)
+                    backoff = 0.1
+                    break
+                except (OSError, ValueError) as e:
+                    print(f"Replication to {peer.url} failed: {e}")
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, REPLICATION_MAX_BACKOFF)
+
+    def sync_once(self):
+        """Pull and merge every reachable peer's state; returns how many answered."""
+        synced = 0
+        for peer in self.peers:
+            try:
+                state = request_json(f"{peer.url}/replicate/state", timeout=self.timeout)
+            except (OSError, ValueError) as e:
+                print(f"Anti-entropy sync with {peer.url} failed: {e}")
+                continue
+            self.merge_state(state)
+            synced += 1
+        return synced
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.sync_interval)
+            self.sync_once()
+
+    def start(self):
+        if not self.peers:
+            return
+        # Catch up before serving so a restarted node does not advertise a stale registry
+        self.sync_once()
+        for peer in self.peers:
+            threading.Thread(target=self._push_loop, args=(peer,), name=f"replicate-{peer.url}", daemon=True).start()
+        threading.Thread(target=self._sync_loop, name='anti-entropy', daemon=True).start()
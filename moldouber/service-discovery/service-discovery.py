@@ -1,74 +1,571 @@
 # service-discovery/service-discovery.py
 
 from flask import Flask, request, jsonify
-from threading import Lock
+from threading import Lock, Condition, Thread
+import argparse
+import heapq
+import itertools
+import os
+import socket
+import time
+import urllib.request
+
+from registry_log import RegistryLog, REGISTRY_SNAPSHOT_INTERVAL
+from replication import Replicator, REGISTRY_PEERS
 
 app = Flask(__name__)
 
-# In-memory registry
+# Upper bound for ?wait= on blocking queries
+MAX_WAIT_SECONDS = 60
+
+# Registrations are leases: an instance that stops renewing is dropped after its TTL
+DEFAULT_LEASE_TTL = float(os.environ.get('LEASE_TTL', 30))
+# Longest the reaper sleeps between checks when no lease is close to expiring
+REAPER_MAX_SLEEP = 1.0
+# Active HTTP checks against each instance's /status; 0 disables them
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', 0))
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT', 2))
+HEALTH_CHECK_FAILURES = int(os.environ.get('HEALTH_CHECK_FAILURES', 3))
+
+# Directory for the write-ahead log and snapshots; empty keeps the registry in memory only
+REGISTRY_DATA_DIR = os.environ.get('REGISTRY_DATA_DIR', '')
+# How long deregistrations are remembered so a lagging peer cannot resurrect the instance
+REGISTRY_TOMBSTONE_TTL = float(os.environ.get('REGISTRY_TOMBSTONE_TTL', 3600))
+NODE_ID = os.environ.get('REGISTRY_NODE_ID') or socket.gethostname()
+
+# Set up in main() when durability / replication are enabled
+registry_log = None
+replicator = None
+
+# Lamport clock ordering every register/deregister across nodes
+lamport_clock = 0
+clock_lock = Lock()
+
+
+class ServiceEntry:
+    """Instances of one service, indexed by (address, port).
+
+    Writers take the entry's own lock, so services never contend with each other. Every
+    change publishes a new immutable `view` of (index, instances); readers just load it.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.instances = {}
+        # (address, port) -> [expires_at, ttl]
+        self.leases = {}
+        # Min-heap of (expires_at, (address, port)); renewals push a new entry and the
+        # stale one is skipped when popped
+        self.expiry_heap = []
+        # (address, port) -> consecutive failed health checks
+        self.health_failures = {}
+        # (address, port) -> [clock, node_id, present, ttl, updated_at] of the winning
+        # register/deregister; kept for deregistered instances too (tombstones)
+        self.versions = {}
+        self.view = (0, ())
+        self.rotation = itertools.count()
+
+    def add(self, service_address, service_port, ttl):
+        # Caller holds self.lock; returns whether the instance is new
+        key = (service_address, service_port)
+        added = key not in self.instances
+        if added:
+            self.instances[key] = {"address": service_address, "port": service_port}
+        # Re-registering an existing instance just renews its lease
+        self.grant_lease(key, ttl)
+        return added
+
+    def remove(self, service_address, service_port):
+        # Caller holds self.lock; returns whether the instance was registered
+        key = (service_address, service_port)
+        self.leases.pop(key, None)
+        self.health_failures.pop(key, None)
+        return self.instances.pop(key, None) is not None
+
+    def grant_lease(self, key, ttl):
+        # Caller holds self.lock
+        expires_at = time.monotonic() + ttl
+        self.leases[key] = [expires_at, ttl]
+        heapq.heappush(self.expiry_heap, (expires_at, key))
+
+    def apply(self, op):
+        # Caller holds self.lock; last writer wins on op['version']. Returns (accepted, modified).
+        key = (op['address'], op['port'])
+        if op['op'] == 'renew':
+            lease = self.leases.get(key)
+            if lease is None:
+                return False, False
+            self.grant_lease(key, op.get('ttl') or lease[1])
+            return True, False
+
+        version = tuple(op['version'])
+        current = self.versions.get(key)
+        if current is not None and version <= (current[0], current[1]):
+            return False, False
+        present = op['op'] == 'register'
+        self.versions[key] = [version[0], version[1], present, op.get('ttl'), time.time()]
+        if present:
+            return True, self.add(key[0], key[1], op.get('ttl') or DEFAULT_LEASE_TTL)
+        return True, self.remove(*key)
+
+    def publish(self, service_name):
+        # Caller holds self.lock. The view is swapped under `changed` so a woken watcher
+        # never reads the previous view with the new index.
+        instances = tuple(self.instances.values())
+        with changed:
+            self.view = (bump_index(service_name), instances)
+
+
+# In-memory registry: service_name -> ServiceEntry. Entries are never deleted, an empty
+# one simply has no instances, so readers can hold a reference without locking.
 registry = {}
+# Only guards creating entries
 lock = Lock()
 
+# Registry version: bumped on every change; service_index holds the version of each service's last change
+registry_index = 0
+service_index = {}
+index_lock = Lock()
+# Signalled on every registry change so long-polling watchers wake up
+changed = Condition(index_lock)
+
+
+def get_entry(service_name):
+    entry = registry.get(service_name)
+    if entry is None:
+        with lock:
+            entry = registry.setdefault(service_name, ServiceEntry())
+    return entry
+
+
+def bump_index(service_name):
+    # Caller holds `changed`
+    global registry_index
+    registry_index += 1
+    service_index[service_name] = registry_index
+    changed.notify_all()
+    return registry_index
+
+
+def next_version():
+    global lamport_clock
+    with clock_lock:
+        lamport_clock += 1
+        return [lamport_clock, NODE_ID]
+
+
+def observe_version(version):
+    global lamport_clock
+    with clock_lock:
+        lamport_clock = max(lamport_clock, version[0])
+
+
+def make_op(kind, service_name, service_address, service_port, ttl=None):
+    op = {"op": kind, "service_name": service_name, "address": service_address, "port": service_port, "ttl": ttl}
+    if kind != 'renew':
+        op["version"] = next_version()
+    return op
+
+
+def valid_op(op):
+    if not isinstance(op, dict) or op.get('op') not in ('register', 'deregister', 'renew'):
+        return False
+    if not all(isinstance(op.get(field), (str, int)) and op.get(field) for field in ('service_name', 'address', 'port')):
+        return False
+    if op['op'] == 'renew':
+        return True
+    version = op.get('version')
+    return isinstance(version, list) and len(version) == 2 and isinstance(version[0], int)
+
+
+def record_ops(ops, replicate=True, log=True):
+    # Renewals are replicated so every node's leases stay alive, but not logged: leases
+    # are re-granted on restart anyway
+    if log and registry_log is not None:
+        registry_log.append([op for op in ops if op['op'] != 'renew'])
+    if replicate and replicator is not None:
+        replicator.broadcast(ops)
+
+
+def apply_ops(ops, replicate=True, log=True):
+    """Apply ops (local or from a peer / the log) per service and record the accepted ones."""
+    by_service = {}
+    for op in ops:
+        by_service.setdefault(op['service_name'], []).append(op)
+        if 'version' in op:
+            observe_version(op['version'])
+
+    accepted = []
+    for service_name, service_ops in by_service.items():
+        entry = get_entry(service_name)
+        with entry.lock:
+            modified = False
+            for op in service_ops:
+                op_accepted, op_modified = entry.apply(op)
+                if op_accepted:
+                    accepted.append(op)
+                modified = modified or op_modified
+            if modified:
+                entry.publish(service_name)
+
+    record_ops(accepted, replicate, log)
+    return accepted
+
+
+def export_state():
+    services = {}
+    for service_name, entry in list(registry.items()):
+        with entry.lock:
+            services[service_name] = [[address, port] + version[:4] for (address, port), version in entry.versions.items()]
+    return {"node_id": NODE_ID, "services": services}
+
+
+def merge_state(state, log=True):
+    # Used for snapshots and anti-entropy alike: every row is just another versioned op
+    ops = []
+    for service_name, rows in state['services'].items():
+        for address, port, clock, node_id, present, ttl in rows:
+            ops.append({"op": "register" if present else "deregister", "service_name": service_name,
+                        "address": address, "port": port, "ttl": ttl, "version": [clock, node_id]})
+    apply_ops(ops, replicate=False, log=log)
+
+
+def prune_tombstones():
+    cutoff = time.time() - REGISTRY_TOMBSTONE_TTL
+    for entry in list(registry.values()):
+        with entry.lock:
+            for key in [key for key, version in entry.versions.items() if not version[2] and version[4] < cutoff]:
+                del entry.versions[key]
+
+
+def compaction_loop():
+    last_snapshot = time.monotonic()
+    while True:
+        time.sleep(1)
+        due = time.monotonic() - last_snapshot >= REGISTRY_SNAPSHOT_INTERVAL and registry_log.records_since_snapshot
+        if registry_log.needs_compaction() or due:
+            prune_tombstones()
+            registry_log.compact(export_state)
+            last_snapshot = time.monotonic()
+
+
+def parse_wait(value):
+    # Accepts "30", "30s" or "500ms"
+    if not value:
+        return 0.0
+    if value.endswith('ms'):
+        seconds = float(value[:-2]) / 1000
+    else:
+        seconds = float(value.rstrip('s'))
+    return min(max(seconds, 0.0), MAX_WAIT_SECONDS)
+
+
+def parse_ttl(value):
+    if value is None:
+        return DEFAULT_LEASE_TTL
+    ttl = float(value)
+    if ttl <= 0:
+        raise ValueError("ttl must be positive")
+    return ttl
+
+
+def reap_expired():
+    # Pops only the leases that are due, so a pass costs O(services + expired * log n)
+    # rather than a scan of every instance
+    now = time.monotonic()
+    reaped = []
+    next_expiry = None
+    for service_name, entry in list(registry.items()):
+        with entry.lock:
+            removed = False
+            while entry.expiry_heap and entry.expiry_heap[0][0] <= now:
+                expires_at, key = heapq.heappop(entry.expiry_heap)
+                lease = entry.leases.get(key)
+                if lease is None or lease[0] != expires_at:
+                    # Renewed or deregistered since this entry was pushed
+                    continue
+                op = make_op('deregister', service_name, *key)
+                accepted, modified = entry.apply(op)
+                if accepted:
+                    reaped.append(op)
+                removed = removed or modified
+            if removed:
+                entry.publish(service_name)
+            if entry.expiry_heap and (next_expiry is None or entry.expiry_heap[0][0] < next_expiry):
+                next_expiry = entry.expiry_heap[0][0]
+    record_ops(reaped)
+    for op in reaped:
+        print(f"Lease expired for {op['service_name']} at {op['address']}:{op['port']}, removed")
+    return next_expiry
+
+
+def reaper_loop():
+    while True:
+        next_expiry = reap_expired()
+        sleep_for = REAPER_MAX_SLEEP
+        if next_expiry is not None:
+            sleep_for = min(max(next_expiry - time.monotonic(), 0.01), REAPER_MAX_SLEEP)
+        time.sleep(sleep_for)
+
+
+def check_instance(service_address, service_port):
+    try:
+        with urllib.request.urlopen(f"http://{service_address}:{service_port}/status",
+                                    timeout=HEALTH_CHECK_TIMEOUT) as response:
+            return response.status < 500
+    except OSError:
+        return False
+
+
+def health_check_loop():
+    while True:
+        time.sleep(HEALTH_CHECK_INTERVAL)
+        for service_name, entry in list(registry.items()):
+            with entry.lock:
+                targets = list(entry.leases)
+            # Checks run without the lock so a slow instance never blocks the registry
+            for key in targets:
+                healthy = check_instance(*key)
+                with entry.lock:
+                    if key not in entry.leases:
+                        continue
+                    if healthy:
+                        entry.health_failures.pop(key, None)
+                        continue
+                    entry.health_failures[key] = entry.health_failures.get(key, 0) + 1
+                    if entry.health_failures[key] < HEALTH_CHECK_FAILURES:
+                        continue
+                    op = make_op('deregister', service_name, *key)
+                    removed = entry.apply(op)[1]
+                    if removed:
+                        entry.publish(service_name)
+                # A renewal that raced in keeps the instance, and nothing is logged or replicated
+                if removed:
+                    record_ops([op])
+                    print(f"Health checks failed for {service_name} at {key[0]}:{key[1]}, removed")
+
+
+def start_background_tasks():
+    Thread(target=reaper_loop, name='lease-reaper', daemon=True).start()
+    if registry_log is not None:
+        Thread(target=compaction_loop, name='registry-compaction', daemon=True).start()
+    if HEALTH_CHECK_INTERVAL > 0:
+        Thread(target=health_check_loop, name='health-checker', daemon=True).start()
+
+
+def wait_for_change(current_index, index, wait):
+    # Blocks until current_index() moves past index or wait expires
+    deadline = time.monotonic() + wait
+    with changed:
+        while current_index() <= index:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            changed.wait(remaining)
+
+
+def registration_fields(data):
+    # Returns (service_name, service_address, service_port) or None if any is missing
+    if not isinstance(data, dict):
+        return None
+    fields = (data.get('service_name'), data.get('service_address'), data.get('service_port'))
+    if not all(fields):
+        return None
+    return fields
+
 @app.route('/register', methods=['POST'])
 def register():
     data = request.json
-    service_name = data.get('service_name')
-    service_address = data.get('service_address')
-    service_port = data.get('service_port')
-    
-    if not all([service_name, service_address, service_port]):
+    fields = registration_fields(data)
+
+    if fields is None:
+        return jsonify({"error": "Missing required fields"}), 400
+    try:
+        ttl = parse_ttl(data.get('ttl'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid ttl"}), 400
+
+    apply_ops([make_op('register', *fields, ttl=ttl)])
+
+    return jsonify({"message": "Service registered successfully", "ttl": ttl}), 200
+
+# Heartbeat: extends the lease. 404 tells the instance it was reaped and must register again.
+@app.route('/renew', methods=['POST'])
+def renew():
+    data = request.json
+    fields = registration_fields(data)
+
+    if fields is None:
         return jsonify({"error": "Missing required fields"}), 400
-    
-    with lock:
-        if service_name not in registry:
-            registry[service_name] = []
-        # Avoid duplicate entries
-        if not any(s['address'] == service_address and s['port'] == service_port for s in registry[service_name]):
-            registry[service_name].append({
-                "address": service_address,
-                "port": service_port
-            })
-    
-    return jsonify({"message": "Service registered successfully"}), 200
+
+    ttl = None
+    if data.get('ttl') is not None:
+        try:
+            ttl = parse_ttl(data['ttl'])
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid ttl"}), 400
+
+    if not apply_ops([make_op('renew', *fields, ttl=ttl)]):
+        return jsonify({"error": "Service not registered"}), 404
+
+    return jsonify({"message": "Lease renewed"}), 200
 
 @app.route('/deregister', methods=['POST'])
 def deregister():
     data = request.json
-    service_name = data.get('service_name')
-    service_address = data.get('service_address')
-    service_port = data.get('service_port')
-    
-    if not all([service_name, service_address, service_port]):
+    fields = registration_fields(data)
+
+    if fields is None:
         return jsonify({"error": "Missing required fields"}), 400
-    
-    with lock:
-        if service_name in registry:
-            registry[service_name] = [s for s in registry[service_name] if not (s['address'] == service_address and s['port'] == service_port)]
-            if not registry[service_name]:
-                del registry[service_name]
-    
+
+    apply_ops([make_op('deregister', *fields)])
+
     return jsonify({"message": "Service deregistered successfully"}), 200
 
+# Many registrations and deregistrations in one call, e.g. after a rolling deploy:
+# {"register": [{service_name, service_address, service_port, ttl?}, ...], "deregister": [...]}
+# Each service is locked once and publishes one new version for the whole batch.
+@app.route('/batch', methods=['POST'])
+def batch():
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+
+    ops = []
+    errors = []
+    for operation in ('register', 'deregister'):
+        for position, item in enumerate(data.get(operation) or []):
+            fields = registration_fields(item)
+            if fields is None:
+                errors.append({"operation": operation, "position": position, "error": "Missing required fields"})
+                continue
+            ttl = None
+            if operation == 'register':
+                try:
+                    ttl = parse_ttl(item.get('ttl'))
+                except (TypeError, ValueError):
+                    errors.append({"operation": operation, "position": position, "error": "Invalid ttl"})
+                    continue
+            ops.append(make_op(operation, *fields, ttl=ttl))
+
+    apply_ops(ops)
+    registered = sum(1 for op in ops if op['op'] == 'register')
+    deregistered = len(ops) - registered
+
+    status_code = 200 if not errors else 207
+    return jsonify({"registered": registered, "deregistered": deregistered, "errors": errors}), status_code
+
+# Operations pushed by a peer node; applied and logged here but not forwarded again
+@app.route('/replicate', methods=['POST'])
+def replicate():
+    data = request.json
+    ops = data.get('ops') if isinstance(data, dict) else None
+    if not isinstance(ops, list) or not all(valid_op(op) for op in ops):
+        return jsonify({"error": "Invalid operations"}), 400
+
+    accepted = apply_ops(ops, replicate=False)
+    return jsonify({"accepted": len(accepted)}), 200
+
+# Full versioned state, including tombstones, for peers doing anti-entropy
+@app.route('/replicate/state', methods=['GET'])
+def replicate_state():
+    return jsonify(export_state()), 200
+
 @app.route('/services/<service_name>', methods=['GET'])
 def get_service(service_name):
-    with lock:
-        services = registry.get(service_name)
-        if not services:
-            return jsonify({"error": "Service not found"}), 404
-        # For simplicity, return the first available service
-        return jsonify(services[0]), 200
-    
+    entry = registry.get(service_name)
+    services = entry.view[1] if entry is not None else ()
+    if not services:
+        return jsonify({"error": "Service not found"}), 404
+    # Rotate through the instances so clients do not all pile onto the first one
+    return jsonify(services[next(entry.rotation) % len(services)]), 200
+
+# Full instance list. With ?index=N&wait=30s the call blocks until the service changes
+# past index N (or wait expires), so clients can watch instead of polling.
+@app.route('/services/<service_name>/instances', methods=['GET'])
+def get_service_instances(service_name):
+    index = request.args.get('index', type=int)
+    try:
+        wait = parse_wait(request.args.get('wait'))
+    except ValueError:
+        return jsonify({"error": "Invalid wait"}), 400
+
+    if index is not None:
+        wait_for_change(lambda: service_index.get(service_name, 0), index, wait)
+    entry = registry.get(service_name)
+    current, services = entry.view if entry is not None else (0, ())
+
+    if not services:
+        response = jsonify({"error": "Service not found", "index": current})
+        response.status_code = 404
+    else:
+        response = jsonify({"service_name": service_name, "instances": list(services), "index": current})
+    response.headers['X-Registry-Index'] = str(current)
+    return response
+
+# Every service and its instances, with the same blocking ?index=&wait= semantics on the
+# registry-wide version
+@app.route('/services', methods=['GET'])
+def get_services():
+    index = request.args.get('index', type=int)
+    try:
+        wait = parse_wait(request.args.get('wait'))
+    except ValueError:
+        return jsonify({"error": "Invalid wait"}), 400
+
+    if index is not None:
+        wait_for_change(lambda: registry_index, index, wait)
+    current = registry_index
+    services = {name: list(entry.view[1]) for name, entry in list(registry.items()) if entry.view[1]}
+
+    response = jsonify({"services": services, "index": current})
+    response.headers['X-Registry-Index'] = str(current)
+    return response
+
 
 # **New /status Endpoint**
 @app.route('/status', methods=['GET'])
 def status():
-    with lock:
-        service_count = sum(len(instances) for instances in registry.values())
+    service_count = sum(len(entry.view[1]) for entry in list(registry.values()))
     return jsonify({
         "status": "Service Discovery is running",
-        "registered_services": service_count
+        "registered_services": service_count,
+        "node_id": NODE_ID,
+        "index": registry_index,
+        "peers": [peer.url for peer in replicator.peers] if replicator is not None else []
     }), 200
 
 
+def main():
+    global NODE_ID, registry_log, replicator
+
+    parser = argparse.ArgumentParser(description='Service discovery registry node')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('DISCOVERY_PORT', 8500)))
+    parser.add_argument('--data-dir', default=REGISTRY_DATA_DIR,
+                        help='directory for the write-ahead log and snapshots (default: memory only)')
+    parser.add_argument('--node-id', default=NODE_ID)
+    parser.add_argument('--peers', default=','.join(REGISTRY_PEERS),
+                        help='comma-separated base URLs of the other registry nodes')
+    args = parser.parse_args()
+
+    NODE_ID = args.node_id
+    if args.data_dir:
+        registry_log = RegistryLog(args.data_dir)
+        state, ops = registry_log.load()
+        if state is not None:
+            merge_state(state, log=False)
+        apply_ops(ops, replicate=False, log=False)
+        print(f"Recovered {sum(len(entry.view[1]) for entry in registry.values())} instances from {args.data_dir}")
+
+    peers = [peer.strip().rstrip('/') for peer in args.peers.split(',') if peer.strip()]
+    if peers:
+        replicator = Replicator(NODE_ID, peers, merge_state)
+        replicator.start()
+
+    start_background_tasks()
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8500)
+    main()